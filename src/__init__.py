@@ -31,6 +31,7 @@ __all__ = [
     "NetworkEvent",
 
     "ProtocolMessage",
+    "DeliveryPolicy",
     "IntroductionMessage",
     "AcknowledgeMessage",
     "MessageMessage",
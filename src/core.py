@@ -48,6 +48,9 @@ def broadcast_message(msg):
     """
     Transmit the message to all of the connections currently established with
     our network manager.
+
+    This returns right away; the message is encoded and sent by the network
+    thread, so it should not be modified after it is handed over.
     """
     _manager.broadcast(msg)
 
@@ -14,6 +14,10 @@ class SubliNetEventListener(sublime_plugin.EventListener):
     """
     This handles Sublime Text events (as opposed to network events, which are
     separate and handled elsewhere).
+
+    These run in the main thread, so they should do no more than gather what
+    they need from the sublime API and hand it off; messages are encoded and
+    transmitted by the network thread.
     """
     def on_new_window(self, window):
         for existing in sublime.windows():
@@ -25,6 +25,7 @@ class NetworkEventHandler():
         manager.add_handler('core', NetworkEvent.CONNECTION_FAILED, self.connectionState)
 
         manager.add_handler('core', NetworkEvent.MESSAGE, self.message)
+        manager.add_handler('core', NetworkEvent.FILE_RECEIVED, self.file_received)
 
     def connectionState(self, connection, event, extra):
         is_error = event in [NetworkEvent.CLOSED, NetworkEvent.CONNECTION_FAILED]
@@ -33,7 +34,7 @@ class NetworkEventHandler():
 
     def message(self, connection, event, msg):
         if msg.msg_id() == ClipboardMessage.msg_id():
-            return self.clipboard_message(connection, msg.text)
+            return self.clipboard_message(connection, msg)
         elif msg.msg_id() == ClipboardHistoryMessage.msg_id():
             return self.clipboard_history(connection, msg)
         elif msg.msg_id() == IntroductionMessage.msg_id():
@@ -41,22 +42,36 @@ class NetworkEventHandler():
         else:
             log(f'{str(msg)}', panel=True)
 
-    def clipboard_message(self, connection, text):
-        log(f'{connection.hostname} updated the clipboard ({len(text)} characters)', panel=True)
+    def file_received(self, connection, event, path):
+        log(f'Received file from {connection.hostname}: {path}', panel=True)
         display_output_panel(is_error=False)
 
-        sublime.set_clipboard(text)
-        g_clipboard_history.push_text(text)
+    def sender(self, connection, msg):
+        """
+        Return the hostname of the host that sent the provided message, which
+        is not the host at the other end of the connection when the message
+        was relayed to us through the overlay.
+        """
+        return msg.origin_hostname or connection.hostname
+
+    def clipboard_message(self, connection, msg):
+        log(f'{self.sender(connection, msg)} updated the clipboard ({len(msg.text)} characters)', panel=True)
+        display_output_panel(is_error=False)
+
+        sublime.set_clipboard(msg.text)
+        if not msg.duplicate:
+            g_clipboard_history.push_text(msg.text)
 
     def clipboard_history(self, connection, msg):
         accept = sn_setting('sync_paste_history')
         if accept:
-            g_clipboard_history.push_text(msg.text)
+            for text, duplicate in zip(msg.entries, msg.duplicates):
+                if not duplicate:
+                    g_clipboard_history.push_text(text)
 
-        if msg.index == msg.total:
-            status = 'Received' if accept else 'Rejected'
-            log(f'{status} {msg.total} clipboard history entries from {connection.hostname}', panel=True)
-            display_output_panel(is_error=False)
+        status = 'Received' if accept else 'Rejected'
+        log(f'{status} {len(msg.entries)} clipboard history entries from {self.sender(connection, msg)}', panel=True)
+        display_output_panel(is_error=False)
 
     def introduction_message(self, connection, msg):
         connection.hostname = msg.hostname
@@ -1,6 +1,8 @@
 from ...sublinet import reload
 
-reload("src.network", ["events", "messages", "connection", "transport", "manager"])
+reload("src.network", ["events", "messages", "timers", "framing", "sendqueue",
+                       "compression", "heartbeat", "connection", "registry", "filetransfer",
+                       "content", "overlay", "dialer", "directory", "transport", "manager"])
 
 from .events import NetworkEvent
 from .messages import *
@@ -12,6 +14,7 @@ __all__ = [
     "NetworkEvent",
 
     "ProtocolMessage",
+    "DeliveryPolicy",
     "IntroductionMessage",
     "AcknowledgeMessage",
     "MessageMessage",
@@ -0,0 +1,239 @@
+import struct
+import zlib
+
+from .messages import ProtocolMessage, CompressedMessage, IntroductionMessage
+from .messages import ClipboardMessage, ClipboardHistoryMessage, FileContentMessage
+from .messages import FragmentMessage
+
+
+### ---------------------------------------------------------------------------
+
+
+# The messages that are worth compressing, and the subset of those whose
+# content is used to build the preset dictionary.
+_compressible = {
+    ClipboardMessage.msg_id(),
+    ClipboardHistoryMessage.msg_id(),
+    FileContentMessage.msg_id()
+}
+_dictionary_source = {
+    ClipboardMessage.msg_id(),
+    ClipboardHistoryMessage.msg_id()
+}
+
+# zlib can't make use of a dictionary larger than its window size.
+_dictionary_size = 32768
+
+_size_width = struct.calcsize(">I")
+
+
+### ---------------------------------------------------------------------------
+
+
+class SharedDictionary():
+    """
+    A preset compression dictionary made up of the most recent clipboard text
+    sent in one direction on a connection.
+
+    Both ends of a connection see exactly the same sequence of messages in
+    each direction, so as long as they each feed every message through their
+    dictionary in the order it was sent or received, they will always agree on
+    its content without it ever needing to be transmitted. This lets small
+    snippets compress well, since they are usually similar to text that was
+    recently copied.
+    """
+    def __init__(self):
+        self.content = bytearray()
+
+    def update(self, msg_id, frame):
+        """
+        Add the provided encoded message (without its length prefix) to the
+        dictionary, if it is one whose content contributes to it.
+        """
+        if msg_id in _dictionary_source:
+            self.content += frame[-_dictionary_size:]
+            del self.content[:-_dictionary_size]
+
+    def get(self):
+        return bytes(self.content)
+
+
+### ---------------------------------------------------------------------------
+
+
+class FragmentTracker():
+    """
+    Large messages are sent as a series of Fragment messages (see
+    FragmentMessage), which should be compressed and feed the dictionary the
+    same as the message that they are pieces of would.
+
+    This keeps track of which message the fragments on each stream are part
+    of; only the first fragment of a message carries its header, and the rest
+    follow it in order on the same stream. Both ends see the fragments in the
+    same order, so they always agree.
+    """
+    def __init__(self):
+        # Maps the id of every stream that is in the middle of a fragmented
+        # message onto the id and size of that message.
+        self.streams = dict()
+
+    def describe(self, body):
+        """
+        Take an encoded message (without its length prefix) and return the id
+        and size of the message whose content it carries; for a Fragment
+        that's the message that it is a piece of, otherwise it is the message
+        itself.
+        """
+        msg_id, = struct.unpack_from(">H", body)
+        if msg_id != FragmentMessage.msg_id():
+            return msg_id, len(body)
+
+        _, stream, flags = struct.unpack_from(">HBB", body)
+        described = self.streams.get(stream)
+        if described is None:
+            size, msg_id = struct.unpack_from(">IH", body, 4)
+            described = (msg_id, size)
+
+        if flags & FragmentMessage.FLAG_LAST:
+            self.streams.pop(stream, None)
+        else:
+            self.streams[stream] = described
+
+        return described
+
+
+### ---------------------------------------------------------------------------
+
+
+class FrameCompressor():
+    """
+    Compresses outgoing encoded messages on a connection. Every frame sent on
+    the connection needs to pass through here in order (even when compression
+    is not enabled) so that the shared dictionary stays in step with the one
+    at the other end.
+
+    Compression is enabled once the Introduction from the remote end says that
+    it can handle it; until then frames pass through untouched. Fragments are
+    compressed one at a time if the message that they're part of would be.
+    """
+    def __init__(self, threshold, use_dictionary):
+        self.threshold = threshold
+        self.use_dictionary = use_dictionary
+        self.enabled = False
+
+        self.dictionary = SharedDictionary()
+        self.fragments = FragmentTracker()
+
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+    def negotiate(self, remote_features):
+        """
+        Configure compression based on the features advertised by the remote
+        end in its Introduction.
+        """
+        self.enabled = bool(remote_features & IntroductionMessage.FEATURE_ZLIB)
+        self.use_dictionary = (self.use_dictionary and
+                               bool(remote_features & IntroductionMessage.FEATURE_DICTIONARY))
+
+    def process(self, frame):
+        """
+        Take an encoded message (including its length prefix) that is about to
+        be sent and return the frame to actually send in its place, which is
+        either the original or a compressed version of it.
+        """
+        if not isinstance(frame, memoryview):
+            return frame
+
+        body = frame[_size_width:]
+        msg_id, size = self.fragments.describe(body)
+
+        result = frame
+        if self.enabled and msg_id in _compressible and len(body) >= self.threshold:
+            result = self._compress(body, size) or frame
+
+        self.dictionary.update(msg_id, body)
+
+        self.raw_bytes += len(frame)
+        self.wire_bytes += len(result)
+
+        return result
+
+    def _compress(self, body, size):
+        """
+        Compress the message body, which is part of a message of the given
+        size, returning the frame for the compressed version, or None if
+        compression didn't make it any smaller.
+        """
+        flags = 0
+        dictionary = self.dictionary.get() if self.use_dictionary else b''
+
+        # Large payloads favor speed over size so that they don't tie up the
+        # network thread for too long.
+        level = 6 if size < 1048576 else 1
+        if dictionary:
+            flags |= CompressedMessage.FLAG_DICTIONARY
+            compressor = zlib.compressobj(level, zdict=dictionary)
+        else:
+            compressor = zlib.compressobj(level)
+
+        content = compressor.compress(body) + compressor.flush()
+        if len(content) >= len(body):
+            return None
+
+        return memoryview(CompressedMessage(flags, len(body), content).encode())
+
+
+### ---------------------------------------------------------------------------
+
+
+class FrameDecompressor():
+    """
+    Expands incoming compressed messages on a connection; every frame received
+    on the connection needs to pass through here in order, so that the shared
+    dictionary stays in step with the one at the other end.
+
+    Messages that would expand to more than the maximum frame size (if there
+    is one) are rejected without being expanded.
+    """
+    def __init__(self, max_frame=0):
+        self.max_frame = max_frame
+        self.dictionary = SharedDictionary()
+        self.fragments = FragmentTracker()
+
+    def process(self, frame):
+        """
+        Take a received encoded message (without its length prefix) and return
+        the encoded message that it represents, expanding it if it was sent
+        compressed.
+        """
+        msg_id, = struct.unpack_from(">H", frame)
+        if msg_id == CompressedMessage.msg_id():
+            frame = self._expand(ProtocolMessage.from_data(frame))
+
+        msg_id, _ = self.fragments.describe(frame)
+        self.dictionary.update(msg_id, frame)
+        return frame
+
+    def _expand(self, msg):
+        """
+        Decompress the content of a compressed message, ensuring that it
+        expands to the size that the sender said that it would.
+        """
+        if self.max_frame and msg.raw_length > self.max_frame:
+            raise ValueError('Compressed message expands beyond the limit of {}'.format(
+                self.max_frame))
+
+        if msg.flags & CompressedMessage.FLAG_DICTIONARY:
+            decompressor = zlib.decompressobj(zdict=self.dictionary.get())
+        else:
+            decompressor = zlib.decompressobj()
+
+        frame = decompressor.decompress(msg.content, msg.raw_length)
+        if len(frame) != msg.raw_length or not decompressor.eof:
+            raise ValueError('Compressed message does not match its stated size')
+
+        return frame
+
+
+### ---------------------------------------------------------------------------
@@ -1,13 +1,16 @@
-import sublime
-
 import queue
-import struct
 import socket
+import selectors
 
-from .messages import ProtocolMessage
+from .messages import ProtocolMessage, DeliveryPolicy, Stream
+from .messages import IntroductionMessage, FragmentMessage
+from .framing import FrameReader, FrameWriter, FrameAssembler, FileFrame
+from .compression import FrameCompressor, FrameDecompressor
+from .sendqueue import SendQueue
+from .heartbeat import LinkStats
 
 from .events import NetworkEvent
-from ..utils import log
+from ..utils import log, sn_setting
 
 
 ### ---------------------------------------------------------------------------
@@ -24,7 +27,18 @@ class Connection():
 
     Each connection contains its own internal queue for messages it has been
     asked to send or that it has received, which it will handle automatically
-    based on being called by the underlying network code.
+    based on being called by the underlying network code. The send queue is
+    bounded; see SendQueue for how messages are treated when it backs up, and
+    for how the logical streams on the connection take turns.
+
+    Once the remote end says that it can put them back together, messages
+    that are larger than the fragment size are sent in pieces, so that a
+    large message doesn't hold up the messages on the other streams.
+
+    Nothing but our Introduction is sent until the remote end has introduced
+    itself and the manager has decided to keep the connection (see open()),
+    so that a redundant connection to a host can be closed before anything
+    else goes over it.
     """
     def __init__(self, mgr, socket, ip, port, callback, accepted=False):
         """
@@ -33,7 +47,10 @@ class Connection():
         onto the connection.
         """
         self.manager = mgr
-        self.send_queue = queue.Queue()
+        self.send_queue = SendQueue(sn_setting('send_queue_high_water'),
+                                    sn_setting('send_queue_low_water'),
+                                    sn_setting('send_queue_limit'))
+        self.send_queue.hold({IntroductionMessage.msg_id()})
         # TODO: As currently implemented, the receive queue is not needed as we
         #       are using an event scheme that allows for more than one thing
         #       to register, so we need to trigger those per message instead of
@@ -51,9 +68,32 @@ class Connection():
         self.socket = socket
         self.connected = False
 
-        self.send_data = None
-        self.receive_data = bytearray()
-        self.expected_length = None
+        # True if the remote end connected to us, False if we connected to it.
+        self.accepted = accepted
+
+        # The selector events that the network thread currently has us
+        # registered for; only the network thread touches this.
+        self.selected_events = 0
+
+        self.reader = FrameReader(max_frame=sn_setting('max_frame_size'))
+        self.writer = FrameWriter()
+        self.assembler = FrameAssembler(max_frame=sn_setting('max_frame_size'))
+
+        # The size of the pieces that large messages are sent in, or 0 if the
+        # remote end can't put them back together (or hasn't told us yet).
+        self.fragment_size = 0
+
+        # Everything sent and received passes through these, so that messages
+        # can be compressed once the remote end says it can handle it.
+        self.compressor = FrameCompressor(sn_setting('compression_threshold'),
+                                          sn_setting('compression_dictionary'))
+        self.decompressor = FrameDecompressor(sn_setting('max_frame_size'))
+
+        # The Introduction the remote end sent us, once we have it.
+        self.introduction = None
+
+        # Heartbeat state and round trip times for this connection.
+        self.link = LinkStats()
 
         self.callback = callback
 
@@ -86,8 +126,82 @@ class Connection():
         """
         Queue the provided protocol message up for sending to the other end of
         the connection. It will be sent at the next available opportunity.
+
+        Messages are always encoded in the network thread; when called from
+        any other thread, the message is handed off to be encoded there and
+        should not be modified after it has been handed over.
         """
-        self.send_queue.put(protocolMsgInstance.encode())
+        if not self.manager._on_network_thread():
+            return self.manager._defer(self.send, protocolMsgInstance)
+
+        if not self.accepts(protocolMsgInstance.msg_id()):
+            return
+
+        self.send_encoded(protocolMsgInstance.encode(),
+                          protocolMsgInstance.delivery_policy,
+                          protocolMsgInstance.msg_id(),
+                          protocolMsgInstance.stream)
+
+    def send_encoded(self, data, policy=DeliveryPolicy.CONTROL, msg_id=None,
+                     stream=Stream.CONTROL, fragments=None):
+        """
+        Queue up an already encoded protocol message for sending to the other
+        end of the connection; this is the result of calling encode() on a
+        message, and should be immutable since the same data may be queued
+        up for sending on more than one connection at once.
+
+        The policy and message id control how the message is treated if the
+        send queue is backed up, and the stream is the one it is sent on; they
+        should be the delivery_policy, msg_id() and stream of the message that
+        was encoded.
+
+        Messages larger than the remote end has said it will accept are not
+        sent.
+
+        A message larger than the fragment size of the connection is split
+        into Fragments. When the same data is being sent to several
+        connections, the caller can pass the same (initially empty) fragments
+        dictionary for all of them; the fragments are then only made once for
+        each fragment size and shared between the connections.
+        """
+        if not self.fits(len(data)):
+            log("Message too large for {}:{} ({} bytes); not sending",
+                self.ip, self.port, len(data))
+            return
+
+        if (self.fragment_size and not isinstance(data, FileFrame) and
+                len(data) > self.fragment_size):
+            pieces = fragments.get(self.fragment_size) if fragments is not None else None
+            if pieces is None:
+                pieces = FragmentMessage.split(data, stream, self.fragment_size)
+                if fragments is not None:
+                    fragments[self.fragment_size] = pieces
+
+            data = pieces
+
+        congested = self.send_queue.congested
+        overflowed = self.send_queue.overflowed
+        if not self.send_queue.put(data, policy, msg_id, stream):
+            # A remote end that lets the queue overflow has stopped reading
+            # from us, so the connection is closed rather than letting the
+            # backlog grow without bound; reconnecting starts it afresh.
+            if self.send_queue.overflowed:
+                if not overflowed:
+                    log("Send queue overflowed; closing connection: {}:{}",
+                        self.ip, self.port)
+                    self.manager._defer(self.close)
+
+            elif not congested:
+                log("Send queue congested; dropping messages: {}:{}",
+                    self.ip, self.port)
+            return
+
+        # Make sure that the network thread is watching for us to become
+        # writable. From any other thread this has to be done every time,
+        # since the network thread may be in the middle of deciding that we
+        # have nothing to send; a wakeup that's already pending is not sent
+        # again, and in the network thread this is just a comparison.
+        self.manager._interest_changed(self)
 
     # TODO: This is currently not needed because our receive queue is always
     #       empty; see the note in the constructor.
@@ -101,6 +215,81 @@ class Connection():
         except queue.Empty:
             return None
 
+    def introduced(self, msg):
+        """
+        Called in the network thread when the remote end sends us its
+        Introduction, which tells us who it is and what it's capable of.
+        """
+        self.introduction = msg
+        self.hostname = msg.hostname
+
+        if sn_setting('compression'):
+            self.compressor.negotiate(msg.features)
+
+        if msg.features & IntroductionMessage.FEATURE_FRAGMENTS:
+            # The first piece of a message always carries its whole header.
+            self.fragment_size = max(sn_setting('fragment_size'), 1024)
+
+    def open(self):
+        """
+        Called in the network thread once the remote end has introduced itself
+        and this connection is going to be kept, to start sending everything
+        that has been queued up for it in the meantime.
+        """
+        self.send_queue.release()
+        self.manager._interest_changed(self)
+
+    def accepts(self, msg_id):
+        """
+        Returns True if the remote end wants to be sent messages with the given
+        id. Until it has introduced itself, we assume that it does.
+        """
+        return self.introduction is None or self.introduction.subscribes(msg_id)
+
+    def fits(self, size):
+        """
+        Returns True if a frame of the given size (including its length prefix)
+        is small enough for the remote end to accept.
+        """
+        if self.introduction is None or not self.introduction.max_frame:
+            return True
+
+        return size - ProtocolMessage._size_width <= self.introduction.max_frame
+
+    def compression_stats(self):
+        """
+        Return a dictionary with the number of bytes of messages that have
+        been sent on this connection, and how many bytes they took up on the
+        wire after compression.
+        """
+        return {
+            "raw_bytes": self.compressor.raw_bytes,
+            "wire_bytes": self.compressor.wire_bytes
+        }
+
+    def link_stats(self):
+        """
+        Return a dictionary of statistics on the health of this connection,
+        including the round trip time and the estimated offset of the clock on
+        the remote host; see LinkStats.
+        """
+        return self.link.stats()
+
+    def queued_bytes(self):
+        """
+        Return the number of bytes that have been queued up for sending on
+        this connection but which have not been sent yet.
+        """
+        return self.send_queue.size + self.writer.size
+
+    def queue_stats(self):
+        """
+        Return a dictionary of statistics on the state of the send queue for
+        this connection, including its depth and how many messages have been
+        dropped or superseded.
+        """
+        return self.send_queue.stats()
+
     # TODO: Should we defer closing into all queued messages have been
     #       transmitted out, and reject any addition outgoing messages during
     #       the close grace period?
@@ -131,8 +320,9 @@ class Connection():
     def _raise(self, event, extra=None):
         """
         If there is a registered listener, trigger a callback to let the other
-        end know that there is a change in state. The callback is triggered in
-        the main thread in Sublime.
+        end know that there is a change in state. The callback is invoked in
+        whatever thread raises the event; the manager queues events up and
+        delivers them to handlers in the main thread in Sublime.
 
         Events get invoked with the connection that is raising the event, the
         event itself and some optional extra data (which differs based on the
@@ -143,7 +333,7 @@ class Connection():
         triggered from there.
         """
         if self.callback:
-            sublime.set_timeout(lambda: self.callback(self, event, extra))
+            self.callback(self, event, extra)
         else:
             # This should not be seen unless there's a programmer error.
             log('Unhandled Event: {} {} {}', event, extra, self)
@@ -153,27 +343,44 @@ class Connection():
         Returns True if this connection is write-able; that is, that it has
         something to write.
 
-        This returns True if the input queue has items in it or if we are
-        currently sending a message and didn't send it all in one shot.
+        This returns True if the output queue has items ready to send in it or
+        if we have gathered data to send that has not been completely sent yet.
 
         The network thread uses this to know if this connection cares to know
         if it is write-able or not.
         """
         if self.socket:
             return (not self.connected or
-                    self.send_queue.qsize() > 0 or
-                    self.send_data is not None)
+                    self.send_queue.ready() or
+                    self.writer.pending())
 
         return False
 
+    def _interest(self):
+        """
+        Returns the selector events that this connection currently cares
+        about; we want to read once we're connected, and want to write while
+        the connection is pending or we have something to send.
+        """
+        if not self.socket:
+            return 0
+
+        events = selectors.EVENT_READ if self.connected else 0
+        if self._is_writeable():
+            events |= selectors.EVENT_WRITE
+
+        return events
+
     def _send(self):
         """
         Called by the network thread in response to a select() call if this
         connection selected as write-able.
 
-        This tries to send as many messages from the outgoing queue as possible
-        with a sanity check to ensure that another thread can't starve other
-        connection I/O by pumping messages into our queue while we're sending.
+        This tries to send as many messages from the outgoing queue as possible,
+        gathering them up so that many frames go out in a single system call.
+        The amount sent is capped at the writer's byte budget to ensure that
+        another thread can't starve other connection I/O by pumping messages
+        into our queue while we're sending.
         """
         # Since sends happen after receives, it's possible that the connection
         # broke during the receive, in which case we should do nothing here.
@@ -185,25 +392,24 @@ class Connection():
             if code == 0:
                 self.connected = True
                 self._raise(NetworkEvent.CONNECTED)
+                self.manager._connected(self)
             else:
                 self._raise(NetworkEvent.CONNECTION_FAILED)
                 return self.close()
 
         try:
-            for _ in range(10):
-                if self.send_data is None:
-                    self.send_data = self.send_queue.get_nowait()
-
-                sent = self.socket.send(self.send_data)
-                # sent = self.socket.send(self.send_data[:1])
-                self.send_data = self.send_data[sent:]
-                if not self.send_data:
-                    self.send_data = None
-                else:
+            sent = 0
+            while sent < self.writer.budget:
+                self.writer.fill(self.send_queue, self.compressor.process)
+                if not self.writer.pending():
                     break
 
-        except queue.Empty:
-            pass
+                sent += self.writer.write(self.socket)
+
+                # If the socket didn't take everything, its buffer is full and
+                # trying again right away would just block.
+                if self.writer.blocked:
+                    break
 
         except BlockingIOError:
             pass
@@ -212,7 +418,12 @@ class Connection():
             self._raise(NetworkEvent.SEND_ERROR, str(e))
             log("Send Error: {}:{}: {}",
                 self.ip, self.port, e)
-            self.close()
+            return self.close()
+
+        # Once the connection completes or we run out of things to send, what
+        # we want from the selector changes.
+        if self._interest() != self.selected_events:
+            self.manager._interest_changed(self)
 
     # TODO: This is currently triggering notifications for each incoming
     #       message instead of queuing them up; see the constructor for
@@ -224,40 +435,24 @@ class Connection():
 
         This reads as many incoming messages as possible from the socket and
         queues them up, raising a notification to tell the handler that a new
-        message has been received.
+        message has been received. Reading continues until the socket has
+        nothing more for us or the reader's byte budget runs out, so that a
+        single busy connection can't starve the others.
         """
         try:
-            new_data = self.socket.recv(4096)
-            if not new_data:
-                return self.close()
-
-            self.receive_data.extend(new_data)
-
-            while True:
-                if self.expected_length is None:
-                    if len(self.receive_data) >= 4:
-                        self.expected_length, = struct.unpack_from(">I", self.receive_data)
-                        self.receive_data = self.receive_data[4:]
-                    else:
-                        break
-
-                if len(self.receive_data) >= self.expected_length:
-                    msg_data = self.receive_data[:self.expected_length]
-                    self.receive_data = self.receive_data[self.expected_length:]
-                    self.expected_length = None
-
-                    # TODO: In order to facilitate our new event model and the
-                    #       notion that more than one listener might want the
-                    #       message, don't put received messages in the queue.
-                    #
-                    #       We probably don't need this any more if we decide
-                    #       we like/need this model and not the standard single
-                    #       handler we previously used.
-                    new_msg = ProtocolMessage.from_data(msg_data)
-                    # self.recv_queue.put(ProtocolMessage.from_data(msg_data))
-                    self._raise(NetworkEvent.MESSAGE, new_msg)
-
-                else:
+            received = 0
+            while received < self.reader.budget:
+                count = self.reader.receive(self.socket)
+                if not count:
+                    return self.close()
+
+                received += count
+                self.link.received()
+                self._dispatch()
+
+                # Handling a message may have closed the connection, and if
+                # the read came up short there's probably nothing left.
+                if self.socket is None or self.reader.drained:
                     break
 
         except BlockingIOError:
@@ -269,5 +464,35 @@ class Connection():
                 self.ip, self.port, e)
             self.close()
 
+    def _dispatch(self):
+        """
+        Decode all of the complete messages that the reader is holding and
+        hand them off to be handled.
+        """
+        for msg_data in self.reader.frames():
+            # TODO: In order to facilitate our new event model and the
+            #       notion that more than one listener might want the
+            #       message, don't put received messages in the queue.
+            #
+            #       We probably don't need this any more if we decide
+            #       we like/need this model and not the standard single
+            #       handler we previously used.
+            new_msg = ProtocolMessage.from_data(self.decompressor.process(msg_data))
+            # self.recv_queue.put(ProtocolMessage.from_data(msg_data))
+
+            # The pieces of a large message are held until the last one
+            # arrives, and then it's handled as if it had arrived whole.
+            if isinstance(new_msg, FragmentMessage):
+                frame = self.assembler.add(new_msg)
+                if frame is None:
+                    continue
+
+                new_msg = ProtocolMessage.from_data(frame, True)
+
+            # Some messages are part of a protocol that is handled entirely
+            # within the network thread, and are not raised as events.
+            if not self.manager._intercept(self, new_msg):
+                self._raise(NetworkEvent.MESSAGE, new_msg)
+
 
 ### ---------------------------------------------------------------------------
@@ -0,0 +1,346 @@
+import hashlib
+
+from collections import OrderedDict, deque
+from threading import Lock
+
+from .events import NetworkEvent
+from .messages import ClipboardMessage, ClipboardHistoryMessage, HistoryRequestMessage
+from .messages import ContentOfferMessage, ContentRequestMessage
+from ..utils import log, sn_setting
+
+from Default.paste_from_history import g_clipboard_history
+
+
+### ---------------------------------------------------------------------------
+
+
+class ContentCache():
+    """
+    A cache of clipboard text that this process has sent or received, keyed by
+    a digest of the content. This is what lets us offer content to a remote
+    host by digest and know which offers we already have the content for.
+
+    The cache is bounded by the total size (in bytes) of the encoded text it
+    holds, and evicts the least recently used entries once it goes over that;
+    text larger than the whole cache is never held at all.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    @staticmethod
+    def digest(data):
+        """
+        Return the digest that identifies the provided encoded content.
+        """
+        return hashlib.sha1(data).digest()
+
+    def add(self, text):
+        """
+        Add the provided text to the cache, returning a (digest, size, new)
+        tuple; new is False if the text was already in the cache.
+        """
+        data = text.encode('utf-8')
+        digest = self.digest(data)
+        size = len(data)
+
+        with self.lock:
+            if digest in self.entries:
+                self.entries.move_to_end(digest)
+                return digest, size, False
+
+            if size <= self.max_size:
+                self.entries[digest] = (text, size)
+                self.size += size
+
+                while self.size > self.max_size:
+                    _, (_, old_size) = self.entries.popitem(last=False)
+                    self.size -= old_size
+                    self.evicted += 1
+
+        return digest, size, True
+
+    def get(self, digest):
+        """
+        Return the text with the given digest, or None if it's not in the
+        cache.
+        """
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(digest)
+            self.hits += 1
+            return entry[0]
+
+    def holds(self, size):
+        """
+        Returns True if text of the given size can be held in the cache.
+        """
+        return size <= self.max_size
+
+    def stats(self):
+        """
+        Return a dictionary of statistics on the current state of the cache,
+        for monitoring purposes.
+        """
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evicted": self.evicted
+            }
+
+
+### ---------------------------------------------------------------------------
+
+
+class HistoryLog():
+    """
+    A log of the entries in our clipboard history, each of which is given a
+    sequence number that increases monotonically as entries are added. This
+    lets a remote host that has synced with us before ask for only the entries
+    that were added since the last time.
+
+    We also remember the last sequence number that we received from each
+    remote host, by the instance id from its Introduction.
+    """
+    # How many entries the log keeps; hosts that are further behind than this
+    # just get everything that's left.
+    max_entries = 1024
+
+    def __init__(self):
+        self.sequence = 0
+        self.entries = deque()
+        self.known = dict()
+
+        self.remote = dict()
+
+    def update(self, history):
+        """
+        Bring the log up to date with the provided list of clipboard history
+        text, which is ordered from newest to oldest; any entries that aren't
+        already in the log are added to it.
+        """
+        for text in reversed(history):
+            if text in self.known:
+                continue
+
+            self.sequence += 1
+            self.entries.append((self.sequence, text))
+            self.known[text] = self.sequence
+
+            if len(self.entries) > self.max_entries:
+                sequence, text = self.entries.popleft()
+                if self.known.get(text) == sequence:
+                    del self.known[text]
+
+    def since(self, sequence):
+        """
+        Return the list of text for all entries added after the given sequence
+        number, from oldest to newest.
+        """
+        return [text for entry_seq, text in self.entries if entry_seq > sequence]
+
+    def last_seen(self, instance_id):
+        """
+        Return the last sequence number received from the remote instance with
+        the given id, or 0 if we have never synced with it.
+        """
+        return self.remote.get(instance_id, 0)
+
+    def seen(self, instance_id, sequence):
+        """
+        Record the last sequence number received from the remote instance with
+        the given id.
+        """
+        if instance_id:
+            self.remote[instance_id] = max(sequence, self.last_seen(instance_id))
+
+
+### ---------------------------------------------------------------------------
+
+
+class ContentExchange():
+    """
+    This class stops clipboard text from being sent to hosts that already have
+    it. Rather than sending clipboard history (or large clipboard updates)
+    outright, we send a ContentOffer that lists the digest of each piece of
+    text; the remote end checks its cache and sends back a ContentRequest for
+    only the ones it doesn't have, which we then send as usual.
+
+    Every clipboard message that arrives is added to the cache on the way in,
+    and flagged as a duplicate if it was already there, so that the same text
+    doesn't get pushed into the paste history over and over.
+
+    Every clipboard update we send is numbered with a generation, which
+    clipboard offers carry; a request for an offer that has since been
+    followed by a newer clipboard update is ignored, so that the older text
+    can't arrive after the newer one and replace it.
+
+    Clipboard history is only synced when the remote end asks for it with a
+    HistoryRequest, which it sends after the Introduction exchange if it wants
+    our history; it is offered only the entries in our HistoryLog that were
+    added since the last time it synced with us.
+
+    Everything here runs in the network thread.
+    """
+    def __init__(self, manager):
+        self.manager = manager
+        self.cache = ContentCache(sn_setting('content_cache_size'))
+        self.history = HistoryLog()
+        self.generation = 0
+
+        manager._add_protocol_handler(HistoryRequestMessage, self.history_requested)
+        manager._add_protocol_handler(ContentOfferMessage, self.offer_received)
+        manager._add_protocol_handler(ContentRequestMessage, self.request_received)
+        manager._add_protocol_handler(ClipboardMessage, self.content_received)
+        manager._add_protocol_handler(ClipboardHistoryMessage, self.history_received)
+
+    def outgoing(self, msg):
+        """
+        Given a message that is about to be broadcast, return the message that
+        should be sent in its place; large clipboard updates are replaced with
+        an offer of their content.
+        """
+        if msg.msg_id() != ClipboardMessage.msg_id():
+            return msg
+
+        self.generation = (self.generation + 1) & 0xFFFFFFFF
+
+        digest, size, _ = self.cache.add(msg.text)
+        if size < sn_setting('content_offer_threshold') or not self.cache.holds(size):
+            return msg
+
+        return ContentOfferMessage(ContentOfferMessage.KIND_CLIPBOARD, [(digest, size)],
+                                   self.generation)
+
+    def request_history(self, connection):
+        """
+        Ask the remote end of the connection for the clipboard history it has
+        added since we last synced with it; this is invoked once it has sent
+        us its Introduction. Nothing is asked for if we don't sync history.
+        """
+        if not sn_setting('sync_paste_history'):
+            return
+
+        instance_id = connection.introduction.instance_id
+        connection.send(HistoryRequestMessage(self.history.last_seen(instance_id)))
+
+    def history_requested(self, connection, msg):
+        """
+        Offer the remote end the entries of our clipboard history that were
+        added after the sequence number it asked for. If we don't sync history
+        it's offered nothing, at the sequence number it asked for, so that it
+        isn't left waiting and doesn't skip anything if we start to later.
+        """
+        if not connection.accepts(ClipboardHistoryMessage.msg_id()):
+            return
+
+        if not sn_setting('sync_paste_history'):
+            return connection.send(ContentOfferMessage(ContentOfferMessage.KIND_HISTORY,
+                                                       [], msg.sequence))
+
+        self.history.update([entry[1] for entry in g_clipboard_history.get()])
+
+        entries = list()
+        for text in self.history.since(msg.sequence):
+            digest, size, _ = self.cache.add(text)
+            if self.cache.holds(size):
+                entries.append((digest, size))
+
+        connection.send(ContentOfferMessage(ContentOfferMessage.KIND_HISTORY, entries,
+                                            self.history.sequence))
+        log("Offered {} clipboard history entries to {}", len(entries), connection.hostname)
+
+    def offer_received(self, connection, msg):
+        """
+        Handle content being offered to us by requesting whatever we don't
+        already have. Offered clipboard content that we do have is used as if
+        it had been sent, since the remote end still wants it on our clipboard.
+        """
+        if msg.kind == ContentOfferMessage.KIND_HISTORY and not sn_setting('sync_paste_history'):
+            return
+
+        missing = list()
+        for digest, _ in msg.entries:
+            text = self.cache.get(digest)
+            if text is None:
+                missing.append(digest)
+
+            elif msg.kind == ContentOfferMessage.KIND_CLIPBOARD:
+                content = ClipboardMessage(text)
+                content.duplicate = True
+                connection._raise(NetworkEvent.MESSAGE, content)
+
+        if missing:
+            connection.send(ContentRequestMessage(msg.kind, missing, msg.sequence))
+
+        elif msg.kind == ContentOfferMessage.KIND_HISTORY:
+            self._history_synced(connection, msg.sequence)
+            log("Clipboard history from {} is up to date ({} entries offered)",
+                connection.hostname, len(msg.entries))
+
+    def request_received(self, connection, msg):
+        """
+        Send the remote end the content it asked for; anything that has been
+        evicted from the cache since it was offered is skipped, as is
+        clipboard content that we've sent a newer clipboard update since.
+        Clipboard history goes out as a single batch.
+        """
+        if (msg.kind == ContentOfferMessage.KIND_CLIPBOARD and
+                msg.sequence != self.generation):
+            return
+
+        texts = [text for text in map(self.cache.get, msg.digests) if text is not None]
+
+        if msg.kind == ContentOfferMessage.KIND_CLIPBOARD:
+            for text in texts:
+                connection.send(ClipboardMessage(text))
+        else:
+            connection.send(ClipboardHistoryMessage(msg.sequence, texts))
+
+    def content_received(self, connection, msg):
+        """
+        Add incoming clipboard text to the cache, flagging it if we've seen it
+        before, then pass the message on as usual.
+        """
+        _, _, new = self.cache.add(msg.text)
+        msg.duplicate = not new
+
+        connection._raise(NetworkEvent.MESSAGE, msg)
+
+    def history_received(self, connection, msg):
+        """
+        Add incoming clipboard history to the cache, flagging the entries that
+        we've seen before, and note how far we've synced with the remote end
+        before passing the message on as usual.
+        """
+        msg.duplicates = [not self.cache.add(text)[2] for text in msg.entries]
+        self._history_synced(connection, msg.sequence)
+
+        connection._raise(NetworkEvent.MESSAGE, msg)
+
+    def _history_synced(self, connection, sequence):
+        """
+        Record that we have the clipboard history of the remote end of the
+        connection up to the given sequence number.
+        """
+        if connection.introduction is not None:
+            self.history.seen(connection.introduction.instance_id, sequence)
+
+        self.manager._history_synced(connection)
+
+
+### ---------------------------------------------------------------------------
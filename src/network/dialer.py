@@ -0,0 +1,141 @@
+import random
+
+from collections import deque
+from timeit import default_timer as timer
+
+from ..utils import log, sn_setting
+
+
+### ---------------------------------------------------------------------------
+
+
+class ConnectScheduler():
+    """
+    This class paces the outgoing connections that we make to the hosts we
+    find out about through discovery, peer lists, the peer directory and so
+    on, so that when a whole network of hosts finds each other at once (such
+    as when the network comes back after an outage) they don't all dial each
+    other in the same instant and overflow each other's accept backlog.
+
+    Every connection is started after a random delay, and only a limited
+    number of connections are allowed to be in the middle of connecting at
+    once; the rest wait their turn. A host that we fail to connect to is not
+    tried again until a backoff delay has passed, which doubles with every
+    failure in a row.
+
+    Everything here runs in the network thread.
+    """
+    # The backoff delay (in seconds) after the first failure to connect to a
+    # host, and how long the backoff can grow to.
+    backoff_delay = 1.0
+    max_backoff_delay = 60.0
+
+    def __init__(self, manager):
+        self.manager = manager
+
+        # Maps the (ip, port) of hosts we're going to connect to onto the
+        # timer that starts the connection, or None if it's waiting for an
+        # in flight connection to finish.
+        self.requests = dict()
+        self.waiting = deque()
+
+        # Maps connections that are in the middle of connecting onto the
+        # (ip, port) they're connecting to.
+        self.in_flight = dict()
+
+        # Maps the (ip, port) of hosts that we failed to connect to onto how
+        # many times in a row that has happened and when to next try.
+        self.failures = dict()
+
+    def request(self, ip, port, hostname=None, jitter=True):
+        """
+        Arrange to connect to the host at the provided ip and port, which is
+        known by the given hostname if one is provided. This does nothing if
+        we're already going to connect to that host.
+
+        The random delay can be skipped for connections that are not made in
+        response to something that other hosts also see at the same time.
+        """
+        key = (ip, port)
+        if key in self.requests or key in self.in_flight.values():
+            return
+
+        delay = random.uniform(0, sn_setting('connect_jitter')) if jitter else 0
+        failure = self.failures.get(key)
+        if failure is not None:
+            delay += max(0, failure[1] - timer())
+
+        self.requests[key] = self.manager._call_later(delay, self._ready, key, hostname)
+
+    def pending(self):
+        """
+        Return the number of connections that we're going to make but which
+        have not been started yet.
+        """
+        return len(self.requests)
+
+    def connected(self, connection):
+        """
+        Called when the provided connection has connected, to let the next
+        waiting connection start.
+        """
+        key = self._finished(connection)
+        if key is not None:
+            self.failures.pop(key, None)
+
+    def closed(self, connection):
+        """
+        Called when the provided connection has been closed; if it never
+        managed to connect, the host it was connecting to is backed off.
+        """
+        key = self._finished(connection)
+        if key is None:
+            return
+
+        count = self.failures.get(key, (0, 0))[0] + 1
+        delay = min(self.backoff_delay * 2 ** (count - 1), self.max_backoff_delay)
+        self.failures[key] = (count, timer() + delay)
+
+        log("Unable to connect to {}:{}; backing off for {:.0f}s", key[0], key[1], delay)
+
+    def _ready(self, key, hostname):
+        """
+        Start the connection to the host with the provided (ip, port), once
+        its delay has passed, or queue it if too many connections are already
+        in flight.
+        """
+        if len(self.in_flight) >= sn_setting('max_pending_connects'):
+            self.requests[key] = None
+            self.waiting.append((key, hostname))
+        else:
+            self._start(key, hostname)
+
+    def _start(self, key, hostname):
+        """
+        Start the connection to the host with the provided (ip, port), unless
+        we have been connected to it in the meantime.
+        """
+        del self.requests[key]
+        if self.manager.find_connection(*key):
+            return
+
+        connection = self.manager.net_thread.dial(key[0], key[1], hostname)
+        self.in_flight[connection] = key
+
+    def _finished(self, connection):
+        """
+        Stop tracking the provided connection as in flight, starting as many
+        waiting connections as there is now room for; returns the (ip, port)
+        it was connecting to, or None if it was not in flight.
+        """
+        key = self.in_flight.pop(connection, None)
+        if key is None:
+            return None
+
+        while self.waiting and len(self.in_flight) < sn_setting('max_pending_connects'):
+            self._start(*self.waiting.popleft())
+
+        return key
+
+
+### ---------------------------------------------------------------------------
@@ -0,0 +1,194 @@
+import sublime
+
+import json
+import os
+import time
+
+from ..utils import log, sn_setting
+
+
+### ---------------------------------------------------------------------------
+
+
+class PeerDirectory():
+    """
+    This class remembers the hosts that we have been connected to, storing
+    them in a small file in our area of the Sublime cache directory, so that
+    when we start up we can connect to them right away instead of waiting for
+    discovery to find them again.
+
+    Hosts are keyed by the ip and port that they listen on, since their
+    instance id changes every time they restart. Hosts that we have not seen
+    for longer than the configured expiry time, or that we failed to reach
+    several times in a row, are forgotten.
+
+    Everything here runs in the network thread, except for loading and the
+    final save at shutdown, which happen while it is not running.
+    """
+    # How many times in a row a host can be unreachable at startup before we
+    # forget about it.
+    max_failures = 3
+
+    # How long (in seconds) to wait after a change before saving, so that a
+    # burst of connections only causes one write.
+    save_delay = 2.0
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.peers = dict()
+        self.save_timer = None
+
+    def path(self):
+        """
+        Return the path of the file that the directory is stored in.
+        """
+        return os.path.join(sublime.cache_path(), "SubliNet", "peers.json")
+
+    def load(self):
+        """
+        Load the directory from disk, dropping any hosts that have expired.
+        """
+        try:
+            with open(self.path(), "r") as handle:
+                content = json.load(handle)
+
+        except FileNotFoundError:
+            return
+
+        except (OSError, ValueError) as e:
+            log("Unable to load the peer directory: {}", e)
+            return
+
+        # The file may have been edited by hand or only partly written, so
+        # anything that doesn't look the way we wrote it is skipped.
+        entries = content.get("peers") if isinstance(content, dict) else None
+        if not isinstance(entries, list):
+            log("Unable to load the peer directory: no list of peers")
+            return
+
+        expiry = time.time() - sn_setting('peer_expiry')
+        for entry in entries:
+            if not self._valid(entry):
+                log("Ignoring invalid peer directory entry: {}", entry)
+                continue
+
+            if entry["last_seen"] >= expiry:
+                self.peers[(entry["ip"], entry["port"])] = entry
+
+    def save(self):
+        """
+        Write the directory out to disk.
+        """
+        path = self.path()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "w") as handle:
+                json.dump({"version": 1, "peers": list(self.peers.values())}, handle, indent=4)
+
+            os.replace(path + ".tmp", path)
+
+        except OSError as e:
+            log("Unable to save the peer directory: {}", e)
+
+    def dial_all(self):
+        """
+        Connect to all of the hosts in the directory that we're not already
+        connected to (or as many as the overlay wants); this is done at
+        startup. Hosts that we haven't heard
+        from once the connect timeout has passed count as unreachable.
+        """
+        thread = self.manager.net_thread
+        own_address = (thread.broadcast_msg.ip, thread.broadcast_msg.port)
+
+        dialed = list()
+        for key, entry in self.peers.items():
+            if key == own_address or self.manager.find_connection(*key):
+                continue
+
+            if not self.manager.overlay.wants_neighbours():
+                break
+
+            self.manager.dialer.request(entry["ip"], entry["port"], entry.get("hostname"),
+                                        jitter=False)
+            dialed.append(key)
+
+        # Only so many connections are made at once, so allow for the time it
+        # might take to get to the last of them.
+        if dialed:
+            log("Connecting to {} known hosts", len(dialed))
+            rounds = 1 + len(dialed) // sn_setting('max_pending_connects')
+            self.manager._call_later(sn_setting('connect_timeout') * rounds + 1,
+                                     self._check_dials, dialed)
+
+    def seen(self, connection):
+        """
+        Record the host at the remote end of the provided connection, which
+        has just sent us its Introduction.
+        """
+        intro = connection.introduction
+        self.peers[(intro.ip, intro.port)] = {
+            "ip": intro.ip,
+            "port": intro.port,
+            "hostname": intro.hostname,
+            "instance_id": intro.instance_id.hex(),
+            "last_seen": time.time(),
+            "features": intro.features,
+            "subscriptions": intro.subscriptions,
+            "max_frame": intro.max_frame,
+            "failures": 0
+        }
+
+        self._schedule_save()
+
+    def _valid(self, entry):
+        """
+        Returns True if the provided entry loaded from disk has everything
+        that we need from it, of the right types; the optional fields that
+        are missing are filled in.
+        """
+        if not isinstance(entry, dict):
+            return False
+
+        ip, port, hostname = entry.get("ip"), entry.get("port"), entry.get("hostname")
+        if not (isinstance(ip, str) and isinstance(hostname, str) and
+                type(port) is int and 0 < port < 65536):
+            return False
+
+        entry.setdefault("last_seen", 0)
+        entry.setdefault("failures", 0)
+        return (type(entry["failures"]) is int and
+                isinstance(entry["last_seen"], (int, float)) and
+                not isinstance(entry["last_seen"], bool))
+
+    def _check_dials(self, dialed):
+        """
+        Count every host that we dialed at startup but which never introduced
+        itself as having failed, forgetting the ones that fail too often.
+        """
+        for key in dialed:
+            entry = self.peers.get(key)
+            if entry is None or any(conn.introduction is not None and conn.introduction.port == key[1]
+                                    for conn in self.manager.find_connection(key[0])):
+                continue
+
+            entry["failures"] += 1
+            if entry["failures"] >= self.max_failures:
+                log("Forgetting unreachable host {}:{}", *key)
+                del self.peers[key]
+
+        self._schedule_save()
+
+    def _schedule_save(self):
+        """
+        Arrange for the directory to be saved shortly, if that's not already
+        going to happen.
+        """
+        if self.save_timer is None:
+            self.save_timer = self.manager._call_later(self.save_delay, self._save_now)
+
+    def _save_now(self):
+        self.save_timer = None
+        self.save()
+
+
+### ---------------------------------------------------------------------------
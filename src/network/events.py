@@ -35,5 +35,9 @@ class NetworkEvent(Enum):
     # A message has been received from the other end of the connection.
     MESSAGE=7
 
+    # A file streamed from the other end of the connection has been received
+    # completely; the extra data is the path it was stored at.
+    FILE_RECEIVED=8
+
 
 ### ---------------------------------------------------------------------------
@@ -0,0 +1,633 @@
+import sublime
+
+import hashlib
+import os
+
+from collections import OrderedDict
+from threading import Thread
+from timeit import default_timer as timer
+
+from .events import NetworkEvent
+from .framing import FileFrame
+from .messages import FileStartMessage, FileChunkMessage, FileEndMessage
+from .messages import FileAckMessage, FileAckStatus, DeliveryPolicy
+from ..utils import log, sn_setting
+
+
+### ---------------------------------------------------------------------------
+
+
+def file_frames(path, chunk_size, transfer_id, start, digest):
+    """
+    Generate (sequence, frame) tuples that send the content of the file at the
+    given path as FileChunk messages of the given size for the provided
+    transfer, starting with the chunk numbered start.
+
+    The frames are file backed, so the content of the chunks is sent directly
+    from the file. The digest is updated with the content of every chunk that
+    is sent, which requires reading it here; that happens a chunk at a time
+    into a single reused buffer. The digest needs to already cover the chunks
+    prior to the start chunk; see hash_prefix().
+    """
+    # The frames hold a reference to this file, which keeps it open until the
+    # last of them is sent.
+    file = open(path, "rb")
+
+    with open(path, "rb") as hashed:
+        hashed.seek(start * chunk_size)
+
+        buffer = bytearray(chunk_size)
+        sequence = start
+        while True:
+            count = hashed.readinto(buffer)
+            if not count:
+                return
+
+            with memoryview(buffer) as view:
+                digest.update(view[:count])
+
+            header = FileChunkMessage.encode_header(transfer_id, sequence, count)
+            yield sequence, FileFrame(header, file, sequence * chunk_size, count)
+
+            sequence += 1
+
+
+def write_chunks(path, offset, digest):
+    """
+    A generator that writes every chunk sent to it to the file at the given
+    path, starting at the given offset; close() the generator to close the
+    file.
+
+    Anything in the file prior to the offset is kept, and anything after it is
+    discarded. Every chunk written is fed into the digest, which needs to
+    already cover the content prior to the offset; see hash_prefix().
+    """
+    with open(path, "r+b" if os.path.exists(path) else "wb") as file:
+        file.seek(offset)
+        file.truncate()
+
+        while True:
+            chunk = yield
+            file.write(chunk)
+            digest.update(chunk)
+
+
+def hash_prefix(path, length, callback, *args):
+    """
+    Compute the digest of the first length bytes of the file at the given path
+    in a background thread, since for a large file that takes long enough to
+    hold up all of the other network traffic; this is needed when a transfer
+    resumes part way through a file.
+
+    Once done, the callback is invoked with the given arguments followed by
+    either the digest or the OSError that stopped it; it is invoked in the
+    background thread, so it should hand the result off to the network
+    thread.
+    """
+    def run():
+        digest = hashlib.sha256()
+        try:
+            with open(path, "rb") as file:
+                buffer = bytearray(1048576)
+                remaining = length
+                while remaining:
+                    with memoryview(buffer) as view:
+                        count = file.readinto(view[:min(remaining, len(buffer))])
+                        if not count:
+                            break
+
+                        digest.update(view[:count])
+                        remaining -= count
+
+        except OSError as e:
+            return callback(*args, e)
+
+        callback(*args, digest)
+
+    Thread(target=run, name="SubliNet hash", daemon=True).start()
+
+
+def _transfer_path(*parts):
+    """
+    Return a path within our area of the Sublime cache directory, creating the
+    directory that contains it if needed.
+    """
+    path = os.path.join(sublime.cache_path(), "SubliNet", *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    return path
+
+
+def _safe_name(relative_name):
+    """
+    Sanitize a relative file name provided by a remote host so that it can't
+    be used to escape the directory that it is being stored in.
+    """
+    parts = relative_name.replace("\\", "/").split("/")
+    return os.path.join(*[p for p in parts if p not in ("", ".", "..")] or ["unnamed"])
+
+
+def _received_path(hostname, relative_name):
+    """
+    Return the path that a file with the given relative name received from
+    the host with the given hostname is stored at, creating the directory
+    that contains it if needed. Both names come from the remote host, so
+    they're sanitized, and OSError is raised if the result would still end
+    up outside of the directory that received files are stored in.
+    """
+    root = os.path.realpath(os.path.join(sublime.cache_path(), "SubliNet", "received"))
+    host = _safe_name(hostname).replace(os.sep, "_")
+
+    path = os.path.realpath(os.path.join(root, host, _safe_name(relative_name)))
+    if os.path.commonpath([root, path]) != root or os.path.dirname(path) == root:
+        raise OSError("refusing to store a file outside of %s" % root)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+### ---------------------------------------------------------------------------
+
+
+class OutgoingTransfer():
+    """
+    The sending side state of a streamed file transfer.
+    """
+    def __init__(self, transfer_id, connection, root_path, relative_name, chunk_size):
+        self.transfer_id = transfer_id
+        self.connection = connection
+        self.ip = connection.ip
+
+        self.root_path = root_path
+        self.relative_name = relative_name
+        self.path = os.path.join(root_path, relative_name)
+        self.size = os.path.getsize(self.path)
+        self.chunk_size = chunk_size
+
+        # The chunks are not read until the remote end tells us where to
+        # start; we know the transfer is over when the FileEnd has been sent.
+        self.chunks = None
+        self.digest = None
+        self.next_sequence = 0
+        self.ended = False
+
+        # While the part of the file prior to where the remote end wants us
+        # to resume from is being hashed, a token that identifies that run.
+        self.hashing = None
+
+        self.paused_at = None
+
+    def start_message(self):
+        return FileStartMessage(self.transfer_id, self.root_path, self.relative_name,
+                                self.size, self.chunk_size)
+
+    def pause(self):
+        """
+        Stop sending because the connection was lost; the transfer will start
+        again from the last acknowledged chunk once we have a connection to
+        the same host again.
+        """
+        if self.chunks is not None:
+            self.chunks.close()
+
+        self.connection = None
+        self.chunks = None
+        self.hashing = None
+        self.ended = False
+        self.paused_at = timer()
+
+
+class IncomingTransfer():
+    """
+    The receiving side state of a streamed file transfer; chunks are written
+    to a partial file as they arrive so that an interrupted transfer can pick
+    up where it left off.
+    """
+    def __init__(self, connection, msg):
+        self.transfer_id = msg.transfer_id
+        self.connection = connection
+        self.hostname = connection.hostname
+
+        self.relative_name = msg.relative_name
+        self.size = msg.file_size
+        self.chunk_size = msg.chunk_size
+
+        self.part_path = _transfer_path("transfers", msg.transfer_id.hex() + ".part")
+        self.writer = None
+        self.digest = None
+        self.next_sequence = 0
+
+        # While the partial file is being hashed, a token that identifies that
+        # run; see FileTransferManager.start_received().
+        self.hashing = None
+
+        self.updated_at = timer()
+
+    def resume(self, connection):
+        """
+        Work out where to resume the transfer from, keeping all of the complete
+        chunks that are already in the partial file, and return the sequence
+        number of the chunk that needs to be sent next.
+
+        If we still have the digest of the chunks that are being kept, the
+        partial file is opened for writing right away; otherwise they need to
+        be hashed, and open() called with the digest once that's done.
+        """
+        self.close()
+
+        written = os.path.getsize(self.part_path) if os.path.exists(self.part_path) else 0
+        next_sequence = written // self.chunk_size
+
+        if next_sequence == 0:
+            self.digest = hashlib.sha256()
+        elif next_sequence != self.next_sequence:
+            self.digest = None
+
+        self.connection = connection
+        self.next_sequence = next_sequence
+        self.updated_at = timer()
+
+        if self.digest is not None:
+            self.open(self.digest)
+
+        return self.next_sequence
+
+    def open(self, digest):
+        """
+        Open the partial file for writing at the chunk that is to be sent next,
+        given the digest of the chunks prior to it.
+        """
+        self.digest = digest
+        self.writer = write_chunks(self.part_path, self.next_sequence * self.chunk_size, self.digest)
+        next(self.writer)
+
+    def write(self, chunk):
+        self.writer.send(chunk)
+        self.next_sequence += 1
+        self.updated_at = timer()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def discard(self):
+        self.close()
+        try:
+            os.remove(self.part_path)
+        except OSError:
+            pass
+
+
+### ---------------------------------------------------------------------------
+
+
+class FileTransferManager():
+    """
+    This class handles streaming files between hosts as a series of chunks,
+    so that the memory used on both ends is bounded by the chunk size no
+    matter how large the file is.
+
+    A transfer starts with a FileStart message, to which the receiving end
+    responds with a FileAck telling the sender which chunk to start with. The
+    sender then streams FileChunk messages, keeping only a small window of
+    them queued on the connection at a time, and finishes with a FileEnd that
+    carries a digest of the whole file. The receiver acknowledges chunks as
+    it writes them, so if the connection drops the sender can start the
+    transfer again, and the receiver tells it to resume from the last chunk it
+    has.
+
+    Everything here runs in the network thread.
+    """
+    # How many chunks to keep queued on a connection at once
+    window_chunks = 4
+
+    # The largest chunk size that we accept for an incoming transfer.
+    max_chunk_size = 16777216
+
+    # How many chunks to receive between acknowledgements
+    ack_interval = 8
+
+    # How long (in seconds) an interrupted transfer is kept around waiting
+    # for the other end to come back.
+    resume_timeout = 300
+
+    # How often (in seconds) the network thread wakes up to check on
+    # transfers while there are any, so that paused transfers are resumed and
+    # abandoned ones are cleaned up even if nothing else is happening.
+    poll_interval = 1.0
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.outgoing = dict()
+        self.incoming = dict()
+        self.completed = OrderedDict()
+        self.poll_timer = None
+
+        manager._add_protocol_handler(FileStartMessage, self.start_received)
+        manager._add_protocol_handler(FileChunkMessage, self.chunk_received)
+        manager._add_protocol_handler(FileEndMessage, self.end_received)
+        manager._add_protocol_handler(FileAckMessage, self.ack_received)
+
+    def send_file(self, connection, root_path, relative_name, transfer_id):
+        """
+        Start streaming the given file to the remote end of the connection as
+        a transfer with the provided id.
+        """
+        transfer = OutgoingTransfer(transfer_id, connection, root_path,
+                                    relative_name, sn_setting('file_chunk_size'))
+        self.outgoing[transfer_id] = transfer
+
+        connection.send(transfer.start_message())
+
+    def pump(self):
+        """
+        Service all of the transfers we're sending; this keeps the window of
+        chunks queued on the connection for each active transfer full, pauses
+        transfers whose connection has gone away and restarts paused ones once
+        their host is connected again.
+
+        This is called by the network thread every time through its loop, and
+        wakes the loop up periodically while there are transfers.
+        """
+        if not self.outgoing and not self.incoming:
+            return
+
+        if self.poll_timer is None:
+            self.poll_timer = self.manager._call_later(self.poll_interval, self._poll)
+
+        now = timer()
+        for transfer in list(self.outgoing.values()):
+            if transfer.connection is not None and transfer.connection.socket is None:
+                transfer.pause()
+
+            if transfer.connection is None:
+                self._resume(transfer, now)
+
+            elif transfer.chunks is not None:
+                self._fill(transfer)
+
+        for transfer in list(self.incoming.values()):
+            if now - transfer.updated_at > self.resume_timeout:
+                log("Abandoning incomplete transfer of {} from {}",
+                    transfer.relative_name, transfer.hostname)
+                transfer.discard()
+                del self.incoming[transfer.transfer_id]
+
+    def _poll(self):
+        """
+        Called when the poll timer expires; the loop calls pump() after this,
+        which reschedules the timer if it's still needed.
+        """
+        self.poll_timer = None
+
+    def _resume(self, transfer, now):
+        """
+        Try to restart a paused transfer, abandoning it if its host has not
+        come back in time.
+        """
+        if now - transfer.paused_at > self.resume_timeout:
+            log("Abandoning interrupted transfer of {} to {}",
+                transfer.relative_name, transfer.ip)
+            del self.outgoing[transfer.transfer_id]
+            return
+
+        for connection in self.manager.find_connection(transfer.ip):
+            if connection.connected:
+                transfer.connection = connection
+                transfer.paused_at = None
+                connection.send(transfer.start_message())
+                return
+
+    def _fill(self, transfer):
+        """
+        Queue chunks of the transfer on its connection until the window is
+        full, sending the FileEnd once the whole file has been sent.
+        """
+        connection = transfer.connection
+        window = self.window_chunks * transfer.chunk_size
+
+        while connection.queued_bytes() < window:
+            try:
+                sequence, frame = next(transfer.chunks)
+
+            except StopIteration:
+                connection.send(FileEndMessage(transfer.transfer_id,
+                                               transfer.next_sequence,
+                                               transfer.digest.digest()))
+                transfer.chunks = None
+                transfer.ended = True
+                return
+
+            connection.send_encoded(frame, DeliveryPolicy.CONTROL, FileChunkMessage.msg_id(),
+                                    FileChunkMessage.stream)
+            transfer.next_sequence = sequence + 1
+
+    def ack_received(self, connection, msg):
+        """
+        The remote end of one of our outgoing transfers is telling us where it
+        is at; this starts the flow of chunks and finishes the transfer.
+        """
+        transfer = self.outgoing.get(msg.transfer_id)
+        if transfer is None:
+            return
+
+        if msg.status != FileAckStatus.CONTINUE:
+            del self.outgoing[msg.transfer_id]
+            if transfer.chunks is not None:
+                transfer.chunks.close()
+
+            log("{} sending {} to {}",
+                "Finished" if msg.status == FileAckStatus.COMPLETE else "Failed",
+                transfer.relative_name, connection.hostname)
+            return
+
+        # The first acknowledgement after a FileStart tells us where to start
+        # sending from; the others are just progress. When resuming part way
+        # through, the part of the file that the remote end already has is
+        # hashed first.
+        if transfer.chunks is None and not transfer.ended and transfer.hashing is None:
+            transfer.next_sequence = msg.next_sequence
+            if not msg.next_sequence:
+                return self._start_chunks(transfer, hashlib.sha256())
+
+            transfer.hashing = token = object()
+            hash_prefix(transfer.path, msg.next_sequence * transfer.chunk_size,
+                        self.manager._defer, self._prefix_hashed, transfer, token)
+
+    def _prefix_hashed(self, transfer, token, digest):
+        """
+        The part of the file of an outgoing transfer prior to where the remote
+        end wants us to resume from has been hashed; start sending the rest,
+        unless the transfer has been paused or finished in the meantime.
+        """
+        if transfer.hashing is not token or self.outgoing.get(transfer.transfer_id) is not transfer:
+            return
+
+        transfer.hashing = None
+        if isinstance(digest, OSError):
+            del self.outgoing[transfer.transfer_id]
+            log("Failed sending {} to {}: {}", transfer.relative_name, transfer.ip, digest)
+            return
+
+        self._start_chunks(transfer, digest)
+
+    def _start_chunks(self, transfer, digest):
+        """
+        Start sending the chunks of an outgoing transfer from its next
+        sequence number, given the digest of the chunks prior to it.
+        """
+        transfer.digest = digest
+        transfer.chunks = file_frames(transfer.path, transfer.chunk_size,
+                                      transfer.transfer_id, transfer.next_sequence,
+                                      transfer.digest)
+
+    def start_received(self, connection, msg):
+        """
+        The remote end is starting or resuming a transfer to us; let them know
+        what chunk to start with.
+        """
+        status = self.completed.get(msg.transfer_id)
+        if status is not None:
+            return connection.send(FileAckMessage(msg.transfer_id, 0, status))
+
+        transfer = self.incoming.get(msg.transfer_id)
+        reason = self._check_start(msg, transfer)
+        if reason is not None:
+            if transfer is not None:
+                return self._fail(connection, transfer, reason)
+
+            log("Refusing transfer of {} from {}: {}", msg.relative_name,
+                connection.hostname, reason)
+            self._remember(msg.transfer_id, FileAckStatus.FAILED)
+            return connection.send(FileAckMessage(msg.transfer_id, 0, FileAckStatus.FAILED))
+
+        if transfer is None:
+            transfer = IncomingTransfer(connection, msg)
+            self.incoming[msg.transfer_id] = transfer
+
+        try:
+            next_sequence = transfer.resume(connection)
+        except OSError as e:
+            return self._fail(connection, transfer, e)
+
+        if transfer.writer is not None:
+            return connection.send(FileAckMessage(msg.transfer_id, next_sequence))
+
+        # The chunks already in the partial file need to be hashed before we
+        # can carry on, which happens in the background.
+        transfer.hashing = token = object()
+        hash_prefix(transfer.part_path, next_sequence * transfer.chunk_size,
+                    self.manager._defer, self._partial_hashed, connection, transfer, token)
+
+    def _check_start(self, msg, transfer):
+        """
+        Check that the provided FileStart describes a transfer that we can
+        accept, returning the reason why not if it doesn't, or None if it's
+        fine. For a transfer that's resuming, nothing can have changed since
+        it started.
+        """
+        if not 0 < msg.chunk_size <= self.max_chunk_size:
+            return "invalid chunk size %d" % msg.chunk_size
+
+        # Chunks are numbered with 32 bits.
+        if (msg.file_size + msg.chunk_size - 1) // msg.chunk_size > 0xFFFFFFFF:
+            return "file of %d bytes is too large" % msg.file_size
+
+        if transfer is not None and (transfer.chunk_size != msg.chunk_size or
+                                     transfer.size != msg.file_size):
+            return "transfer changed while resuming"
+
+        return None
+
+    def _partial_hashed(self, connection, transfer, token, digest):
+        """
+        The chunks that were already in the partial file of an incoming
+        transfer have been hashed; carry on with the transfer, unless it has
+        been restarted or abandoned in the meantime.
+        """
+        if transfer.hashing is not token or self.incoming.get(transfer.transfer_id) is not transfer:
+            return
+
+        transfer.hashing = None
+        try:
+            if isinstance(digest, OSError):
+                raise digest
+
+            transfer.open(digest)
+
+        except OSError as e:
+            return self._fail(connection, transfer, e)
+
+        connection.send(FileAckMessage(transfer.transfer_id, transfer.next_sequence))
+
+    def chunk_received(self, connection, msg):
+        """
+        Write an incoming chunk to the partial file for its transfer,
+        acknowledging our progress every so often.
+        """
+        transfer = self.incoming.get(msg.transfer_id)
+        if transfer is None or transfer.writer is None:
+            return
+
+        if msg.sequence != transfer.next_sequence:
+            return self._fail(connection, transfer, "chunk %d out of sequence" % msg.sequence)
+
+        try:
+            transfer.write(msg.chunk)
+        except OSError as e:
+            return self._fail(connection, transfer, e)
+
+        if transfer.next_sequence % self.ack_interval == 0:
+            connection.send(FileAckMessage(msg.transfer_id, transfer.next_sequence))
+
+    def end_received(self, connection, msg):
+        """
+        The last chunk of a transfer has arrived; verify what we received and
+        move it into place, letting the sender know how it turned out.
+        """
+        transfer = self.incoming.get(msg.transfer_id)
+        if transfer is None or transfer.writer is None:
+            return
+
+        transfer.close()
+        if msg.chunk_count != transfer.next_sequence or msg.digest != transfer.digest.digest():
+            return self._fail(connection, transfer, "content does not match digest")
+
+        del self.incoming[msg.transfer_id]
+        self._remember(msg.transfer_id, FileAckStatus.COMPLETE)
+
+        try:
+            path = _received_path(transfer.hostname, transfer.relative_name)
+            os.replace(transfer.part_path, path)
+        except OSError as e:
+            return self._fail(connection, transfer, e)
+
+        connection.send(FileAckMessage(msg.transfer_id, transfer.next_sequence, FileAckStatus.COMPLETE))
+        connection._raise(NetworkEvent.FILE_RECEIVED, path)
+
+    def _fail(self, connection, transfer, reason):
+        """
+        Abandon an incoming transfer, letting the sender know that it failed.
+        """
+        log("Transfer of {} from {} failed: {}",
+            transfer.relative_name, transfer.hostname, reason)
+
+        transfer.discard()
+        self.incoming.pop(transfer.transfer_id, None)
+        self._remember(transfer.transfer_id, FileAckStatus.FAILED)
+
+        connection.send(FileAckMessage(transfer.transfer_id, transfer.next_sequence, FileAckStatus.FAILED))
+
+    def _remember(self, transfer_id, status):
+        """
+        Remember how the given transfer finished, so that if the sender
+        restarts it before it sees our final acknowledgement, we can tell it
+        the outcome instead of receiving it all over again.
+        """
+        self.completed[transfer_id] = status
+        while len(self.completed) > 64:
+            self.completed.popitem(last=False)
+
+
+### ---------------------------------------------------------------------------
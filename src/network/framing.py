@@ -0,0 +1,433 @@
+import mmap
+import os
+import queue
+import socket
+import struct
+
+from collections import deque
+
+
+### ---------------------------------------------------------------------------
+
+
+class FrameReader():
+    """
+    The data arriving on a connection is a stream of frames, each of which is
+    a length prefix followed by that many bytes of encoded message data.
+
+    This class accumulates the incoming stream in a single reusable buffer that
+    the socket reads directly into, tracking where the unparsed data starts
+    and ends. Complete frames are handed out as memoryview slices of that
+    buffer, so parsing a burst of frames never copies the data that follows
+    them.
+
+    Reads are sized to the frame currently being received, so a large frame
+    arrives in as few reads as possible; the buffer grows to hold the largest
+    frame seen and drops back to its initial size once it drains. A frame
+    larger than the maximum frame size (if there is one) raises ValueError
+    before any buffer space is set aside for it.
+
+    Between frames, the read size adapts to the traffic; it doubles (up to the
+    maximum) every time a read fills all of the space it was given, so a bulk
+    transfer of small frames takes few reads, and halves (down to the initial
+    size) when reads come back mostly empty.
+
+    The byte budget is how much a connection reads per wakeup before letting
+    other connections have a turn.
+    """
+    _size_width = struct.calcsize(">I")
+
+    def __init__(self, read_size=4096, idle_size=65536, max_frame=0,
+                 max_read_size=262144, budget=262144):
+        self.min_read_size = read_size
+        self.read_size = read_size
+        self.max_read_size = max_read_size
+        self.idle_size = idle_size
+        self.max_frame = max_frame
+        self.budget = budget
+
+        self.buffer = bytearray(read_size)
+        self.read_pos = 0
+        self.write_pos = 0
+
+        # True when the last read returned less than it asked for, meaning
+        # that the socket probably has nothing more waiting.
+        self.drained = False
+
+    def pending(self):
+        """
+        Return the number of bytes that have been received but which have not
+        yet been handed out as part of a frame.
+        """
+        return self.write_pos - self.read_pos
+
+    def receive(self, sock):
+        """
+        Read data from the provided socket directly into our buffer, returning
+        the number of bytes read; 0 indicates that the remote end closed the
+        connection.
+
+        This will raise BlockingIOError if the socket has no data, in which
+        case the reader is left as it was.
+        """
+        size = self._wanted()
+        self._reserve(size)
+
+        with memoryview(self.buffer) as view:
+            count = sock.recv_into(view[self.write_pos:self.write_pos + size])
+
+        self.write_pos += count
+        self.drained = count < size
+
+        if count == size:
+            self.read_size = min(self.read_size * 2, self.max_read_size)
+        elif count < size // 4:
+            self.read_size = max(self.read_size // 2, self.min_read_size)
+
+        return count
+
+    def frames(self):
+        """
+        Generate a memoryview for each complete frame currently held in the
+        buffer, not including the length prefix.
+
+        The view is only valid until the next frame is requested; anything
+        that needs the data beyond that needs to copy it out (which decoding
+        the message does).
+        """
+        while True:
+            available = self.pending()
+            if available < self._size_width:
+                break
+
+            length = self._frame_length()
+            if available < self._size_width + length:
+                break
+
+            start = self.read_pos + self._size_width
+            self.read_pos = start + length
+
+            with memoryview(self.buffer) as view, view[start:start + length] as frame:
+                yield frame
+
+        self._reset()
+
+    def _wanted(self):
+        """
+        Return how many bytes we should ask the socket for; if we know how big
+        the frame we're in the middle of is, ask for the rest of it.
+        """
+        available = self.pending()
+        if available < self._size_width:
+            return self.read_size
+
+        length = self._frame_length()
+        return max(self.read_size, self._size_width + length - available)
+
+    def _frame_length(self):
+        """
+        Return the length of the frame at the read position, which must have
+        its length prefix in the buffer, ensuring that it's not too large.
+        """
+        length, = struct.unpack_from(">I", self.buffer, self.read_pos)
+        if self.max_frame and length > self.max_frame:
+            raise ValueError('Frame of {} bytes exceeds the limit of {}'.format(
+                length, self.max_frame))
+
+        return length
+
+    def _reserve(self, size):
+        """
+        Ensure that there is room for at least size bytes past the end of the
+        received data, moving the unparsed tail of the buffer to the front
+        and growing the buffer as needed.
+        """
+        if len(self.buffer) - self.write_pos >= size:
+            return
+
+        available = self.pending()
+        if self.read_pos:
+            self.buffer[:available] = self.buffer[self.read_pos:self.write_pos]
+            self.read_pos = 0
+            self.write_pos = available
+
+        needed = available + size
+        if len(self.buffer) < needed:
+            self.buffer.extend(bytes(max(needed, len(self.buffer) * 2) - len(self.buffer)))
+
+    def _reset(self):
+        """
+        Once everything in the buffer has been handed out, rewind to the start
+        of the buffer; if it grew to hold a large frame, release that memory.
+        """
+        if self.read_pos != self.write_pos:
+            return
+
+        self.read_pos = 0
+        self.write_pos = 0
+
+        if len(self.buffer) > max(self.idle_size, self.read_size):
+            self.buffer = bytearray(self.read_size)
+
+
+### ---------------------------------------------------------------------------
+
+
+class FileFrame():
+    """
+    A frame whose body is a range of an open file rather than data in memory.
+
+    The header of the frame (the length prefix and the fields of the message
+    that precede the content) is sent from memory as usual, but the body is
+    sent straight from the file descriptor by the kernel with os.sendfile(),
+    so the content is never copied into Python at all. On platforms without
+    sendfile(), the range of the file is memory mapped and sent from a view on
+    the mapping instead.
+
+    The frame holds a reference to the file, which stays open until the frame
+    has been sent or thrown away. If the file turns out to be shorter than the
+    range (because it was truncated after the frame was made), writing the
+    frame raises EOFError, since the rest of it can never be sent.
+    """
+    _has_sendfile = hasattr(os, "sendfile")
+
+    def __init__(self, header, file, offset, count):
+        self.header = memoryview(header)
+        self.file = file
+        self.offset = offset
+        self.remaining = count
+
+    def __len__(self):
+        return len(self.header) + self.remaining
+
+    def write(self, sock):
+        """
+        Send as much of the frame as the socket will take, returning the number
+        of bytes that were sent.
+
+        This will raise BlockingIOError if the socket can't take any data.
+        """
+        sent = 0
+        try:
+            if self.header:
+                sent = sock.send(self.header)
+                self.header = self.header[sent:]
+                if self.header:
+                    return sent
+
+            if self.remaining:
+                if self._has_sendfile:
+                    count = os.sendfile(sock.fileno(), self.file.fileno(),
+                                        self.offset, self.remaining)
+                else:
+                    count = self._send_mapped(sock)
+
+                if not count:
+                    raise EOFError("file ended {} bytes short of the frame".format(
+                        self.remaining))
+
+                self.offset += count
+                self.remaining -= count
+                sent += count
+
+        except BlockingIOError:
+            if not sent:
+                raise
+
+        return sent
+
+    def _send_mapped(self, sock):
+        """
+        Fallback for platforms without sendfile(); map the rest of the range of
+        the file and send from a view on it.
+        """
+        start = self.offset - self.offset % mmap.ALLOCATIONGRANULARITY
+        with mmap.mmap(self.file.fileno(), self.offset + self.remaining - start,
+                       access=mmap.ACCESS_READ, offset=start) as mapped:
+            with memoryview(mapped) as view, view[self.offset - start:] as body:
+                return sock.send(body)
+
+
+### ---------------------------------------------------------------------------
+
+
+class FrameWriter():
+    """
+    The outgoing half of a connection; this gathers encoded frames from the
+    send queue of a connection and writes them to its socket.
+
+    Where the platform supports it, all of the gathered frames are handed to
+    the socket in a single scatter-gather sendmsg() call, so a burst of small
+    frames goes out in one system call. Partial writes are tracked by slicing
+    a memoryview of the frame that was cut short rather than copying what is
+    left of it. File backed frames (see FileFrame) are sent on their own.
+
+    The amount of data gathered at once is limited by a byte budget, which
+    the connection also uses to limit how much it sends per wakeup so that a
+    single busy connection can't starve the others.
+    """
+    # Platforms put a limit on how many buffers a single sendmsg() call can
+    # take (1024 on Linux); stay well under that.
+    max_buffers = 512
+
+    _has_sendmsg = hasattr(socket.socket, "sendmsg")
+
+    def __init__(self, budget=262144):
+        self.budget = budget
+
+        self.buffers = deque()
+        self.size = 0
+
+        # True when the last write could not send everything it tried to,
+        # meaning that the socket buffer is full.
+        self.blocked = False
+
+    def pending(self):
+        """
+        Returns True if there is gathered data that has not been sent yet.
+        """
+        return bool(self.buffers)
+
+    def fill(self, send_queue, transform=None):
+        """
+        Gather frames from the provided queue until the queue is empty or we
+        are holding a full budget worth of data.
+
+        If a transform is provided, every frame is passed through it in order
+        as it is gathered, and the frame it returns is sent instead.
+        """
+        while self.size < self.budget and len(self.buffers) < self.max_buffers:
+            try:
+                frame = send_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if not isinstance(frame, FileFrame):
+                frame = memoryview(frame)
+
+            if transform is not None:
+                frame = transform(frame)
+
+            self.buffers.append(frame)
+            self.size += len(frame)
+
+    def write(self, sock):
+        """
+        Send as much of the gathered data as the socket will take, returning
+        the number of bytes that were sent.
+
+        This will raise BlockingIOError if the socket can't take any data.
+        """
+        head = self.buffers[0]
+        if isinstance(head, FileFrame):
+            sent = head.write(sock)
+            self.blocked = len(head) > 0
+
+        elif self._has_sendmsg:
+            frames = list(self._leading_frames())
+            sent = sock.sendmsg(frames)
+            self.blocked = sent < sum(len(frame) for frame in frames)
+
+        else:
+            sent = self._write_each(sock)
+
+        self._consume(sent)
+        return sent
+
+    def _leading_frames(self):
+        """
+        Generate the in memory frames at the front of the gathered data, up to
+        the first file backed frame.
+        """
+        for frame in self.buffers:
+            if isinstance(frame, FileFrame):
+                return
+
+            yield frame
+
+    def _write_each(self, sock):
+        """
+        Fallback for platforms without sendmsg(); send the gathered frames one
+        at a time until the socket stops taking all of the data.
+        """
+        sent = 0
+        self.blocked = True
+        for frame in self._leading_frames():
+            try:
+                count = sock.send(frame)
+            except BlockingIOError:
+                if not sent:
+                    raise
+                return sent
+
+            sent += count
+            if count < len(frame):
+                return sent
+
+        self.blocked = False
+        return sent
+
+    def _consume(self, sent):
+        """
+        Discard the given number of bytes from the front of the gathered data,
+        leaving a view on the remainder of any frame only partially sent. File
+        backed frames keep track of their own progress.
+        """
+        self.size -= sent
+        while self.buffers:
+            frame = self.buffers[0]
+            if isinstance(frame, FileFrame):
+                if not len(frame):
+                    self.buffers.popleft()
+                return
+
+            if len(frame) > sent:
+                if sent:
+                    self.buffers[0] = frame[sent:]
+                return
+
+            sent -= len(frame)
+            self.buffers.popleft()
+
+
+### ---------------------------------------------------------------------------
+
+
+class FrameAssembler():
+    """
+    Large messages can arrive in pieces (see FragmentMessage), mixed in with
+    the other messages on the connection; this class puts them back together.
+
+    The pieces of a message always arrive in order on the stream that it was
+    sent on, but they can be mixed in with the pieces of messages on other
+    streams, so a message is assembled for each stream separately. A message
+    that grows larger than the maximum frame size (if there is one) raises
+    ValueError.
+    """
+    _size_width = struct.calcsize(">I")
+
+    def __init__(self, max_frame=0):
+        self.max_frame = max_frame
+        self.partial = dict()
+
+    def add(self, fragment):
+        """
+        Add the data from the provided Fragment to the message being assembled
+        on its stream; once the last piece arrives, the complete encoded
+        message (including its length prefix) is returned, otherwise None.
+        """
+        data = self.partial.setdefault(fragment.stream, bytearray())
+        data += fragment.data
+
+        if self.max_frame and len(data) > self.max_frame + self._size_width:
+            raise ValueError('Fragmented frame of {} bytes exceeds the limit of {}'.format(
+                len(data) - self._size_width, self.max_frame))
+
+        if not fragment.last:
+            return None
+
+        del self.partial[fragment.stream]
+        return data
+
+
+### ---------------------------------------------------------------------------
@@ -0,0 +1,250 @@
+import itertools
+import time
+
+from collections import deque
+from timeit import default_timer as timer
+
+from .messages import PingMessage, PongMessage
+from ..utils import log, sn_setting
+
+
+### ---------------------------------------------------------------------------
+
+
+class LinkStats():
+    """
+    This class tracks the health of a single connection; how many heartbeats
+    in a row have gone unanswered, and a rolling window of round trip times
+    and estimates of how far the clock on the remote host is from ours.
+
+    The clock offset is estimated the same way NTP does it; the remote end
+    stamps its reply with its clock, which we assume happened halfway through
+    the round trip. The sample with the shortest round trip is the one least
+    skewed by queueing, so that's the one the estimate comes from.
+
+    This belongs to the network thread.
+    """
+    # How many of the most recent samples are kept.
+    window = 64
+
+    # The upper bounds (in milliseconds) of the buckets in the round trip time
+    # histogram; anything slower lands in a final bucket of its own.
+    buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self):
+        self.samples = deque(maxlen=self.window)
+        self.missed = 0
+
+        # The token, monotonic time and wall clock time of the Ping that we're
+        # waiting on a reply to, if any.
+        self.pending = None
+
+    def sent(self, token):
+        """
+        Record that a Ping with the given token was just sent.
+        """
+        self.pending = (token, timer(), time.time())
+        self.missed += 1
+
+    def received(self):
+        """
+        Record that something arrived from the remote end, which shows that
+        it's still alive whether or not it's a reply to our Ping.
+        """
+        self.missed = 0
+
+    def replied(self, token, remote_time):
+        """
+        Record a Pong from the remote end, returning the round trip time in
+        seconds, or None if the Pong is not for our last Ping.
+        """
+        if self.pending is None or self.pending[0] != token:
+            return None
+
+        _, sent, wall_sent = self.pending
+        self.pending = None
+
+        rtt = timer() - sent
+        offset = remote_time - (wall_sent + rtt / 2.0)
+        self.samples.append((rtt, offset))
+
+        return rtt
+
+    def rtt(self):
+        """
+        Return the median round trip time (in seconds) over the window, or
+        None if there are no samples yet.
+        """
+        if not self.samples:
+            return None
+
+        times = sorted(rtt for rtt, _ in self.samples)
+        return times[len(times) // 2]
+
+    def clock_offset(self):
+        """
+        Return the estimated number of seconds that the clock on the remote
+        host is ahead of ours, or None if there are no samples yet.
+        """
+        if not self.samples:
+            return None
+
+        return min(self.samples)[1]
+
+    def histogram(self):
+        """
+        Return a list of (bound, count) tuples giving how many of the round
+        trip times in the window fell into each bucket; the bound is the upper
+        limit of the bucket in milliseconds, which is None for the last one.
+        """
+        counts = [0] * (len(self.buckets) + 1)
+        for rtt, _ in self.samples:
+            ms = rtt * 1000.0
+            counts[next((i for i, bound in enumerate(self.buckets) if ms < bound),
+                        len(self.buckets))] += 1
+
+        return list(zip(self.buckets + (None,), counts))
+
+    def stats(self):
+        """
+        Return a dictionary of statistics on the link, for diagnostics.
+        """
+        return {
+            "rtt": self.rtt(),
+            "clock_offset": self.clock_offset(),
+            "samples": len(self.samples),
+            "missed": self.missed,
+            "histogram": self.histogram()
+        }
+
+
+### ---------------------------------------------------------------------------
+
+
+class Heartbeat():
+    """
+    This class sends a Ping on every connection at a regular interval, to
+    measure round trip times and to find connections whose remote end has
+    gone away without the connection being closed, such as when the host
+    lost power or a NAT dropped the connection state.
+
+    A connection that we haven't heard anything at all from for the
+    configured number of heartbeats in a row is closed, and we try to connect
+    to the host again, backing off between attempts, until it either comes
+    back or we give up.
+
+    The heartbeat only runs while there are connections, so that an idle
+    network thread is not woken up for nothing. Everything here runs in the
+    network thread.
+    """
+    # The delay (in seconds) before the first attempt to reconnect to a host
+    # whose connection died, how long the delay between attempts can grow to,
+    # and how many attempts are made before we leave it to discovery.
+    redial_delay = 1.0
+    max_redial_delay = 60.0
+    max_redials = 6
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.tokens = itertools.count(1)
+        self.timer = None
+
+        # The number of reconnect attempts made so far, keyed by the (ip, port)
+        # that the host listens on.
+        self.redials = dict()
+
+        manager._add_protocol_handler(PingMessage, self.ping_received)
+        manager._add_protocol_handler(PongMessage, self.pong_received)
+
+    def start(self):
+        """
+        Start sending heartbeats, if they're enabled and not already running.
+        """
+        if self.timer is None and sn_setting('heartbeat_interval') > 0:
+            self.timer = self.manager._call_later(sn_setting('heartbeat_interval'), self.beat)
+
+    def ping(self, connection):
+        """
+        Send a Ping on the provided connection.
+        """
+        token = next(self.tokens) & 0xFFFFFFFF
+        connection.link.sent(token)
+        connection.send(PingMessage(token))
+
+    def beat(self):
+        """
+        Ping every connection, closing those that have missed too many
+        heartbeats in a row first.
+        """
+        self.timer = None
+
+        for connection in self.manager.registry.snapshot():
+            if not connection.connected:
+                continue
+
+            if connection.link.missed >= sn_setting('heartbeat_misses'):
+                self.evict(connection)
+            else:
+                self.ping(connection)
+
+        if len(self.manager.registry):
+            self.start()
+
+    def evict(self, connection):
+        """
+        Close the provided connection, whose remote end has stopped
+        responding, and try to connect to the host again.
+        """
+        log("No heartbeat from {}:{} ({}); closing", connection.ip, connection.port,
+            connection.hostname)
+        connection.close()
+
+        intro = connection.introduction
+        if intro is not None and (intro.ip, intro.port) not in self.redials:
+            self.redials[(intro.ip, intro.port)] = 0
+            self.manager._call_later(self.redial_delay, self.redial,
+                                     intro.ip, intro.port, intro.hostname)
+
+    def redial(self, ip, port, hostname):
+        """
+        Try to connect to a host whose connection died, unless it's already
+        back, scheduling another attempt with a longer delay in case this
+        one doesn't work out.
+        """
+        attempts = self.redials.get((ip, port))
+        if attempts is None:
+            return
+
+        # The host is back once we have a connection to it that it has
+        # introduced itself on, whichever end it was started from.
+        connections = self.manager.find_connection(ip)
+        if (attempts >= self.max_redials or
+                any(conn.introduction is not None and conn.introduction.port == port
+                    for conn in connections)):
+            del self.redials[(ip, port)]
+            return
+
+        # Leave an attempt that's still in progress alone.
+        if not any(conn.port == port for conn in connections):
+            log("Reconnecting to {}:{} ({}), attempt {}", ip, port, hostname, attempts + 1)
+            self.manager.dialer.request(ip, port, hostname)
+            self.redials[(ip, port)] = attempts + 1
+
+        delay = min(self.redial_delay * 2 ** (attempts + 1), self.max_redial_delay)
+        self.manager._call_later(delay, self.redial, ip, port, hostname)
+
+    def ping_received(self, connection, msg):
+        """
+        Reply to a Ping from the remote end.
+        """
+        connection.send(PongMessage(msg.token, time.time()))
+
+    def pong_received(self, connection, msg):
+        """
+        Record the round trip time and clock offset from a Pong sent in reply
+        to one of our Pings.
+        """
+        connection.link.replied(msg.token, msg.time)
+
+
+### ---------------------------------------------------------------------------
@@ -1,8 +1,22 @@
-import socket
-from threading import Event, Lock
+import sublime
 
-from ..utils import log
+import socket
+import uuid
+from collections import deque
+from threading import Event, Lock, current_thread
+from timeit import default_timer as timer
+
+from ..utils import log, sn_setting
+from .messages import DeliveryPolicy, Stream, IntroductionMessage, PeerListMessage
+from .events import NetworkEvent
 from .connection import Connection
+from .registry import ConnectionRegistry
+from .filetransfer import FileTransferManager
+from .content import ContentExchange
+from .directory import PeerDirectory
+from .heartbeat import Heartbeat
+from .overlay import Overlay
+from .dialer import ConnectScheduler
 from .transport import NetworkThread
 
 
@@ -19,27 +33,58 @@ class ConnectionManager():
     all public facing access to the intenals of the network code go through the
     methods in this class.
 
-    We maintain a threadsafe list of connections and have the ability for
+    We maintain a threadsafe registry of connections and have the ability for
     external code to register an interest in socket events.
+
+    Events raised by connections are collected in an inbox that is drained in
+    the main thread in batches, each limited by a time budget so that a burst
+    of traffic from a peer can't freeze the editor.
     """
     def __init__(self):
-        self.conn_lock = Lock()
-        self.connections = list()
+        self.registry = ConnectionRegistry()
         self.thr_event = Event()
         self.handlers = dict()
-        self.net_thread = NetworkThread(self, self.conn_lock, self.connections,
-                                        self.thr_event)
+        self.protocol_handlers = dict()
+
+        self.event_lock = Lock()
+        self.event_inbox = deque()
+        self.event_delivery_scheduled = False
+
+        # Identifies this instance to remote hosts; it changes every time we
+        # start, since the history log it goes with doesn't persist.
+        self.instance_id = uuid.uuid4().bytes
+
+        self.net_thread = NetworkThread(self, self.registry, self.thr_event)
+        self.transfers = FileTransferManager(self)
+        self.content = ContentExchange(self)
+        self.directory = PeerDirectory(self)
+        self.heartbeat = Heartbeat(self)
+        self.overlay = Overlay(self)
+        self.dialer = ConnectScheduler(self)
+
+        # When we started up, and how long after that (in seconds) we first
+        # finished syncing clipboard history with another host.
+        self.started_at = None
+        self.first_sync_time = None
+
+        self._add_protocol_handler(IntroductionMessage, self._introduction_received)
+        self._add_protocol_handler(PeerListMessage, self.net_thread.peer_list_received)
 
     def startup(self):
         """
         Start up the networking system. This intializes the client list and
         starts the network thread running. That will start our discovery
-        broadcasts.
+        broadcasts, and we also connect right away to the hosts we were
+        connected to the last time we ran.
 
         This must be called from plugin_loaded()
         """
         log("=> Connection Manager Initializing")
+        self.started_at = timer()
+        self.directory.load()
+
         self.net_thread.start()
+        self._defer(self.directory.dial_all)
 
     def shutdown(self):
         """
@@ -51,11 +96,13 @@ class ConnectionManager():
         """
         log("=> Connection Manager Shutting Down")
         self.thr_event.set()
+        self._wakeup()
         self.net_thread.join(0.25)
 
-        with self.conn_lock:
-            for connection in self.connections:
-                self._close_connection(connection)
+        for connection in self.registry.snapshot():
+            self._close_connection(connection)
+
+        self.directory.save()
 
     def add_handler(self, key, event, handler):
         """
@@ -82,39 +129,35 @@ class ConnectionManager():
             if key in notify_list:
                 del notify_list[key]
 
-    def find_connection(self, ip=None, port=None):
+    def find_connection(self, ip=None, port=None, hostname=None, instance_id=None):
         """
         Find and return all connections matching the provided criteria; can
-        find all connections to a ip, all connections to a port, or just all
-        connections period.
+        find all connections to a ip, all connections to a port, the
+        connections to a particular host by hostname or by the instance id
+        from its Introduction, or just all connections period.
 
         The returned list may be empty.
         """
-        retcons = list()
-        with self.conn_lock:
-            for connection in self.connections:
-                if ip is not None and ip != connection.ip:
-                    continue
-
-                if port is not None and port != connection.port:
-                    continue
-
-                retcons.append(connection)
-
-        return retcons
+        return self.registry.find(ip, port, hostname, instance_id)
 
     def connect(self, ip, port):
         """
-        Start an outgoing connection to the provided ip and port.
+        Start an outgoing connection to the provided ip and port, sending the
+        remote end our Introduction once it connects so that it knows who we
+        are.
 
         The new connection object will be returned, but it will not yet be
         connected. An event will be raised when the connection attempt finishes
         (regardless of whether it succeeded or not).
         """
-        with self.conn_lock:
-            connection = self._open_connection(ip, port)
-            self.connections.append(connection)
-
+        connection = self._open_connection(ip, port)
+        self.registry.add(connection)
+        connection.send(self.net_thread.broadcast_msg)
+
+        self._interest_changed(connection)
+        self._defer(self.net_thread.watch_connect, connection)
+        self._defer(self.heartbeat.start)
+        self.net_thread.peers_changed()
         return connection
 
     def broadcast(self, protocolMsgInstance):
@@ -123,12 +166,275 @@ class ConnectionManager():
         connections. This silently does nothing if there are not any
         connection.
 
-        This is a convenience method for using find_connections() to find every
-        connection and calling their send() methods in turn.
+        The message is handed off to the network thread, which encodes it only
+        once no matter how many connections there are and shares the result
+        between all of them; this makes it safe to call from the main thread
+        regardless of how large the message is. The message should not be
+        modified after it has been handed over.
+        """
+        self._defer(self._broadcast, protocolMsgInstance)
+
+    def broadcast_encoded(self, data, connections=None,
+                          policy=DeliveryPolicy.CONTROL, msg_id=None, stream=Stream.CONTROL):
+        """
+        Broadcast an already encoded protocol message over the provided list of
+        connections, or all of the current connections if no list is given.
+
+        This is for callers that want to send the same message to several
+        connections; the message can be encoded once with encode() and the
+        same data queued up for each of them; a large message is also only
+        split into fragments once. See Connection.send_encoded() for the
+        meaning of the policy, message id and stream.
+        """
+        if connections is None:
+            connections = self.registry.snapshot()
+
+        fragments = dict()
+        for connection in connections:
+            connection.send_encoded(data, policy, msg_id, stream, fragments)
+
+    def send_file(self, connection, root_path, relative_name):
+        """
+        Stream the file with the given name (relative to the given root path)
+        to the remote end of the provided connection, returning the unique id
+        of the transfer.
+
+        The file is sent in chunks by the network thread, and the transfer
+        resumes where it left off if the connection is interrupted; the
+        remote end raises a FILE_RECEIVED event once it has the whole file.
+        """
+        transfer_id = uuid.uuid4().bytes
+        self._defer(self.transfers.send_file, connection, root_path,
+                    relative_name, transfer_id)
+
+        return transfer_id
+
+    def best_connection(self, ip=None, port=None, hostname=None, instance_id=None):
+        """
+        Of the connections matching the provided criteria (see
+        find_connection), return the one that is the best path to the remote
+        host, or None if there are none.
+
+        Connections that are up and that the remote end has introduced itself
+        on are preferred, and of those the one with the shortest round trip
+        time wins, with connections that we don't have a round trip time for
+        yet coming last.
+        """
+        def rank(conn):
+            rtt = conn.link.rtt()
+            return (not conn.connected, conn.introduction is None,
+                    rtt is None, rtt or 0, conn.queued_bytes())
+
+        connections = self.find_connection(ip, port, hostname, instance_id)
+        return min(connections, key=rank, default=None)
+
+    def link_stats(self):
+        """
+        Return a list of (connection, stats) tuples that describe the health
+        of every current connection, including round trip times and clock
+        offsets, for diagnostics.
+        """
+        return [(conn, conn.link_stats()) for conn in self.registry.snapshot()]
+
+    def queue_stats(self):
+        """
+        Return a list of (connection, stats) tuples that describe the state of
+        the send queue of every current connection, for monitoring.
+        """
+        return [(conn, conn.queue_stats()) for conn in self.registry.snapshot()]
+
+    def content_stats(self):
+        """
+        Return a dictionary of statistics on the state of the cache of
+        clipboard content that is used to avoid resending content to hosts
+        that already have it.
+        """
+        return self.content.cache.stats()
+
+    def overlay_stats(self):
+        """
+        Return a dictionary of statistics on the overlay network; how many
+        neighbours we have and how many relayed broadcasts we have passed on
+        or thrown away as copies.
+        """
+        return self.overlay.stats()
+
+    def _add_protocol_handler(self, msg_class, handler):
+        """
+        Register a handler for messages of the given class that is invoked in
+        the network thread when one arrives, instead of the message being
+        raised as an event.
+        """
+        self.protocol_handlers[msg_class.msg_id()] = handler
+
+    def _intercept(self, connection, msg):
+        """
+        Called by connections in the network thread for every message they
+        receive; if there is a protocol handler for the message it is invoked
+        and True is returned, otherwise False is returned and the connection
+        raises the message as an event.
+        """
+        handler = self.protocol_handlers.get(msg.msg_id())
+        if handler is None:
+            return False
+
+        handler(connection, msg)
+        return True
+
+    def _introduction_received(self, connection, msg):
+        """
+        Let the connection know what the remote end told us about itself in
+        its Introduction, and close it if it turns out to be a second
+        connection to a host we're already connected to.
+
+        Otherwise, open the connection up for sending, pass the message on as
+        usual, ask it for any clipboard history we're missing, tell it about
+        the other hosts that we're connected to and ping it to get a round trip
+        time.
+        """
+        connection.introduced(msg)
+        self.registry.reindex(connection)
+
+        redundant = self._redundant_connection(connection)
+        if redundant is not None:
+            log("Closing redundant connection to {} ({}:{})", redundant.hostname,
+                redundant.ip, redundant.port)
+            redundant.close()
+            if redundant is connection:
+                return
+
+        if self.overlay.over_capacity(connection):
+            log("Closing connection from {} ({}:{}); we have enough neighbours",
+                connection.hostname, connection.ip, connection.port)
+            connection.close()
+            return
+
+        connection.open()
+        self.directory.seen(connection)
+        connection._raise(NetworkEvent.MESSAGE, msg)
+
+        self.content.request_history(connection)
+        self._share_peers(connection)
+
+        # Get a round trip time for the new connection right away.
+        self.heartbeat.ping(connection)
+
+    def _redundant_connection(self, connection):
+        """
+        Given a connection that the remote end has just introduced itself on,
+        check for another connection to the same instance, which happens when
+        two hosts connect to each other at the same time. If there is one,
+        return whichever of the two should be closed, otherwise return None.
+
+        Both hosts need to pick the same connection to keep without talking
+        about it, so the one that was started by the host with the lower
+        instance id is kept. If both connections were started by the same
+        host, that host closes the newer one and the other host leaves it to
+        them.
+        """
+        instance_id = connection.introduction.instance_id
+        if not instance_id:
+            return None
+
+        others = [conn for conn in self.registry.find(instance_id=instance_id)
+                       if conn is not connection]
+        if not others:
+            return None
+
+        other = others[0]
+        if other.accepted == connection.accepted:
+            return None if connection.accepted else connection
+
+        # The connection that the remote end started is the one we accepted.
+        keep_accepted = instance_id < self.instance_id
+        return other if connection.accepted == keep_accepted else connection
+
+    def _history_synced(self, connection):
+        """
+        Called in the network thread whenever we finish syncing clipboard
+        history with a remote host, to track how long after startup the
+        first sync took.
+        """
+        if self.first_sync_time is None and self.started_at is not None:
+            self.first_sync_time = timer() - self.started_at
+            log("First clipboard sync (with {}) {:.0f}ms after startup",
+                connection.hostname, self.first_sync_time * 1000.0)
+
+    def _share_peers(self, connection):
+        """
+        Send the remote end of the provided connection a list of all of the
+        other hosts that we're connected to, so that it can connect to them
+        too; this lets a host that just joined connect to everyone at once.
+        """
+        peers = [(conn.introduction.ip, conn.introduction.port, conn.introduction.instance_id)
+                 for conn in self.registry.snapshot()
+                 if conn is not connection and conn.introduction is not None]
+
+        if peers:
+            connection.send(PeerListMessage(peers))
+
+    def _broadcast(self, protocolMsgInstance):
+        """
+        Encode and broadcast the provided message; this is invoked from within
+        the network thread on behalf of broadcast().
+
+        The message only goes to connections whose remote end wants messages of
+        its type, and is not encoded at all if there are none. Clipboard content
+        may be offered by digest rather than sent outright; see ContentExchange.
+
+        When the overlay is turned on, the message is relayed through it to
+        every host instead; see Overlay.
         """
-        with self.conn_lock:
-            for connection in self.connections:
-                connection.send(protocolMsgInstance)
+        if self.overlay.enabled():
+            return self.overlay.broadcast(protocolMsgInstance)
+
+        connections = [conn for conn in self.registry.snapshot()
+                            if conn.accepts(protocolMsgInstance.msg_id())]
+
+        protocolMsgInstance = self.content.outgoing(protocolMsgInstance)
+        if not connections:
+            return
+
+        self.broadcast_encoded(protocolMsgInstance.encode(), connections,
+                               policy=protocolMsgInstance.delivery_policy,
+                               msg_id=protocolMsgInstance.msg_id(),
+                               stream=protocolMsgInstance.stream)
+
+    def _defer(self, callback, *args):
+        """
+        Hand the provided callback off to the network thread to invoke with the
+        given arguments the next time through its loop.
+        """
+        self.net_thread.call_soon(callback, *args)
+
+    def _on_network_thread(self):
+        """
+        Returns True if the caller is running in the network thread.
+        """
+        return current_thread() is self.net_thread
+
+    def _wakeup(self):
+        """
+        Signal the network thread that something has changed (a message was
+        queued, a connection was added or we're shutting down) so that it
+        stops waiting in select() and handles it right away.
+        """
+        self.net_thread.wakeup()
+
+    def _call_later(self, delay, callback, *args):
+        """
+        Arrange for the callback to be invoked in the network thread with the
+        given arguments after the given number of seconds; this must be called
+        from the network thread.
+        """
+        return self.net_thread.call_later(delay, callback, *args)
+
+    def _interest_changed(self, connection):
+        """
+        Let the network thread know that the selector events the provided
+        connection is interested in may have changed.
+        """
+        self.net_thread.update_interest(connection)
 
     def _add_connection(self, sock, ip, port):
         """
@@ -136,10 +442,12 @@ class ConnectionManager():
         actually made. This is called by the network thread to add in the
         new connection after it accepts a connection successfully.
         """
-        with self.conn_lock:
-            connection = Connection(self, sock, ip, port, self._handle_event, accepted=True)
-            self.connections.append(connection)
+        connection = Connection(self, sock, ip, port, self._queue_event, accepted=True)
+        self.registry.add(connection)
 
+        self._interest_changed(connection)
+        self.heartbeat.start()
+        self.net_thread.peers_changed()
         return connection
 
     def _open_connection(self, ip, port):
@@ -154,7 +462,7 @@ class ConnectionManager():
         except BlockingIOError:
             pass
 
-        connection = Connection(self, sock, ip, port, self._handle_event)
+        connection = Connection(self, sock, ip, port, self._queue_event)
 
         return connection
 
@@ -163,6 +471,10 @@ class ConnectionManager():
         Given a connection object, attempt to gracefully close it.
         """
         if connection.socket:
+            # Connections are closed from within the network thread, except
+            # at shutdown once the thread is no longer running.
+            self.net_thread.forget(connection)
+
             try:
                 connection.socket.shutdown(socket.SHUT_RDWR)
                 connection.socket.close()
@@ -174,15 +486,75 @@ class ConnectionManager():
                 connection.socket = None
                 connection.connected = False
 
+    def _connected(self, connection):
+        """
+        Called by connections in the network thread when an outgoing
+        connection attempt succeeds.
+        """
+        self.dialer.connected(connection)
+
     def _remove(self, connection):
         """
-        Remove the provided connection from the list of connections that we
-        are currently storing.
+        Remove the provided connection from the registry of connections that
+        we are currently storing.
         """
-        with self.conn_lock:
-            self._close_connection(connection)
-            self.connections[:] = [conn for conn in self.connections
-                                        if conn is not connection]
+        self._close_connection(connection)
+        self.dialer.closed(connection)
+        if self.registry.remove(connection):
+            self.net_thread.peers_changed()
+
+    def _queue_event(self, connection, event, extra):
+        """
+        This is the callback for all of our connections; it can be invoked
+        from any thread, and adds the event to the inbox for delivery in the
+        main thread, scheduling a delivery if one is not already pending.
+        """
+        with self.event_lock:
+            self.event_inbox.append((connection, event, extra))
+            if self.event_delivery_scheduled:
+                return
+
+            self.event_delivery_scheduled = True
+
+        sublime.set_timeout(self._deliver_events)
+
+    def _deliver_events(self):
+        """
+        Deliver events from the inbox to their handlers in the main thread.
+
+        Events are delivered until either the inbox is empty or the configured
+        time budget for a slice runs out, in which case another slice is
+        scheduled to handle the rest so that Sublime can handle user input in
+        between.
+        """
+        budget = sn_setting('event_time_budget') / 1000.0
+        start = timer()
+        delivered = 0
+
+        while True:
+            with self.event_lock:
+                if not self.event_inbox:
+                    self.event_delivery_scheduled = False
+                    break
+
+                # If we're out of time, go around again later, leaving the
+                # delivery flagged as scheduled.
+                if delivered and timer() - start >= budget:
+                    sublime.set_timeout(self._deliver_events)
+                    break
+
+                connection, event, extra = self.event_inbox.popleft()
+
+            try:
+                self._handle_event(connection, event, extra)
+                delivered += 1
+
+            except Exception as e:
+                log("Error handling {} event: {}", event, e)
+
+        if delivered > 1:
+            log("Delivered {} coalesced network events in {:.2f}ms ({} pending)",
+                delivered, (timer() - start) * 1000.0, len(self.event_inbox))
 
     def _handle_event(self, connection, event, extra):
         """
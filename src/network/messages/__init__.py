@@ -2,9 +2,13 @@ from ....sublinet import reload
 
 reload('src.network.messages', ["base", "introduction", "acknowledge",
                                 "message", "error", "clipboard", "history",
-                                "filecontent"])
+                                "filecontent", "filestart", "filechunk",
+                                "fileend", "fileack", "compressed",
+                                "contentoffer", "contentrequest",
+                                "historyrequest", "peerlist", "ping",
+                                "pong", "relay", "fragment"])
 
-from .base import ProtocolMessage
+from .base import ProtocolMessage, DeliveryPolicy, Stream
 from .introduction import IntroductionMessage
 from .acknowledge import AcknowledgeMessage
 from .message import MessageMessage
@@ -12,6 +16,19 @@ from .error import ErrorMessage
 from .clipboard import ClipboardMessage
 from .history import ClipboardHistoryMessage
 from .filecontent import FileContentMessage
+from .filestart import FileStartMessage
+from .filechunk import FileChunkMessage
+from .fileend import FileEndMessage
+from .fileack import FileAckMessage, FileAckStatus
+from .compressed import CompressedMessage
+from .contentoffer import ContentOfferMessage
+from .contentrequest import ContentRequestMessage
+from .historyrequest import HistoryRequestMessage
+from .peerlist import PeerListMessage
+from .ping import PingMessage
+from .pong import PongMessage
+from .relay import RelayMessage
+from .fragment import FragmentMessage
 
 
 ProtocolMessage.register(IntroductionMessage)
@@ -21,10 +38,25 @@ ProtocolMessage.register(ErrorMessage)
 ProtocolMessage.register(ClipboardMessage)
 ProtocolMessage.register(ClipboardHistoryMessage)
 ProtocolMessage.register(FileContentMessage)
+ProtocolMessage.register(FileStartMessage)
+ProtocolMessage.register(FileChunkMessage)
+ProtocolMessage.register(FileEndMessage)
+ProtocolMessage.register(FileAckMessage)
+ProtocolMessage.register(CompressedMessage)
+ProtocolMessage.register(ContentOfferMessage)
+ProtocolMessage.register(ContentRequestMessage)
+ProtocolMessage.register(HistoryRequestMessage)
+ProtocolMessage.register(PeerListMessage)
+ProtocolMessage.register(PingMessage)
+ProtocolMessage.register(PongMessage)
+ProtocolMessage.register(RelayMessage)
+ProtocolMessage.register(FragmentMessage)
 
 
 __all__ = [
     "ProtocolMessage",
+    "DeliveryPolicy",
+    "Stream",
 
     "IntroductionMessage",
     "AcknowledgeMessage",
@@ -34,5 +66,20 @@ __all__ = [
 
     "ClipboardMessage",
     "ClipboardHistoryMessage",
-    "FileContentMessage"
+    "FileContentMessage",
+    "FileStartMessage",
+    "FileChunkMessage",
+    "FileEndMessage",
+    "FileAckMessage",
+    "FileAckStatus",
+
+    "CompressedMessage",
+    "ContentOfferMessage",
+    "ContentRequestMessage",
+    "HistoryRequestMessage",
+    "PeerListMessage",
+    "PingMessage",
+    "PongMessage",
+    "RelayMessage",
+    "FragmentMessage"
 ]
@@ -1,6 +1,52 @@
 import inspect
 import struct
 
+from enum import Enum
+
+
+### ---------------------------------------------------------------------------
+
+
+class DeliveryPolicy(Enum):
+    """
+    This enumeration represents how a message that is waiting to be sent may
+    be treated if the send queue of a connection backs up because the remote
+    end is not keeping up.
+    """
+    # The message is never dropped.
+    CONTROL=0
+
+    # Only the most recent message of this type matters; a newer one replaces
+    # any older one that is still waiting to be sent.
+    LATEST=1
+
+    # The message may be dropped if the queue is congested.
+    DROPPABLE=2
+
+
+### ---------------------------------------------------------------------------
+
+
+class Stream(Enum):
+    """
+    This enumeration represents the logical stream that a message is sent on.
+    Every connection carries several streams at once, and takes turns sending
+    from each of them, so that a message on one stream never has to wait for
+    a large transfer on another to finish.
+
+    Messages on the same stream are always delivered in the order that they
+    were sent; there is no ordering between streams.
+    """
+    # Protocol housekeeping; introductions, heartbeats, offers and requests.
+    CONTROL=0
+
+    # Things that a user is waiting on, such as the clipboard.
+    INTERACTIVE=1
+
+    # Large transfers that can take as long as they need, such as files and
+    # clipboard history.
+    BULK=2
+
 
 ### ---------------------------------------------------------------------------
 
@@ -15,6 +61,19 @@ class ProtocolMessage():
     _registry = {}
     _size_width = struct.calcsize(">I")
 
+    # How this message is treated while it waits in a send queue; subclasses
+    # that carry data that can be dropped or superseded override this.
+    delivery_policy = DeliveryPolicy.CONTROL
+
+    # The stream that this message is sent on; see Stream.
+    stream = Stream.CONTROL
+
+    # For a message that was relayed to us through the overlay, the instance
+    # id and hostname of the host that sent it; these are None for messages
+    # that came straight from the host at the other end of the connection.
+    origin = None
+    origin_hostname = None
+
     @classmethod
     def register(cls, classObj):
         """
@@ -38,8 +97,8 @@ class ProtocolMessage():
     @classmethod
     def from_data(cls, data, udp=False):
         """
-        Takes a block of data (bytes) that contains an encoded protocol
-        message. If the block is for a known protocol message (based on the
+        Takes a block of data (bytes or a memoryview) that contains an encoded
+        protocol message. If the block is for a known protocol message (based on the
         encoded type ID), an instance of that message will be returned
         containing the decoded data. Otherwise a ValueError exception will be
         raised.
@@ -68,9 +127,12 @@ class ProtocolMessage():
     @classmethod
     def decode(cls, data):
         """
-        Takes a byte object and return back an instance of this class based on
-        that data. The data provided will be exactly the data that was returned
-        from a prior call to encode().
+        Takes a bytes-like object and return back an instance of this class
+        based on that data. The data provided will be exactly the data that was
+        returned from a prior call to encode(), without the length prefix.
+
+        The data may be a view into a receive buffer that will be reused once
+        this returns, so the decoded message must not hold a reference to it.
         """
         raise NotImplementedError('abstract base method should be overridden')
 
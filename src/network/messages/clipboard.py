@@ -1,6 +1,6 @@
 import struct
 
-from .base import ProtocolMessage
+from .base import ProtocolMessage, DeliveryPolicy, Stream
 
 
 ### ---------------------------------------------------------------------------
@@ -13,9 +13,15 @@ class ClipboardMessage(ProtocolMessage):
     This message is structured similarly to the Message and Error messages, but
     has a specific purpose for the information that it conveys.
     """
+    delivery_policy = DeliveryPolicy.LATEST
+    stream = Stream.INTERACTIVE
+
     def __init__(self, text):
         self.text = text
 
+        # Set on arrival if this text has been seen before; see ContentCache.
+        self.duplicate = False
+
     def __str__(self):
         return "<Clipboard text='{0}'>".format(self.text)
 
@@ -0,0 +1,53 @@
+import struct
+
+from .base import ProtocolMessage
+
+
+### ---------------------------------------------------------------------------
+
+
+class CompressedMessage(ProtocolMessage):
+    """
+    This message wraps another message whose encoded form has been compressed
+    with zlib; it is only ever sent to hosts that advertised support for it in
+    their Introduction.
+
+    The flags indicate how the content was compressed; when a preset dictionary
+    was used, it is the one both ends of the connection build from the recent
+    clipboard traffic on it. Expanding the content back into the original
+    message is the job of the connection that received it, since that is where
+    the dictionary is kept.
+    """
+    # The content was compressed using the preset dictionary.
+    FLAG_DICTIONARY = 0x01
+
+    def __init__(self, flags, raw_length, content):
+        self.flags = flags
+        self.raw_length = raw_length
+        self.content = content
+
+    def __str__(self):
+        return "<Compressed flags={0} size={1} raw={2}>".format(
+            self.flags, len(self.content), self.raw_length)
+
+    @classmethod
+    def msg_id(cls):
+        return 11
+
+    @classmethod
+    def decode(cls, data):
+        pre_len = struct.calcsize(">HBI")
+        _, flags, raw_length = struct.unpack(">HBI", data[:pre_len])
+
+        return CompressedMessage(flags, raw_length, bytes(data[pre_len:]))
+
+    def encode(self):
+        return struct.pack(">IHBI%ds" % len(self.content),
+            2 + 1 + 4 + len(self.content),
+            CompressedMessage.msg_id(),
+            self.flags,
+            self.raw_length,
+            self.content)
+
+
+### ---------------------------------------------------------------------------
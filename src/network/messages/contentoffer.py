@@ -0,0 +1,64 @@
+import struct
+
+from .base import ProtocolMessage, Stream
+
+
+### ---------------------------------------------------------------------------
+
+
+class ContentOfferMessage(ProtocolMessage):
+    """
+    This message offers content to the remote end by its digest (and size)
+    rather than by sending it outright; the remote end responds with a
+    ContentRequest for anything it doesn't already have.
+
+    The kind says what the offered content is for; clipboard content replaces
+    the clipboard on the remote end, while history content is added to its
+    paste history. History offers also carry the sequence number of the
+    newest entry in the history log of the sender, while clipboard offers
+    carry the generation of the clipboard update; either way the remote end
+    echoes it back in its request.
+
+    Clipboard offers are sent on the same stream as the clipboard updates
+    that aren't offered, so that they all arrive in the order they were made.
+    """
+    KIND_CLIPBOARD = 0
+    KIND_HISTORY = 1
+
+    def __init__(self, kind, entries, sequence=0):
+        self.kind = kind
+        self.entries = entries
+        self.sequence = sequence
+
+        if kind == self.KIND_CLIPBOARD:
+            self.stream = Stream.INTERACTIVE
+
+    def __str__(self):
+        return "<ContentOffer kind={0} entries={1} sequence={2}>".format(
+            self.kind, len(self.entries), self.sequence)
+
+    @classmethod
+    def msg_id(cls):
+        return 12
+
+    @classmethod
+    def decode(cls, data):
+        pre_len = struct.calcsize(">HBIH")
+        _, kind, sequence, count = struct.unpack(">HBIH", data[:pre_len])
+
+        entries = [struct.unpack_from(">20sI", data, pre_len + 24 * idx) for idx in range(count)]
+
+        return ContentOfferMessage(kind, entries, sequence)
+
+    def encode(self):
+        entries = b''.join(struct.pack(">20sI", digest, size) for digest, size in self.entries)
+        return struct.pack(">IHBIH%ds" % len(entries),
+            2 + 1 + 4 + 2 + len(entries),
+            ContentOfferMessage.msg_id(),
+            self.kind,
+            self.sequence,
+            len(self.entries),
+            entries)
+
+
+### ---------------------------------------------------------------------------
@@ -0,0 +1,48 @@
+import struct
+
+from .base import ProtocolMessage
+
+
+### ---------------------------------------------------------------------------
+
+
+class ContentRequestMessage(ProtocolMessage):
+    """
+    This message is the response to a ContentOffer, and asks the remote end to
+    send the content with the given digests, which were offered to us but
+    which we don't already have. The sequence number of the offer is echoed
+    back, so that it can be passed along with the content.
+    """
+    def __init__(self, kind, digests, sequence=0):
+        self.kind = kind
+        self.digests = digests
+        self.sequence = sequence
+
+    def __str__(self):
+        return "<ContentRequest kind={0} digests={1} sequence={2}>".format(
+            self.kind, len(self.digests), self.sequence)
+
+    @classmethod
+    def msg_id(cls):
+        return 13
+
+    @classmethod
+    def decode(cls, data):
+        pre_len = struct.calcsize(">HBIH")
+        _, kind, sequence, count = struct.unpack(">HBIH", data[:pre_len])
+
+        digests = list(struct.unpack_from(">" + "20s" * count, data, pre_len))
+
+        return ContentRequestMessage(kind, digests, sequence)
+
+    def encode(self):
+        return struct.pack(">IHBIH" + "20s" * len(self.digests),
+            2 + 1 + 4 + 2 + 20 * len(self.digests),
+            ContentRequestMessage.msg_id(),
+            self.kind,
+            self.sequence,
+            len(self.digests),
+            *self.digests)
+
+
+### ---------------------------------------------------------------------------
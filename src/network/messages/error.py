@@ -1,6 +1,6 @@
 import struct
 
-from .base import ProtocolMessage
+from .base import ProtocolMessage, Stream
 
 
 ### ---------------------------------------------------------------------------
@@ -16,6 +16,8 @@ class ErrorMessage(ProtocolMessage):
     message of this type after they do something that signals a failure, so
     that both the code and the user can see what's happened.
     """
+    stream = Stream.INTERACTIVE
+
     def __init__(self, error_code, error_msg):
         self.error_code = error_code
         self.error_msg = error_msg
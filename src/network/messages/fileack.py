@@ -0,0 +1,68 @@
+import struct
+
+from enum import Enum
+
+from .base import ProtocolMessage
+
+
+### ---------------------------------------------------------------------------
+
+
+class FileAckStatus(Enum):
+    """
+    The state of a streamed file transfer, as reported by the receiving end in
+    a FileAck message.
+    """
+    # The transfer is in progress; chunks up to the acknowledged one have
+    # been received and written.
+    CONTINUE=0
+
+    # The file was received completely and its digest matched.
+    COMPLETE=1
+
+    # The transfer failed on the receiving end and will not be resumed.
+    FAILED=2
+
+
+### ---------------------------------------------------------------------------
+
+
+class FileAckMessage(ProtocolMessage):
+    """
+    This message is sent by the receiving end of a streamed file transfer to
+    tell the sender the sequence number of the next chunk that it needs;
+    everything prior to that has been safely written.
+
+    This is sent in response to a FileStart (to tell the sender where to start
+    from, which is how an interrupted transfer resumes), periodically while
+    chunks are arriving, and at the end to report the final status.
+    """
+    def __init__(self, transfer_id, next_sequence, status=FileAckStatus.CONTINUE):
+        self.transfer_id = transfer_id
+        self.next_sequence = next_sequence
+        self.status = status
+
+    def __str__(self):
+        return "<FileAck id={0} next={1} status={2}>".format(
+            self.transfer_id.hex(), self.next_sequence, self.status.name)
+
+    @classmethod
+    def msg_id(cls):
+        return 10
+
+    @classmethod
+    def decode(cls, data):
+        _, transfer_id, next_sequence, status = struct.unpack(">H16sIB", data)
+
+        return FileAckMessage(transfer_id, next_sequence, FileAckStatus(status))
+
+    def encode(self):
+        return struct.pack(">IH16sIB",
+            2 + 16 + 4 + 1,
+            FileAckMessage.msg_id(),
+            self.transfer_id,
+            self.next_sequence,
+            self.status.value)
+
+
+### ---------------------------------------------------------------------------
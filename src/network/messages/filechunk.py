@@ -0,0 +1,59 @@
+import struct
+
+from .base import ProtocolMessage, Stream
+
+
+### ---------------------------------------------------------------------------
+
+
+class FileChunkMessage(ProtocolMessage):
+    """
+    This message carries a single chunk of the content of a file that is being
+    streamed as part of a transfer started by a FileStart message.
+
+    Chunks are numbered sequentially from 0; every chunk but the last is the
+    chunk size given in the FileStart.
+    """
+    stream = Stream.BULK
+
+    def __init__(self, transfer_id, sequence, chunk):
+        self.transfer_id = transfer_id
+        self.sequence = sequence
+        self.chunk = chunk
+
+    def __str__(self):
+        return "<FileChunk id={0} seq={1} size={2}>".format(
+            self.transfer_id.hex(), self.sequence, len(self.chunk))
+
+    @classmethod
+    def msg_id(cls):
+        return 8
+
+    @classmethod
+    def decode(cls, data):
+        pre_len = struct.calcsize(">H16sII")
+        _, transfer_id, sequence, chunk_len = struct.unpack(">H16sII", data[:pre_len])
+
+        chunk, = struct.unpack_from(">%ds" % chunk_len, data, pre_len)
+
+        return FileChunkMessage(transfer_id, sequence, chunk)
+
+    def encode(self):
+        return self.encode_header(self.transfer_id, self.sequence, len(self.chunk)) + self.chunk
+
+    @classmethod
+    def encode_header(cls, transfer_id, sequence, chunk_len):
+        """
+        Return the encoded form of a chunk message of the given length, up to
+        but not including the content of the chunk itself; this allows the
+        content to be sent directly from the file it is stored in.
+        """
+        return struct.pack(">IH16sII",
+            2 + 16 + 4 + 4 + chunk_len,
+            FileChunkMessage.msg_id(),
+            transfer_id,
+            sequence,
+            chunk_len)
+
+
+### ---------------------------------------------------------------------------
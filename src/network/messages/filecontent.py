@@ -1,39 +1,46 @@
 import struct
 from os.path import dirname, basename, join
 
-from .base import ProtocolMessage
+from .base import ProtocolMessage, Stream
 
 
 ### ---------------------------------------------------------------------------
 
 
-# TODO: This should allow for spooling of files in partial chunks by including
-#       a total chunk count and a current chunk indicator, allowing both ends
-#       to handle large files without exploding memory usage.
-#
-#       This could also be enhanced to allow for sending the buffer in place
-#       of reading the current file content from disk first.
+# TODO: This could be enhanced to allow for sending the buffer in place of
+#       reading the current file content from disk first.
 class FileContentMessage(ProtocolMessage):
     """
     This message transmits file information to the remote end; the name of a
     file and optionally also its content.
 
-    Currently this is a rather crude implementation; the whole file will be
-    read into memory and transmitted at once. A more robust implementation
-    would allow for spooling chunks of the file in sucessive messages so that
-    the memory load is not of concern in the general case.
+    This is a rather crude implementation; the whole file will be read into
+    memory and transmitted at once. Large files should be streamed in chunks
+    instead, using ConnectionManager.send_file().
+
+    The file is not read until the message is encoded, which happens in the
+    network thread, so creating one of these does not touch the disk.
     """
+    stream = Stream.BULK
+
     def __init__(self, root_path, relative_name, read_file=True):
         self.root_path = root_path
         self.relative_name = relative_name
-
-        if read_file:
-            with open(join(root_path, relative_name), "rb") as file:
-                self.file_content = file.read()
+        self.read_file = read_file
+        self.file_content = None
 
     def __str__(self):
         return "<FileContent root='{0}' name='{1}' size={2}>".format(
-            self.root_path, self.relative_name, len(self.file_content))
+            self.root_path, self.relative_name,
+            len(self.file_content) if self.file_content is not None else "unread")
+
+    def _load(self):
+        """
+        Read the content of the file from disk, if it hasn't been already.
+        """
+        if self.file_content is None and self.read_file:
+            with open(join(self.root_path, self.relative_name), "rb") as file:
+                self.file_content = file.read()
 
     @classmethod
     def msg_id(cls):
@@ -54,6 +61,7 @@ class FileContentMessage(ProtocolMessage):
         return msg
 
     def encode(self):
+        self._load()
         return struct.pack(">IH256s256sI%ds" % len(self.file_content),
             2 + 256 + 256 + 4 + len(self.file_content),
             FileContentMessage.msg_id(),
@@ -0,0 +1,46 @@
+import struct
+
+from .base import ProtocolMessage, Stream
+
+
+### ---------------------------------------------------------------------------
+
+
+class FileEndMessage(ProtocolMessage):
+    """
+    This message marks the end of a streamed file transfer; it tells the
+    receiving end how many chunks were sent in total and carries a SHA-256
+    digest of the complete file content, so that the receiving end can verify
+    that what it wrote matches what was sent.
+    """
+    stream = Stream.BULK
+
+    def __init__(self, transfer_id, chunk_count, digest):
+        self.transfer_id = transfer_id
+        self.chunk_count = chunk_count
+        self.digest = digest
+
+    def __str__(self):
+        return "<FileEnd id={0} chunks={1} digest={2}>".format(
+            self.transfer_id.hex(), self.chunk_count, self.digest.hex())
+
+    @classmethod
+    def msg_id(cls):
+        return 9
+
+    @classmethod
+    def decode(cls, data):
+        _, transfer_id, chunk_count, digest = struct.unpack(">H16sI32s", data)
+
+        return FileEndMessage(transfer_id, chunk_count, digest)
+
+    def encode(self):
+        return struct.pack(">IH16sI32s",
+            2 + 16 + 4 + 32,
+            FileEndMessage.msg_id(),
+            self.transfer_id,
+            self.chunk_count,
+            self.digest)
+
+
+### ---------------------------------------------------------------------------
@@ -0,0 +1,61 @@
+import struct
+
+from .base import ProtocolMessage, Stream
+
+
+### ---------------------------------------------------------------------------
+
+
+class FileStartMessage(ProtocolMessage):
+    """
+    This message starts (or resumes) a streamed file transfer; it carries the
+    name and size of the file and the size of the chunks it will be sent in.
+
+    The transfer id uniquely identifies the transfer on both ends; the
+    receiving end responds with a FileAck that tells the sender which chunk
+    to start with, which is how an interrupted transfer resumes.
+    """
+    stream = Stream.BULK
+
+    def __init__(self, transfer_id, root_path, relative_name, file_size, chunk_size):
+        self.transfer_id = transfer_id
+        self.root_path = root_path
+        self.relative_name = relative_name
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+
+    def __str__(self):
+        return "<FileStart id={0} root='{1}' name='{2}' size={3} chunk={4}>".format(
+            self.transfer_id.hex(), self.root_path, self.relative_name,
+            self.file_size, self.chunk_size)
+
+    @classmethod
+    def msg_id(cls):
+        return 7
+
+    @classmethod
+    def decode(cls, data):
+        pre_len = struct.calcsize(">H16sQIHH")
+        _, transfer_id, file_size, chunk_size, root_len, name_len = struct.unpack(">H16sQIHH", data[:pre_len])
+
+        root, name = struct.unpack_from(">%ds%ds" % (root_len, name_len), data, pre_len)
+
+        return FileStartMessage(transfer_id, root.decode("utf-8"), name.decode("utf-8"),
+                                file_size, chunk_size)
+
+    def encode(self):
+        root = self.root_path.encode("utf-8")
+        name = self.relative_name.encode("utf-8")
+        return struct.pack(">IH16sQIHH%ds%ds" % (len(root), len(name)),
+            2 + 16 + 8 + 4 + 2 + 2 + len(root) + len(name),
+            FileStartMessage.msg_id(),
+            self.transfer_id,
+            self.file_size,
+            self.chunk_size,
+            len(root),
+            len(name),
+            root,
+            name)
+
+
+### ---------------------------------------------------------------------------
@@ -0,0 +1,71 @@
+import struct
+
+from .base import ProtocolMessage, Stream
+
+
+### ---------------------------------------------------------------------------
+
+
+class FragmentMessage(ProtocolMessage):
+    """
+    This message carries one piece of a message that was too large to send
+    in one go, so that the pieces of a large message on one stream can be
+    sent in between the messages on the others instead of holding them up.
+
+    The pieces of a message are sent in order on the stream that the message
+    itself was sent on, and the data in them is the complete encoded message
+    (including its length prefix) cut into pieces; the last piece is flagged
+    so that the remote end knows when it has all of them.
+    """
+    FLAG_LAST = 0x01
+
+    def __init__(self, stream, last, data):
+        self.stream = stream
+        self.last = last
+        self.data = data
+
+    def __str__(self):
+        return "<Fragment stream={0} last={1} data={2} bytes>".format(
+            self.stream.name, self.last, len(self.data))
+
+    @classmethod
+    def msg_id(cls):
+        return 19
+
+    @classmethod
+    def decode(cls, data):
+        pre_len = struct.calcsize(">HBB")
+        _, stream, flags = struct.unpack(">HBB", data[:pre_len])
+
+        return FragmentMessage(Stream(stream), bool(flags & cls.FLAG_LAST),
+                               bytes(data[pre_len:]))
+
+    @classmethod
+    def split(cls, data, stream, size):
+        """
+        Cut the provided encoded message into pieces carrying no more than
+        the given number of bytes of it each, returning a list of the encoded
+        Fragment messages to send in its place.
+        """
+        fragments = list()
+        with memoryview(data) as view:
+            for offset in range(0, len(view), size):
+                piece = view[offset:offset + size]
+                last = offset + size >= len(view)
+                fragments.append(struct.pack(">IHBB",
+                    2 + 1 + 1 + len(piece),
+                    FragmentMessage.msg_id(),
+                    stream.value,
+                    cls.FLAG_LAST if last else 0) + piece)
+
+        return fragments
+
+    def encode(self):
+        return struct.pack(">IHBB",
+            2 + 1 + 1 + len(self.data),
+            FragmentMessage.msg_id(),
+            self.stream.value,
+            self.FLAG_LAST if self.last else 0) + self.data
+
+
+### ---------------------------------------------------------------------------
@@ -1,6 +1,6 @@
 import struct
 
-from .base import ProtocolMessage
+from .base import ProtocolMessage, DeliveryPolicy, Stream
 
 
 ### ---------------------------------------------------------------------------
@@ -8,19 +8,30 @@ from .base import ProtocolMessage
 
 class ClipboardHistoryMessage(ProtocolMessage):
     """
-    This message transmits a textual version of the clipboard contets.
+    This message transmits a batch of clipboard history entries, oldest first.
 
-    This is identical to ClipboardMessage, but is a different type so that the
-    receiving end can filter them out if it so desires.
+    This is sent in response to a ContentRequest for history content, and
+    carries the sequence number that the history offer was made at, so that
+    the receiving end knows where to pick up the next time it syncs.
+
+    This can be dropped if the connection is backed up; the receiving end
+    then hasn't synced past the entries that it carried, so it asks for them
+    again the next time it syncs.
     """
-    def __init__(self, index, total, text):
-        self.index = index
-        self.total = total
-        self.text = text
+    delivery_policy = DeliveryPolicy.DROPPABLE
+    stream = Stream.BULK
+
+    def __init__(self, sequence, entries):
+        self.sequence = sequence
+        self.entries = entries
+
+        # Set on arrival for each entry that has been seen before; see
+        # ContentCache.
+        self.duplicates = [False] * len(entries)
 
     def __str__(self):
-        return "<ClipboardHistory text='{0}' ({1}/{2})>".format(
-            self.text, self.index, self.total)
+        return "<ClipboardHistory sequence={0} entries={1}>".format(
+            self.sequence, len(self.entries))
 
     @classmethod
     def msg_id(cls):
@@ -28,22 +39,29 @@ class ClipboardHistoryMessage(ProtocolMessage):
 
     @classmethod
     def decode(cls, data):
-        pre_len = struct.calcsize(">HBBI")
-        _, index, total, msg_len = struct.unpack(">HBBI", data[:pre_len])
+        pre_len = struct.calcsize(">HII")
+        _, sequence, count = struct.unpack(">HII", data[:pre_len])
+
+        entries = list()
+        offset = pre_len
+        for _ in range(count):
+            msg_len, = struct.unpack_from(">I", data, offset)
+            offset += 4
 
-        msg_str, = struct.unpack_from(">%ds" % msg_len, data, pre_len)
+            entries.append(bytes(data[offset:offset + msg_len]).decode('utf-8'))
+            offset += msg_len
 
-        return ClipboardHistoryMessage(index, total, msg_str.decode('utf-8'))
+        return ClipboardHistoryMessage(sequence, entries)
 
     def encode(self):
-        msg_data = self.text.encode("utf-8")
-        return struct.pack(">IHBBI%ds" % len(msg_data),
-            2 + 4 + 1 + 1 + len(msg_data),
+        entries = b''.join(struct.pack(">I", len(data)) + data
+                           for data in (text.encode("utf-8") for text in self.entries))
+        return struct.pack(">IHII%ds" % len(entries),
+            2 + 4 + 4 + len(entries),
             ClipboardHistoryMessage.msg_id(),
-            self.index,
-            self.total,
-            len(msg_data),
-            msg_data)
+            self.sequence,
+            len(self.entries),
+            entries)
 
 
 ### ---------------------------------------------------------------------------
@@ -0,0 +1,42 @@
+import struct
+
+from .base import ProtocolMessage
+
+
+### ---------------------------------------------------------------------------
+
+
+class HistoryRequestMessage(ProtocolMessage):
+    """
+    This message asks the remote end to sync its clipboard history to us,
+    starting after the given sequence number in its history log; this is the
+    last sequence number we received from that host, or 0 if we have never
+    synced with it.
+
+    Hosts that don't want the clipboard history of other hosts just never
+    send this.
+    """
+    def __init__(self, sequence):
+        self.sequence = sequence
+
+    def __str__(self):
+        return "<HistoryRequest sequence={0}>".format(self.sequence)
+
+    @classmethod
+    def msg_id(cls):
+        return 14
+
+    @classmethod
+    def decode(cls, data):
+        _, sequence = struct.unpack(">HI", data)
+
+        return HistoryRequestMessage(sequence)
+
+    def encode(self):
+        return struct.pack(">IHI",
+            2 + 4,
+            HistoryRequestMessage.msg_id(),
+            self.sequence)
+
+
+### ---------------------------------------------------------------------------
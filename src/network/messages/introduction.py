@@ -43,20 +43,62 @@ class IntroductionMessage(ProtocolMessage):
     notion is that they would provide a minimal level of access control in
     cases where multiple users on the same local network are available and it's
     not desirable for them to intermingle traffic.
-    """
-    protocol_version = 1
 
-    def __init__(self, user, password, ip=None, port=None, hostname=None, platform=None):
+    The fixed fields are followed by a list of extension fields, each of which
+    is a tag and a length followed by that many bytes of value. Tags that are
+    not known are skipped, so new information can be added to the handshake
+    without changing the protocol version.
+    """
+    protocol_version = 3
+
+    # A unique id for the running instance of the host, which stays the same
+    # across connections but changes whenever the host restarts.
+    EXT_INSTANCE = 2
+
+    # What the host is capable of and wants to be sent: a bitmask of the
+    # FEATURE_ flags, a bitmask with the bit (1 << msg_id) set for each type
+    # of message it wants to receive, and the largest frame (in bytes) it will
+    # accept, with 0 meaning no limit. Hosts that don't send this are assumed
+    # to have no features and to want everything. Newer versions may add more
+    # fields on the end, which older ones ignore.
+    EXT_CAPABILITIES = 3
+    _capabilities_format = ">IQI"
+
+    # The host accepts zlib compressed messages; when combined with the
+    # dictionary flag, it also accepts them compressed with a preset
+    # dictionary.
+    FEATURE_ZLIB = 0x01
+    FEATURE_DICTIONARY = 0x02
+
+    # The host can put large messages that are sent to it in pieces back
+    # together; see FragmentMessage.
+    FEATURE_FRAGMENTS = 0x04
+
+    ALL_MESSAGES = 0xFFFFFFFFFFFFFFFF
+
+    def __init__(self, user, password, ip=None, port=None, hostname=None, platform=None,
+                 features=0, subscriptions=ALL_MESSAGES, max_frame=0, instance_id=b''):
         self.user = user
         self.password = password
         self.ip = ip or _get_local_ip()
         self.port = port or 4377
         self.hostname = hostname or socket.getfqdn()
         self.platform = platform or sublime.platform()
+        self.features = features
+        self.subscriptions = subscriptions
+        self.max_frame = max_frame
+        self.instance_id = instance_id
 
     def __str__(self):
-        return "<Introduction user={0} ip={1}:{2} host={3} platform={4} version={5}>".format(
-            self.user, self.ip, self.port, self.hostname, self.platform, self.protocol_version)
+        return "<Introduction user={0} ip={1}:{2} host={3} platform={4} version={5} features={6:#x}>".format(
+            self.user, self.ip, self.port, self.hostname, self.platform, self.protocol_version,
+            self.features)
+
+    def subscribes(self, msg_id):
+        """
+        Returns True if the host wants to receive messages with the given id.
+        """
+        return bool(self.subscriptions & (1 << msg_id))
 
     @classmethod
     def msg_id(cls):
@@ -64,7 +106,8 @@ class IntroductionMessage(ProtocolMessage):
 
     @classmethod
     def decode(cls, data):
-        _, version, user, password, ip, port, hostname, platform = struct.unpack(">HB64s64s39sH64s8s", data)
+        pre_len = struct.calcsize(">HB64s64s39sH64s8s")
+        _, version, user, password, ip, port, hostname, platform = struct.unpack(">HB64s64s39sH64s8s", data[:pre_len])
 
         msg = IntroductionMessage(
             user.decode("utf-8").rstrip("\000"),
@@ -75,11 +118,46 @@ class IntroductionMessage(ProtocolMessage):
             platform.decode("utf-8").rstrip("\000"))
         msg.protocol_version = version
 
+        ext_len = struct.calcsize(">HH")
+        offset = pre_len
+        while offset + ext_len <= len(data):
+            tag, length = struct.unpack_from(">HH", data, offset)
+            offset += ext_len
+
+            value = bytes(data[offset:offset + length])
+            offset += length
+
+            msg._decode_extension(tag, value)
+
         return msg
 
+    def _decode_extension(self, tag, value):
+        """
+        Store the value of the given extension field in this message; values
+        too short to hold what we expect are ignored, as is anything after it.
+        """
+        if tag == self.EXT_INSTANCE:
+            self.instance_id = value
+        elif (tag == self.EXT_CAPABILITIES and
+                len(value) >= struct.calcsize(self._capabilities_format)):
+            self.features, self.subscriptions, self.max_frame = struct.unpack_from(
+                self._capabilities_format, value)
+
+    def _encode_extensions(self):
+        """
+        Return the encoded extension fields for this message.
+        """
+        return (struct.pack(">HH%ds" % len(self.instance_id), self.EXT_INSTANCE,
+                            len(self.instance_id), self.instance_id) +
+                struct.pack(">HH", self.EXT_CAPABILITIES,
+                            struct.calcsize(self._capabilities_format)) +
+                struct.pack(self._capabilities_format,
+                            self.features, self.subscriptions, self.max_frame))
+
     def encode(self):
-        return struct.pack(">IHB64s64s39sH64s8s",
-            2 + 1 + 64 + 64 + 39 + 2 + 64 + 8,
+        extensions = self._encode_extensions()
+        return struct.pack(">IHB64s64s39sH64s8s%ds" % len(extensions),
+            2 + 1 + 64 + 64 + 39 + 2 + 64 + 8 + len(extensions),
             IntroductionMessage.msg_id(),
             self.protocol_version,
             self.user.encode("utf-8"),
@@ -87,7 +165,8 @@ class IntroductionMessage(ProtocolMessage):
             self.ip.encode("utf=8"),
             self.port,
             self.hostname.encode("utf-8"),
-            self.platform.encode("utf-8"))
+            self.platform.encode("utf-8"),
+            extensions)
 
 
 ### ---------------------------------------------------------------------------
@@ -1,6 +1,6 @@
 import struct
 
-from .base import ProtocolMessage
+from .base import ProtocolMessage, Stream
 
 
 ### ---------------------------------------------------------------------------
@@ -15,6 +15,8 @@ class MessageMessage(ProtocolMessage):
     to be machine readable; messages of this type can be transmitted after such
     a message to provide a human readable version as well.
     """
+    stream = Stream.INTERACTIVE
+
     def __init__(self, msg):
         self.msg = msg
 
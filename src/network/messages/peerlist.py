@@ -0,0 +1,65 @@
+import struct
+
+from .base import ProtocolMessage
+
+
+### ---------------------------------------------------------------------------
+
+
+class PeerListMessage(ProtocolMessage):
+    """
+    This message tells the remote end about the other hosts that we are
+    connected to, so that a host that has just joined can connect to all of
+    them right away instead of waiting to hear their discovery broadcasts.
+
+    Each peer is an (ip, port, instance_id) tuple, giving the address the host
+    is listening on and the instance id from its Introduction.
+    """
+    def __init__(self, peers):
+        self.peers = peers
+
+    def __str__(self):
+        return "<PeerList peers={0}>".format(
+            ", ".join("{0}:{1}".format(ip, port) for ip, port, _ in self.peers))
+
+    @classmethod
+    def msg_id(cls):
+        return 15
+
+    @classmethod
+    def decode(cls, data):
+        pre_len = struct.calcsize(">HH")
+        _, count = struct.unpack(">HH", data[:pre_len])
+
+        peers = list()
+        offset = pre_len
+        for _ in range(count):
+            ip_len, port = struct.unpack_from(">BH", data, offset)
+            offset += 3
+            ip = bytes(data[offset:offset + ip_len]).decode("utf-8")
+            offset += ip_len
+
+            id_len, = struct.unpack_from(">B", data, offset)
+            offset += 1
+            instance_id = bytes(data[offset:offset + id_len])
+            offset += id_len
+
+            peers.append((ip, port, instance_id))
+
+        return PeerListMessage(peers)
+
+    def encode(self):
+        peers = b''
+        for ip, port, instance_id in self.peers:
+            ip = ip.encode("utf-8")
+            peers += struct.pack(">BH%dsB%ds" % (len(ip), len(instance_id)),
+                                 len(ip), port, ip, len(instance_id), instance_id)
+
+        return struct.pack(">IHH%ds" % len(peers),
+            2 + 2 + len(peers),
+            PeerListMessage.msg_id(),
+            len(self.peers),
+            peers)
+
+
+### ---------------------------------------------------------------------------
@@ -0,0 +1,42 @@
+import struct
+
+from .base import ProtocolMessage, DeliveryPolicy
+
+
+### ---------------------------------------------------------------------------
+
+
+class PingMessage(ProtocolMessage):
+    """
+    This message is sent periodically on every connection to check that the
+    remote end is still there; it replies with a Pong carrying the same token.
+
+    Only the most recent Ping matters, so a newer one replaces any that are
+    still waiting to be sent.
+    """
+    delivery_policy = DeliveryPolicy.LATEST
+
+    def __init__(self, token):
+        self.token = token
+
+    def __str__(self):
+        return "<Ping token={0}>".format(self.token)
+
+    @classmethod
+    def msg_id(cls):
+        return 16
+
+    @classmethod
+    def decode(cls, data):
+        _, token = struct.unpack(">HI", data)
+
+        return PingMessage(token)
+
+    def encode(self):
+        return struct.pack(">IHI",
+            2 + 4,
+            PingMessage.msg_id(),
+            self.token)
+
+
+### ---------------------------------------------------------------------------
@@ -0,0 +1,43 @@
+import struct
+
+from .base import ProtocolMessage, DeliveryPolicy
+
+
+### ---------------------------------------------------------------------------
+
+
+class PongMessage(ProtocolMessage):
+    """
+    This message is the reply to a Ping, carrying the token from the Ping
+    along with the wall clock time (in seconds since the epoch) at which it
+    was sent. The time is used to estimate how far apart the clocks on the
+    two hosts are.
+    """
+    delivery_policy = DeliveryPolicy.LATEST
+
+    def __init__(self, token, time):
+        self.token = token
+        self.time = time
+
+    def __str__(self):
+        return "<Pong token={0} time={1:.3f}>".format(self.token, self.time)
+
+    @classmethod
+    def msg_id(cls):
+        return 17
+
+    @classmethod
+    def decode(cls, data):
+        _, token, time = struct.unpack(">HId", data)
+
+        return PongMessage(token, time)
+
+    def encode(self):
+        return struct.pack(">IHId",
+            2 + 4 + 8,
+            PongMessage.msg_id(),
+            self.token,
+            self.time)
+
+
+### ---------------------------------------------------------------------------
@@ -0,0 +1,83 @@
+import struct
+
+from .base import ProtocolMessage
+
+
+### ---------------------------------------------------------------------------
+
+
+class RelayMessage(ProtocolMessage):
+    """
+    This message carries a broadcast through the overlay network, in which
+    each host is only connected to a few neighbours instead of to every other
+    host. Hosts pass every Relay they haven't seen before on to their own
+    neighbours, until its time to live runs out.
+
+    The origin is the instance id of the host that made the broadcast, and
+    together with the sequence number it uniquely identifies the broadcast so
+    that copies arriving by other paths can be thrown away; the hostname of
+    that host comes along so that the broadcast can be attributed to it. The
+    payload is the complete encoded message being broadcast, and the Relay is
+    sent on the same stream and with the same delivery policy as that message
+    would be.
+    """
+    def __init__(self, origin, sequence, ttl, payload, hostname=""):
+        self.origin = origin
+        self.sequence = sequence
+        self.ttl = ttl
+        self.payload = payload
+        self.hostname = hostname
+
+    def __str__(self):
+        return "<Relay origin={0} ({1}) sequence={2} ttl={3} payload={4} bytes>".format(
+            self.origin.hex()[:8], self.hostname, self.sequence, self.ttl, len(self.payload))
+
+    @property
+    def stream(self):
+        return self._payload_class().stream
+
+    @property
+    def delivery_policy(self):
+        return self._payload_class().delivery_policy
+
+    def _payload_class(self):
+        """
+        Return the class of the message in the payload, or the base class if
+        it's not a message type that we know.
+        """
+        msg_id, = struct.unpack_from(">H", self.payload, ProtocolMessage._size_width)
+        return ProtocolMessage._registry.get(msg_id, ProtocolMessage)
+
+    @classmethod
+    def msg_id(cls):
+        return 18
+
+    @classmethod
+    def decode(cls, data):
+        pre_len = struct.calcsize(">HB")
+        _, origin_len = struct.unpack(">HB", data[:pre_len])
+
+        offset = pre_len + origin_len
+        origin = bytes(data[pre_len:offset])
+        sequence, ttl, host_len = struct.unpack_from(">IBB", data, offset)
+        offset += struct.calcsize(">IBB")
+
+        hostname = bytes(data[offset:offset + host_len]).decode('utf-8', 'replace')
+        offset += host_len
+
+        return RelayMessage(origin, sequence, ttl, bytes(data[offset:]), hostname)
+
+    def encode(self):
+        hostname = self.hostname.encode('utf-8')[:255]
+        return struct.pack(">IHB%dsIBB%ds" % (len(self.origin), len(hostname)),
+            2 + 1 + len(self.origin) + 4 + 1 + 1 + len(hostname) + len(self.payload),
+            RelayMessage.msg_id(),
+            len(self.origin),
+            self.origin,
+            self.sequence,
+            self.ttl,
+            len(hostname),
+            hostname) + self.payload
+
+
+### ---------------------------------------------------------------------------
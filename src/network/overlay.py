@@ -0,0 +1,170 @@
+import itertools
+
+from collections import OrderedDict
+
+from .messages import ProtocolMessage, RelayMessage
+from .events import NetworkEvent
+from ..utils import sn_setting
+
+
+### ---------------------------------------------------------------------------
+
+
+class Overlay():
+    """
+    This class implements the optional overlay network, for networks with too
+    many hosts for every host to be connected to every other one. With the
+    overlay turned on each host only connects to a few neighbours, and
+    broadcasts are sent as Relay messages that every host passes on to its
+    own neighbours, so that they spread out across the whole network.
+
+    Every broadcast is identified by the instance id of the host that made it
+    and a sequence number, and hosts remember the broadcasts that they have
+    recently seen so that each one is only handled once, no matter how many
+    paths it arrives by. A copy is only passed on again if it arrives with a
+    longer time to live than any copy before it, since the first copy to
+    arrive may have taken a long way around and could run out before
+    reaching everyone.
+
+    Relays are always handled and passed on, even when the overlay is turned
+    off; the setting only controls how we connect and how our own broadcasts
+    are sent. Everything here runs in the network thread.
+    """
+    # How many recently seen broadcasts are remembered for throwing away
+    # copies.
+    max_seen = 8192
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.sequence = itertools.count(1)
+
+        # Maps the (origin, sequence) of recently seen broadcasts to the
+        # longest time to live that we've seen them with.
+        self.seen = OrderedDict()
+
+        self.relayed = 0
+        self.duplicates = 0
+
+        manager._add_protocol_handler(RelayMessage, self.relay_received)
+
+    def enabled(self):
+        """
+        Returns True if the overlay is turned on.
+        """
+        return sn_setting('overlay_neighbours') > 0
+
+    def wants_neighbours(self):
+        """
+        Returns True if we should connect to more hosts; with the overlay
+        turned off, we connect to every host.
+        """
+        if not self.enabled():
+            return True
+
+        connections = len(self.manager.registry) + self.manager.dialer.pending()
+        return connections < sn_setting('overlay_neighbours')
+
+    def over_capacity(self, connection):
+        """
+        Returns True if the provided connection, on which the remote end has
+        just introduced itself, should be closed because we already have as
+        many neighbours as we'll take. Hosts take up to twice as many
+        neighbours as they connect to themselves, so that there's room for
+        the hosts that connect to them; connections we started are never
+        refused.
+        """
+        if not self.enabled() or not connection.accepted:
+            return False
+
+        return len(self.manager.registry) > 2 * sn_setting('overlay_neighbours')
+
+    def broadcast(self, msg):
+        """
+        Send the provided message to the whole overlay network, as a Relay
+        to each of our neighbours.
+        """
+        relay = RelayMessage(self.manager.instance_id, next(self.sequence) & 0xFFFFFFFF,
+                             sn_setting('overlay_ttl'), msg.encode(),
+                             self.manager.net_thread.broadcast_msg.hostname)
+        self._remember(relay)
+        self._forward(relay, None)
+
+    def relay_received(self, connection, msg):
+        """
+        Handle a broadcast that was relayed to us through the overlay,
+        passing it on to our other neighbours and handling the message that
+        it carries, unless we've already seen it.
+
+        The message is handled as if it arrived on the connection that it was
+        relayed to us on, but carries the identity of the host that made the
+        broadcast in its origin and origin_hostname.
+        """
+        previous = self._remember(msg)
+        if msg.origin == self.manager.instance_id or (previous or 0) >= msg.ttl:
+            self.duplicates += 1
+            return
+
+        if msg.ttl > 1:
+            self._forward(RelayMessage(msg.origin, msg.sequence, msg.ttl - 1, msg.payload,
+                                       msg.hostname),
+                          connection)
+
+        if previous is not None:
+            self.duplicates += 1
+            return
+
+        inner = ProtocolMessage.from_data(msg.payload, True)
+        inner.origin = msg.origin
+        inner.origin_hostname = msg.hostname
+        if not self.manager.net_thread.broadcast_msg.subscribes(inner.msg_id()):
+            return
+
+        if not self.manager._intercept(connection, inner):
+            connection._raise(NetworkEvent.MESSAGE, inner)
+
+    def stats(self):
+        """
+        Return a dictionary of statistics on the overlay, for monitoring.
+        """
+        return {
+            "neighbours": len(self.manager.registry),
+            "relayed": self.relayed,
+            "duplicates": self.duplicates
+        }
+
+    def _remember(self, msg):
+        """
+        Remember that we've seen the provided Relay, returning the longest
+        time to live that we had seen it with before, or None if this is the
+        first time we've seen it.
+        """
+        key = (msg.origin, msg.sequence)
+        previous = self.seen.get(key)
+        if previous is not None:
+            self.seen[key] = max(previous, msg.ttl)
+            return previous
+
+        self.seen[key] = msg.ttl
+        if len(self.seen) > self.max_seen:
+            self.seen.popitem(last=False)
+
+        return None
+
+    def _forward(self, msg, source):
+        """
+        Send the provided Relay to all of our neighbours except the one that
+        it came from.
+        """
+        connections = [conn for conn in self.manager.registry.snapshot()
+                            if conn is not source and conn.accepts(RelayMessage.msg_id())]
+        if not connections:
+            return
+
+        self.relayed += 1
+        self.manager.broadcast_encoded(msg.encode(), connections,
+                                       policy=msg.delivery_policy,
+                                       msg_id=msg.msg_id(),
+                                       stream=msg.stream)
+
+
+### ---------------------------------------------------------------------------
@@ -0,0 +1,186 @@
+from threading import Lock
+
+
+### ---------------------------------------------------------------------------
+
+
+class ConnectionRegistry():
+    """
+    A threadsafe collection of connections that is indexed by the ip address,
+    the ip address and port, the hostname and the instance id of the remote
+    end, so that finding the connections to a particular host doesn't require
+    looking at every connection.
+
+    Only adding, removing and reindexing a connection take the lock, so
+    taking a snapshot or finding a connection never blocks, no matter what
+    other threads are doing. Each index entry is an immutable tuple of the
+    connections that share a key, which changes replace outright, so a
+    lookup always sees a whole entry; a lookup made while a connection is
+    being reindexed may miss it, as if it had been made a moment earlier.
+
+    Snapshots are immutable tuples, rebuilt the first time one is asked for
+    after a change. That keeps adding and removing a connection cheap no
+    matter how many there are, at the cost of an O(n) rebuild for the first
+    snapshot taken after any number of changes.
+
+    The hostname and instance id of a connection can change once the remote
+    end introduces itself, so the registry needs to be told to reindex the
+    connection when that happens.
+    """
+    _indexes = ("ip", "address", "hostname", "instance")
+
+    def __init__(self):
+        self.lock = Lock()
+
+        # Maps each connection to the (index, key) pairs it's indexed under,
+        # in the order the connections were added; this is only changed with
+        # the lock held.
+        self.keys = dict()
+
+        # A dictionary of the indexes, each of which maps a key to a tuple of
+        # the connections that share it; entries are only changed with the
+        # lock held, and are replaced rather than modified.
+        self.indexes = {name: {} for name in self._indexes}
+
+        # The tuple of all connections handed out by snapshot(), or None if
+        # the registry has changed since it was last built.
+        self.published = ()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, connection):
+        """
+        Add the provided connection to the registry.
+        """
+        with self.lock:
+            if connection in self.keys:
+                return
+
+            keys = self._index_keys(connection)
+            self.keys[connection] = keys
+            self._reindex(connection, (), keys)
+            self.published = None
+
+    def remove(self, connection):
+        """
+        Remove the provided connection from the registry, returning False if
+        it was not in the registry.
+        """
+        with self.lock:
+            keys = self.keys.pop(connection, None)
+            if keys is None:
+                return False
+
+            self._reindex(connection, keys, ())
+            self.published = None
+            return True
+
+    def reindex(self, connection):
+        """
+        Update the indexes for the provided connection, which needs to happen
+        whenever its hostname changes or it receives an Introduction.
+        """
+        with self.lock:
+            old_keys = self.keys.get(connection)
+            if old_keys is None:
+                return
+
+            new_keys = self._index_keys(connection)
+            if new_keys == old_keys:
+                return
+
+            self.keys[connection] = new_keys
+            self._reindex(connection, old_keys, new_keys)
+
+    def snapshot(self):
+        """
+        Return a tuple of all of the connections currently in the registry;
+        this is not affected by later changes to the registry.
+        """
+        published = self.published
+        if published is not None:
+            return published
+
+        with self.lock:
+            if self.published is None:
+                self.published = tuple(self.keys)
+
+            return self.published
+
+    def find(self, ip=None, port=None, hostname=None, instance_id=None):
+        """
+        Return a list of all connections that match all of the provided
+        criteria; with no criteria, all connections are returned.
+        """
+        indexes = self.indexes
+
+        if instance_id is not None:
+            candidates = indexes["instance"].get(instance_id, ())
+        elif ip is not None and port is not None:
+            candidates = indexes["address"].get((ip, port), ())
+        elif ip is not None:
+            candidates = indexes["ip"].get(ip, ())
+        elif hostname is not None:
+            candidates = indexes["hostname"].get(hostname, ())
+        else:
+            candidates = self.snapshot()
+
+        return [conn for conn in candidates
+                     if self._matches(conn, ip, port, hostname, instance_id)]
+
+    def _matches(self, connection, ip, port, hostname, instance_id):
+        """
+        Returns True if the provided connection matches all of the provided
+        criteria.
+        """
+        return ((ip is None or connection.ip == ip) and
+                (port is None or connection.port == port) and
+                (hostname is None or connection.hostname == hostname) and
+                (instance_id is None or self._instance_id(connection) == instance_id))
+
+    def _instance_id(self, connection):
+        """
+        Return the instance id of the remote end of the connection, or None
+        if it hasn't told us.
+        """
+        if connection.introduction is None:
+            return None
+
+        return connection.introduction.instance_id or None
+
+    def _index_keys(self, connection):
+        """
+        Return the list of (index, key) pairs that the provided connection
+        should be indexed under.
+        """
+        keys = [("ip", connection.ip),
+                ("address", (connection.ip, connection.port)),
+                ("hostname", connection.hostname)]
+
+        instance_id = self._instance_id(connection)
+        if instance_id is not None:
+            keys.append(("instance", instance_id))
+
+        return keys
+
+    def _reindex(self, connection, old_keys, new_keys):
+        """
+        Remove the connection from the entries for the old keys in the indexes
+        and add it to the ones for the new keys; this needs the lock to be
+        held.
+        """
+        for name, key in old_keys:
+            index = self.indexes[name]
+            members = tuple(conn for conn in index[key] if conn is not connection)
+            if members:
+                index[key] = members
+            else:
+                del index[key]
+
+        for name, key in new_keys:
+            index = self.indexes[name]
+            index[key] = index.get(key, ()) + (connection,)
+
+
+### ---------------------------------------------------------------------------
@@ -0,0 +1,234 @@
+import queue
+
+from collections import deque
+from threading import Lock
+
+from .messages import DeliveryPolicy, Stream
+
+
+### ---------------------------------------------------------------------------
+
+
+class SendQueue():
+    """
+    A threadsafe queue of encoded messages waiting to be sent on a connection,
+    bounded in size by a pair of high and low water marks (in bytes).
+
+    Once the amount of queued data rises above the high water mark the queue
+    is considered congested, and stays that way until it drains to the low
+    water mark. While congested, messages whose delivery policy allows them to
+    be dropped are discarded instead of being queued.
+
+    The queue is also capped at a hard limit (in bytes), which only a remote
+    end that has stopped reading at all will ever push it to; once a message
+    would take it past the limit the queue overflows, and from then on every
+    message is dropped, since the connection needs to be closed. A single
+    message larger than the limit can still be queued when nothing else is
+    waiting.
+
+    Independent of congestion, a message with the LATEST policy replaces any
+    message of the same type that is still waiting in the queue, since only
+    the most recent one is of any interest to the remote end. Control messages
+    are always queued.
+
+    Messages are queued on the stream that they're sent on (see Stream), and
+    the streams take turns; each one gets to send as many frames in a row as
+    its weight before the next stream gets a go, so a backlog of bulk data
+    doesn't hold up the other streams. A large message can be queued as a
+    list of fragments, which are sent one at a time in turn like any other
+    frame; once the first fragment has been sent the rest always follow, so
+    the message can no longer be superseded.
+
+    The queue can also be held, in which case only messages of the types that
+    are allowed through are available to be sent; everything else is kept
+    back, in order, until the queue is released.
+    """
+    # How many frames in a row each stream can send before it's the next
+    # stream's turn.
+    weights = {
+        Stream.CONTROL: 4,
+        Stream.INTERACTIVE: 4,
+        Stream.BULK: 1
+    }
+
+    def __init__(self, high_water, low_water, limit):
+        self.high_water = high_water
+        self.low_water = low_water
+        self.limit = max(limit, high_water)
+
+        self.lock = Lock()
+        self.streams = {stream: deque() for stream in Stream}
+        self.latest = dict()
+
+        # The stream whose turn it is, and how many more frames it can send.
+        self.order = list(Stream)
+        self.turn = 0
+        self.credit = self.weights[self.order[0]]
+
+        # While held, the set of message ids that may still be sent, and the
+        # (stream, entry) for all other messages, waiting to be released.
+        self.allowed = None
+        self.held = deque()
+
+        self.count = 0
+        self.size = 0
+        self.congested = False
+        self.overflowed = False
+
+        self.dropped = 0
+        self.superseded = 0
+
+    def qsize(self):
+        """
+        Return the number of messages waiting to be sent.
+        """
+        return self.count
+
+    def put(self, data, policy=DeliveryPolicy.CONTROL, msg_id=None, stream=Stream.CONTROL):
+        """
+        Add the encoded message data to the queue of the given stream,
+        treating it according to the provided policy. The message id is
+        needed for messages with the LATEST policy, to know which queued
+        messages they replace. The data can also be a list of the encoded
+        fragments of a message, which are queued as a single message.
+
+        Returns False if the message was dropped instead of being queued.
+        """
+        with self.lock:
+            if policy == DeliveryPolicy.DROPPABLE and self.congested:
+                self.dropped += 1
+                return False
+
+            if isinstance(data, list):
+                data = deque(data)
+
+            length = self._length(data)
+            if self.overflowed or (self.count and self.size + length > self.limit):
+                self.overflowed = True
+                self.dropped += 1
+                return False
+
+            entry = [policy, msg_id, data]
+            if policy == DeliveryPolicy.LATEST:
+                # Blank out the data of the message we're replacing; it stays
+                # in place in the queue and gets skipped when it comes up.
+                previous = self.latest.get(msg_id)
+                if previous is not None and previous[2] is not None:
+                    self.count -= 1
+                    self.size -= self._length(previous[2])
+                    previous[2] = None
+                    self.superseded += 1
+
+                self.latest[msg_id] = entry
+
+            if self.allowed is None or msg_id in self.allowed:
+                self.streams[stream].append(entry)
+            else:
+                self.held.append((stream, entry))
+
+            self.count += 1
+            self.size += length
+
+            if self.size > self.high_water:
+                self.congested = True
+
+            return True
+
+    def hold(self, allowed):
+        """
+        Hold back all messages except those whose id is in the provided set
+        until release() is called.
+        """
+        with self.lock:
+            self.allowed = set(allowed)
+
+    def release(self):
+        """
+        Stop holding messages back, making all of the ones that were held
+        available to be sent, in the order they were queued.
+        """
+        with self.lock:
+            self.allowed = None
+            for stream, entry in self.held:
+                self.streams[stream].append(entry)
+
+            self.held.clear()
+
+    def ready(self):
+        """
+        Returns True if there are messages that can be sent right now; this is
+        False when the only messages waiting are being held.
+        """
+        return any(self.streams.values())
+
+    def get_nowait(self):
+        """
+        Remove and return the data for the next frame to be sent, taking turns
+        between the streams, raising queue.Empty if there is nothing waiting
+        that isn't being held.
+        """
+        with self.lock:
+            for _ in range(len(self.order) + 1):
+                entries = self.streams[self.order[self.turn]]
+                while entries and self.credit > 0:
+                    policy, msg_id, data = entry = entries[0]
+
+                    # Once anything has been taken from a message, it can no
+                    # longer be replaced.
+                    if policy == DeliveryPolicy.LATEST and self.latest.get(msg_id) is entry:
+                        del self.latest[msg_id]
+
+                    if isinstance(data, deque):
+                        frame = data.popleft()
+                        finished = not data
+                    else:
+                        frame, finished = data, True
+
+                    if finished:
+                        entries.popleft()
+
+                    if frame is None:
+                        continue
+
+                    self.credit -= 1
+                    if finished:
+                        self.count -= 1
+
+                    self.size -= len(frame)
+                    if self.size <= self.low_water:
+                        self.congested = False
+
+                    return frame
+
+                self.turn = (self.turn + 1) % len(self.order)
+                self.credit = self.weights[self.order[self.turn]]
+
+            raise queue.Empty
+
+    def stats(self):
+        """
+        Return a dictionary of statistics on the current state of the queue,
+        for monitoring purposes.
+        """
+        with self.lock:
+            return {
+                "depth": self.count,
+                "bytes": self.size,
+                "congested": self.congested,
+                "overflowed": self.overflowed,
+                "dropped": self.dropped,
+                "superseded": self.superseded
+            }
+
+    def _length(self, data):
+        """
+        Return the number of bytes in the provided queued data, which may be a
+        list of fragments.
+        """
+        if isinstance(data, deque):
+            return sum(len(frame) for frame in data)
+
+        return len(data)
+
+
+### ---------------------------------------------------------------------------
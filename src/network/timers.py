@@ -0,0 +1,114 @@
+import heapq
+import itertools
+
+from timeit import default_timer as timer
+
+from ..utils import log
+
+
+### ---------------------------------------------------------------------------
+
+
+class Timer():
+    """
+    A callback that has been scheduled to be invoked at some point in the
+    future by a TimerQueue. A timer can be cancelled at any point before it
+    fires, in which case it never will.
+    """
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __repr__(self):
+        return "<Timer {0} in {1:.3f}s{2}>".format(
+            getattr(self.callback, "__name__", self.callback),
+            self.deadline - timer(),
+            " cancelled" if self.cancelled else "")
+
+    def cancel(self):
+        """
+        Stop this timer from firing; this does nothing if it already has.
+        """
+        self.cancelled = True
+
+
+### ---------------------------------------------------------------------------
+
+
+class TimerQueue():
+    """
+    A queue of timers ordered by their deadline, which lets the network thread
+    know how long it can sleep before it has something to do and runs the
+    timers once they come due.
+
+    Cancelled timers are left in the queue and thrown away once they reach
+    the front of it, so cancelling is cheap no matter how many timers there
+    are.
+
+    This is not threadsafe; it belongs to the network thread.
+    """
+    def __init__(self):
+        self.heap = list()
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedule the callback to be invoked with the provided arguments once
+        the given number of seconds have passed, returning the Timer.
+        """
+        return self.call_at(timer() + delay, callback, *args)
+
+    def call_at(self, deadline, callback, *args):
+        """
+        Schedule the callback to be invoked with the provided arguments at the
+        given deadline (as returned by timeit.default_timer), returning the
+        Timer.
+        """
+        entry = Timer(deadline, callback, args)
+
+        # The sequence number keeps timers with the same deadline in the order
+        # they were scheduled, and means that timers never get compared.
+        heapq.heappush(self.heap, (deadline, next(self.sequence), entry))
+        return entry
+
+    def timeout(self, now):
+        """
+        Return the number of seconds from now until the next timer is due,
+        which is 0 if one is already due, or None if there are no timers.
+        """
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+
+        if not self.heap:
+            return None
+
+        return max(0, self.heap[0][0] - now)
+
+    def run(self, now):
+        """
+        Invoke all of the timers that are due as of now. Timers that are
+        scheduled while this is running wait until the next call, even if they
+        are already due, so that a timer can reschedule itself.
+        """
+        due = list()
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap)[2])
+
+        for entry in due:
+            if entry.cancelled:
+                continue
+
+            entry.cancelled = True
+            try:
+                entry.callback(*entry.args)
+
+            except Exception as e:
+                log("Error in network timer {}: {}", entry, e)
+
+
+### ---------------------------------------------------------------------------
@@ -1,18 +1,20 @@
-from threading import Thread
+from threading import Thread, Lock, current_thread
 from timeit import default_timer as timer
 
+import random
 import socket
-import select
+import selectors
 import struct
-import time
 
 import textwrap
 
+from collections import deque
+
 from .messages import ProtocolMessage, IntroductionMessage, ClipboardHistoryMessage
+from .events import NetworkEvent
+from .timers import TimerQueue
 from ..utils import sn_setting
-from ..utils import log, display_output_panel
-
-from Default.paste_from_history import g_clipboard_history
+from ..utils import log
 
 
 ### ---------------------------------------------------------------------------
@@ -24,17 +26,58 @@ class NetworkThread(Thread):
     we don't block anything and that our data flows no matter what else is
     happening.
 
-    All of our sockets use non-blocking mode.
+    All of our sockets use non-blocking mode, and are registered with a
+    selector once when they're created; connections only adjust their
+    registration when the set of events they care about changes, such as
+    when their send queue transitions between empty and non-empty.
+
+    Every time a socket selects as ready, we do as much work on it as we can
+    without blocking, but only up to a limit, so that every other socket gets
+    a turn before we come back to it.
     """
-    def __init__(self, manager, lock, connections, event):
+    # The most connections accepted and discovery packets handled each time
+    # through the loop.
+    max_accepts = 16
+    max_datagrams = 16
+
+    # When we see a discovery broadcast from a host we're not connected to, we
+    # send our own Introduction straight back to it after a random delay of
+    # up to this many seconds, but no more than once per interval per host.
+    reply_jitter = 0.25
+    reply_interval = 5.0
+
+    # Discovery broadcasts start out this many seconds apart, and the gap
+    # doubles after each one (up to the broadcast_time setting) for as long
+    # as the set of connected hosts stays the same.
+    min_broadcast_interval = 1.0
+
+    def __init__(self, manager, registry, event):
         log("== Creating network thread")
         super().__init__()
         self.manager = manager
-        self.conn_lock = lock
-        self.connections = connections
+        self.registry = registry
         self.event = event
         self.discovery_socket = self.make_discovery_socket()
         self.server_socket = self.make_server_socket()
+        self.wakeup_recv, self.wakeup_send = self.make_wakeup_sockets()
+        self.wakeup_pending = False
+
+        # Connections whose selector registration needs to be updated; other
+        # threads can't touch the selector, so they post changes here for us
+        # to apply the next time through the loop.
+        self.selector = selectors.DefaultSelector()
+        self.interest_lock = Lock()
+        self.interest_changes = set()
+
+        # Work that other threads have handed off to us, such as encoding a
+        # message that is going to be sent.
+        self.deferred = deque()
+
+        # Everything we need to do at a particular time; the loop sleeps until
+        # the first of these is due unless a socket needs attention first.
+        self.timers = TimerQueue()
+        self.broadcast_timer = None
+        self.broadcast_interval = self.min_broadcast_interval
 
         # Create the message that we use to introduce ourselves; this is never
         # going to change so no need to make multiples of them.
@@ -43,11 +86,47 @@ class NetworkThread(Thread):
         #       we need either a way to signal the thread to change what it is
         #       broadcasting, or we need to quit and restart Sublime to make
         #       such a change take effect.
-        self.broadcast_msg = IntroductionMessage('tmartin', 'password', sn_setting('stream_ip'), sn_setting('stream_port'))
+        self.broadcast_msg = IntroductionMessage('tmartin', 'password', sn_setting('stream_ip'), sn_setting('stream_port'),
+                                                 features=self.features(),
+                                                 subscriptions=self.subscriptions(),
+                                                 max_frame=sn_setting('max_frame_size'),
+                                                 instance_id=manager.instance_id)
+        self.discovery_packet = self.broadcast_msg.encode()
+
+        # The last time that we replied directly to each host that sent us a
+        # discovery broadcast.
+        self.last_replies = dict()
 
     def __del__(self):
         log("== Destroying network thread")
 
+    def features(self):
+        """
+        Return the feature flags to advertise in our Introduction, based on
+        the current settings.
+        """
+        flags = IntroductionMessage.FEATURE_FRAGMENTS
+        if not sn_setting('compression'):
+            return flags
+
+        flags |= IntroductionMessage.FEATURE_ZLIB
+        if sn_setting('compression_dictionary'):
+            flags |= IntroductionMessage.FEATURE_DICTIONARY
+
+        return flags
+
+    def subscriptions(self):
+        """
+        Return the bitmask of the message types that we want remote hosts to
+        send us, to advertise in our Introduction; types that we would only
+        throw away are left out so that they're never sent.
+        """
+        subscriptions = IntroductionMessage.ALL_MESSAGES
+        if not sn_setting('sync_paste_history'):
+            subscriptions &= ~(1 << ClipboardHistoryMessage.msg_id())
+
+        return subscriptions
+
     def make_discovery_socket(self):
         """
         Create and return a UDP socket configured to multicast to the
@@ -100,18 +179,208 @@ class NetworkThread(Thread):
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
         sock.bind((sn_setting('stream_ip'), sn_setting('stream_port')))
-        sock.listen(5)
+        sock.listen(self.listen_backlog())
 
         return sock
 
-    def receive_discovery(self, conn):
+    def listen_backlog(self):
+        """
+        Return how many incoming connections can wait to be accepted on our
+        server socket. In a full mesh every other host on the network might
+        connect to us at once, so this is as large as the system allows; in
+        the overlay, only a few hosts connect to each one.
+        """
+        if sn_setting('overlay_neighbours') > 0:
+            return max(16, 4 * sn_setting('overlay_neighbours'))
+
+        return socket.SOMAXCONN
+
+    def make_wakeup_sockets(self):
+        """
+        Create and return a connected pair of sockets that are used to wake the
+        network thread out of a select() call. The first socket is the one we
+        select on, and the second is written to by anyone that wants the
+        thread to wake up, such as when a message has been queued.
+        """
+        recv_sock, send_sock = socket.socketpair()
+        recv_sock.setblocking(False)
+        send_sock.setblocking(False)
+
+        return recv_sock, send_sock
+
+    def wakeup(self):
+        """
+        Wake the network thread up if it is currently blocked in select(), so
+        that it notices new outgoing data or connections right away instead of
+        when the select() timeout next expires. This is safe to call from any
+        thread; multiple calls before the thread wakes collapse into one.
+        """
+        if self.wakeup_pending:
+            return
+
+        self.wakeup_pending = True
+        try:
+            self.wakeup_send.send(b'\0')
+
+        # If the socket buffer is full, there are already wakeups pending.
+        except (BlockingIOError, OSError):
+            pass
+
+    def drain_wakeup(self, sock):
+        """
+        Handle the wakeup socket selecting as readable by throwing away all of
+        the pending wakeup data.
+
+        The pending flag is only cleared once the socket is empty; clearing it
+        first would let a wakeup raised while we're draining have its data
+        thrown away while leaving the flag set, after which no wakeup would
+        ever send anything again. A wakeup that is skipped because the flag is
+        still set doesn't need to send anything, since whatever it was raised
+        for was queued before it and is handled the next time through the
+        loop.
+        """
+        try:
+            while sock.recv(1024):
+                pass
+
+        except (BlockingIOError, OSError):
+            pass
+
+        self.wakeup_pending = False
+
+    def call_soon(self, callback, *args):
+        """
+        Arrange for the provided callback to be invoked with the given
+        arguments in the network thread, the next time through the loop. This
+        is used by other threads to hand off work that should not be done
+        there, such as encoding messages for transmission.
+
+        Callbacks are invoked in the order they were added.
+        """
+        self.deferred.append((callback, args))
+        if current_thread() is not self:
+            self.wakeup()
+
+    def run_deferred(self):
+        """
+        Invoke all of the callbacks that were handed to call_soon() before
+        this call started; anything added while they run waits until the next
+        time through the loop so that socket I/O can't be starved.
+        """
+        for _ in range(len(self.deferred)):
+            callback, args = self.deferred.popleft()
+            try:
+                callback(*args)
+
+            except Exception as e:
+                log("Error in deferred network call: {}", e)
+
+    def call_later(self, delay, callback, *args):
+        """
+        Arrange for the provided callback to be invoked with the given
+        arguments in the network thread once the given number of seconds have
+        passed, returning a Timer that can be used to cancel it.
+
+        This must only be called from the network thread; other threads can
+        use call_soon() to get there first.
+        """
+        return self.timers.call_later(delay, callback, *args)
+
+    def update_interest(self, conn):
+        """
+        Indicate that the set of events the given connection is interested in
+        may have changed, such as a new connection being created or its send
+        queue going from empty to non-empty or back again.
+
+        When called from the network thread the change is applied right away;
+        otherwise it's queued up and the network thread is woken to apply it.
+        """
+        if current_thread() is self:
+            return self.sync_interest(conn)
+
+        with self.interest_lock:
+            self.interest_changes.add(conn)
+
+        self.wakeup()
+
+    def apply_interest_changes(self):
+        """
+        Apply all of the interest changes that other threads have posted since
+        the last time through the loop.
+        """
+        with self.interest_lock:
+            changes = self.interest_changes
+            self.interest_changes = set()
+
+        for conn in changes:
+            self.sync_interest(conn)
+
+    def sync_interest(self, conn):
+        """
+        Bring the selector registration for the provided connection into line
+        with the events that it currently wants to know about. This must only
+        be called from the network thread.
+        """
+        events = conn._interest()
+        if events == conn.selected_events:
+            return
+
+        if not conn.selected_events:
+            self.selector.register(conn, events)
+        elif not events:
+            self.selector.unregister(conn)
+        else:
+            self.selector.modify(conn, events)
+
+        conn.selected_events = events
+
+    def forget(self, conn):
+        """
+        Remove the provided connection from the selector entirely. This needs
+        to happen before the socket is closed, since the file descriptor may
+        be reused by the next socket that is created.
+        """
+        if conn.selected_events:
+            try:
+                self.selector.unregister(conn)
+            except (KeyError, ValueError):
+                pass
+
+            conn.selected_events = 0
+
+    def receive_discovery(self, sock):
         """
         Handle an incoming data read on our discovery socket. This gets called
         when the discovery UDP socket selects as readable.
+
+        All of the waiting datagrams are handled, up to a limit so that a
+        flood of them can't hold up the rest of the loop; any left over are
+        handled the next time through.
         """
-        data, addr = conn.recvfrom(10240)
-        msg = ProtocolMessage.from_data(data, True)
+        for _ in range(self.max_datagrams):
+            try:
+                data, addr = sock.recvfrom(10240)
+            except BlockingIOError:
+                return
+
+            try:
+                msg = ProtocolMessage.from_data(data, True)
+            except (ValueError, struct.error) as e:
+                log("Ignoring invalid discovery packet from {}: {}", addr[0], e)
+                continue
+
+            # Only Introductions are ever sent to the discovery port.
+            if not isinstance(msg, IntroductionMessage):
+                log("Ignoring unexpected discovery packet from {}: {}", addr[0], msg)
+                continue
+
+            self.discovered(msg, addr)
 
+    def discovered(self, msg, addr):
+        """
+        Handle an Introduction that was multicast by a host on the network,
+        connecting to it if we're not already.
+        """
         # log('Discovery from: {} : {}', repr(addr), str(msg))
 
         # If this message was broadcast by us, we don't need to handle it
@@ -127,7 +396,7 @@ class NetworkThread(Thread):
         #
         # In the future, we can respond to an older protocol by either refusing
         # to connect or by adapting our communications to the older protocol.
-        if msg.protocol_version != 1:
+        if msg.protocol_version != IntroductionMessage.protocol_version:
             # log('Discovery host is running a different protocol: {}', addr)
             return
 
@@ -139,42 +408,155 @@ class NetworkThread(Thread):
             # log('Discovery host already connected: {}', addr)
             return
 
-        # We should try to connect to this host; once we do, send an
-        # introduction message to the other side so they know who we are.
-        conn = self.manager.connect(msg.ip, msg.port)
-        conn.hostname = msg.hostname
-        conn.send(self.broadcast_msg)
+        # In the overlay, we only connect to a limited number of hosts.
+        if not self.manager.overlay.wants_neighbours():
+            return
 
-        # Sync our cliboard history to the remote end
-        self.transmit_clipboard_history(conn)
+        # We should try to connect to this host, and also let it know about us
+        # directly, in case it can't connect back to us or our connection
+        # attempt fails; it would otherwise have to wait for our next
+        # broadcast to find out about us.
+        self.manager.dialer.request(msg.ip, msg.port, msg.hostname)
+        self.schedule_reply(addr[0])
 
-    def handle_incoming_peer(self, conn):
+    def dial(self, ip, port, hostname=None):
         """
-        Handle an incoming connection request for a peer. This gets called when
-        the server socket selects as readable, indicating that a new connection
-        is pending.
+        Connect to the host at the provided ip and port, which is known by the
+        given hostname if one is provided.
         """
-        client, addr = conn.accept()
-        conn = self.manager._add_connection(client, addr[0], addr[1])
+        conn = self.manager.connect(ip, port)
+        if hostname is not None:
+            conn.hostname = hostname
+            self.registry.reindex(conn)
 
-        # Sync our cliboard history to the remote end
-        self.transmit_clipboard_history(conn)
+        return conn
 
-    def transmit_clipboard_history(self, conn):
-        if not sn_setting('sync_paste_history'):
+    def schedule_reply(self, ip):
+        """
+        Arrange to send our Introduction directly to the discovery socket of
+        the host with the given ip after a random delay, so that a burst of
+        hosts all replying to the same broadcast don't do so all at once. This
+        does nothing if we replied to this host recently.
+        """
+        now = timer()
+        last = self.last_replies.get(ip)
+        if last is not None and now - last < self.reply_interval:
             return
 
-        history = g_clipboard_history.get()
-        if not history:
-            log('Clipboard history is empty; cannot sync', panel=True)
-        else:
-            for idx, entry in enumerate(history):
-                msg= ClipboardHistoryMessage(idx + 1, len(history), entry[1])
-                conn.send(msg)
+        self.last_replies = {host: when for host, when in self.last_replies.items()
+                                 if now - when < self.reply_interval}
+        self.last_replies[ip] = now
+
+        self.call_later(random.uniform(0, self.reply_jitter), self.send_reply, ip)
+
+    def send_reply(self, ip):
+        """
+        Send our Introduction directly to the discovery socket of the host
+        with the given ip.
+        """
+        try:
+            self.discovery_socket.sendto(self.discovery_packet,
+                                         (ip, sn_setting('discovery_port')))
+        except OSError as e:
+            log("Unable to reply to discovery from {}: {}", ip, e)
+
+    def send_broadcast(self):
+        """
+        Multicast our Introduction to announce that we're here, then schedule
+        the next broadcast, backing off a little further each time.
+        """
+        try:
+            self.discovery_socket.sendto(self.discovery_packet,
+                                         (sn_setting('discovery_group'), sn_setting('discovery_port')))
+        except OSError as e:
+            log("Unable to send discovery broadcast: {}", e)
+
+        self.broadcast_timer = self.call_later(self.broadcast_interval, self.send_broadcast)
+        self.broadcast_interval = min(self.broadcast_interval * 2, sn_setting('broadcast_time'))
+
+    def peers_changed(self):
+        """
+        Called whenever a connection is made or lost; while the set of hosts
+        is changing we broadcast more often, so that hosts find each other
+        quickly. This is safe to call from any thread.
+        """
+        if current_thread() is not self:
+            return self.call_soon(self.peers_changed)
+
+        self.broadcast_interval = self.min_broadcast_interval
+        if (self.broadcast_timer is not None and
+                self.broadcast_timer.deadline - timer() > self.broadcast_interval):
+            self.broadcast_timer.cancel()
+            self.broadcast_timer = self.call_later(self.broadcast_interval, self.send_broadcast)
+
+    def watch_connect(self, conn):
+        """
+        Give up on the provided outgoing connection if it has not connected
+        within the configured timeout.
+        """
+        self.call_later(sn_setting('connect_timeout'), self.connect_timed_out, conn)
+
+    def connect_timed_out(self, conn):
+        """
+        Called when the connect timeout for the provided connection expires;
+        if it's still trying to connect, it's closed.
+        """
+        if conn.socket is not None and not conn.connected:
+            log("Connection to {}:{} timed out", conn.ip, conn.port)
+            conn._raise(NetworkEvent.CONNECTION_FAILED)
+            conn.close()
+
+    def peer_list_received(self, connection, msg):
+        """
+        Handle the list of hosts that the remote end of a connection is
+        connected to by connecting to all of the ones we're not already
+        connected to; in the overlay, we connect to a random selection of
+        them until we have enough neighbours.
+        """
+        for ip, port, instance_id in random.sample(msg.peers, len(msg.peers)):
+            if not self.manager.overlay.wants_neighbours():
+                return
+
+            if instance_id == self.broadcast_msg.instance_id:
+                continue
+
+            if instance_id and self.manager.find_connection(instance_id=instance_id):
+                continue
+
+            if self.manager.find_connection(ip, port):
+                continue
+
+            self.manager.dialer.request(ip, port)
+
+    def handle_incoming_peer(self, sock):
+        """
+        Handle an incoming connection request for a peer. This gets called when
+        the server socket selects as readable, indicating that a new connection
+        is pending.
+
+        All of the pending connections are accepted, up to a limit so that a
+        burst of them can't hold up the rest of the loop; any left over are
+        accepted the next time through.
+        """
+        for _ in range(self.max_accepts):
+            try:
+                client, addr = sock.accept()
+            except BlockingIOError:
+                return
+
+            # Accepted sockets don't inherit non-blocking mode.
+            client.setblocking(False)
+            self.accepted(client, addr)
 
-            log(f'Transmitted {len(history)} clipboard entries', panel=True)
+    def accepted(self, client, addr):
+        """
+        Set up a connection for a socket that we have just accepted.
+        """
+        conn = self.manager._add_connection(client, addr[0], addr[1])
 
-        display_output_panel(is_error=False)
+        # Introduce ourselves in return, so that the other end knows what we
+        # are capable of.
+        conn.send(self.broadcast_msg)
 
     def run(self):
         """
@@ -182,58 +564,56 @@ class NetworkThread(Thread):
         the appropriate handlers as socket events occur. The main loop waits on
         a semaphore that tells if it it should terminate itself, at which point
         the loop will break.
+
+        Everything that happens on a schedule (such as discovery broadcasts)
+        is a timer, so when nothing is going on the loop sleeps until the next
+        timer is due instead of waking up periodically to check.
         """
         log("== Entering network loop")
 
-        # Start with no known broadcast so we do so right away; after that
-        # we'll go timed.
-        last_broadcast = None
+        # Announce ourselves right away; after that we'll go timed.
+        self.send_broadcast()
 
-        discovery = self.broadcast_msg.encode()
-        broadcast_addr = (sn_setting('discovery_group'), sn_setting('discovery_port'))
-        broadcast_delay = sn_setting('broadcast_time')
+        # Our own sockets are always interested in being readable, so they can
+        # be registered once up front; the data on the key is the handler.
+        self.selector.register(self.discovery_socket, selectors.EVENT_READ, self.receive_discovery)
+        self.selector.register(self.server_socket, selectors.EVENT_READ, self.handle_incoming_peer)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, self.drain_wakeup)
 
         while not self.event.is_set():
-            tick = timer()
-
-            with self.conn_lock:
-                readable = [c for c in self.connections if c.connected]
-                writable = [c for c in self.connections if c._is_writeable()]
-
-            # Add in our server sockets so that we know when a broadcast
-            # arrives or when someone is trying to connect to us.
-            readable.extend([self.discovery_socket, self.server_socket])
-
-            # This can't happen because of our server sockets, so this is a
-            # reminder that if you select on nothing, the timeout expires
-            # instantly. Goodbye, CPU...
-            if not readable and not writable:
-                log("*** Network thread has no connections to service")
-                time.sleep(0.25)
-                continue
-
-            rset, wset, _ = select.select(readable, writable, [], 0.25)
-
-            for conn in rset:
-                # Was a broadcast seen?
-                if conn == self.discovery_socket:
-                    self.receive_discovery(conn)
-
-                # Is there a new potential incoming connection?
-                elif conn == self.server_socket:
-                    self.handle_incoming_peer(conn)
-
-                # It's just a regular connection
-                else:
+            self.run_deferred()
+            self.apply_interest_changes()
+            self.timers.run(timer())
+
+            # If the deferred calls queued up more work, don't wait to do it;
+            # otherwise sleep until the next timer is due, if there is one.
+            timeout = 0 if self.deferred else self.timers.timeout(timer())
+
+            for key, events in self.selector.select(timeout):
+                # One of our own sockets; let the registered handler deal
+                # with it. A failure in one of them must not take the whole
+                # network thread down with it.
+                if key.data is not None:
+                    try:
+                        key.data(key.fileobj)
+
+                    except Exception as e:
+                        log("Error in network socket handler: {}", e)
+
+                    continue
+
+                # It's just a regular connection; the receive can close it,
+                # in which case the send will do nothing.
+                conn = key.fileobj
+                if events & selectors.EVENT_READ:
                     conn._receive()
 
-            for conn in wset:
-                conn._send()
+                if events & selectors.EVENT_WRITE:
+                    conn._send()
 
-            if last_broadcast is None or tick - last_broadcast > broadcast_delay:
-                self.discovery_socket.sendto(discovery, broadcast_addr)
-                last_broadcast = tick
+            self.manager.transfers.pump()
 
+        self.selector.close()
         log("== Network thread is gracefully ending")
 
 
@@ -14,12 +14,32 @@ def loaded():
     sn_setting.default = {
         'auto_show_panel': 2,
         'sync_paste_history': True,
+        'event_time_budget': 5,
         'broadcast_time': 30,
+        'connect_timeout': 10,
+        'connect_jitter': 0.5,
+        'max_pending_connects': 8,
+        'peer_expiry': 604800,
+        'heartbeat_interval': 15,
+        'heartbeat_misses': 3,
+        'overlay_neighbours': 0,
+        'overlay_ttl': 8,
         'discovery_group': '224.1.1.1',
         'discovery_port': 4377,
         'discovery_ttl': 1,
         'stream_ip': '',
         'stream_port': 4377,
+        'send_queue_high_water': 8388608,
+        'send_queue_low_water': 1048576,
+        'send_queue_limit': 67108864,
+        'file_chunk_size': 65536,
+        'fragment_size': 65536,
+        'compression': True,
+        'compression_threshold': 256,
+        'compression_dictionary': True,
+        'content_offer_threshold': 4096,
+        'content_cache_size': 16777216,
+        'max_frame_size': 134217728,
     }
 
 
@@ -0,0 +1,161 @@
+"""
+Compare the bytes sent on the wire and the end to end latency with message
+compression turned off, turned on, and turned on with the shared clipboard
+dictionary.
+
+For each setting, two nodes are connected over loopback, and one of them
+sends the other:
+
+- snippets: a series of code snippets (cut from this package's own source) as
+  clipboard updates, one at a time.
+- file: a large source file (the package's source repeated to 4MB) as a
+  FileContent message.
+
+The bytes are the raw and on the wire sizes of what the sending connection
+sent for each, and the latency runs from handing the message over until the
+other node's network thread has decoded it. Streamed file transfers (see
+ConnectionManager.send_file()) are never compressed, so they aren't covered.
+
+Usage: python tools/bench_compression.py
+"""
+import glob
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import harness
+
+from SubliNet.src.network import ClipboardMessage, ConnectionManager, NetworkEvent
+from SubliNet.src.network.messages import FileContentMessage
+
+
+### ---------------------------------------------------------------------------
+
+
+# Maps a key for each message to when a network thread decoded it.
+received = dict()
+
+
+def _key(msg):
+    text = getattr(msg, "text", None) or getattr(msg, "file_content", None) or ""
+    return (type(msg).__name__, len(text), text[:64])
+
+
+def _queue_event(queue_event):
+    def wrapper(self, connection, event, extra):
+        if event == NetworkEvent.MESSAGE:
+            received.setdefault(_key(extra), time.perf_counter())
+        return queue_event(self, connection, event, extra)
+
+    return wrapper
+
+
+def snippets(count=200):
+    """
+    Return a list of code snippets of a couple of hundred bytes to a couple of
+    kilobytes, made of consecutive lines of this package's source.
+    """
+    root = os.path.join(harness.ROOT, "src")
+    lines = list()
+    for path in sorted(glob.glob(os.path.join(root, "**", "*.py"), recursive=True)):
+        with open(path, encoding="utf-8") as file:
+            lines.extend(file.readlines())
+
+    result = list()
+    snippet = ""
+    for line in lines:
+        snippet += line
+        if len(snippet) >= 200 + len(result) * 397 % 1800:
+            result.append(snippet)
+            snippet = ""
+            if len(result) == count:
+                break
+
+    return result
+
+
+def _wait(msg, start):
+    key = _key(msg)
+    while key not in received and time.perf_counter() - start < 10:
+        time.sleep(0.0001)
+
+    return received.pop(key, start + 10) - start
+
+
+def run(name, port, settings, texts, file_path):
+    sender = harness.node(port, heartbeat_interval=0, sync_paste_history=False,
+                          broadcast_time=3600, content_offer_threshold=1 << 30, **settings)
+    receiver = harness.node(port + 1, heartbeat_interval=0, sync_paste_history=False,
+                            broadcast_time=3600, content_offer_threshold=1 << 30, **settings)
+    try:
+        sender._defer(sender.net_thread.dial, "127.0.0.1", port + 1)
+        harness.pump(0.5)
+        connection = harness.live(sender)[0]
+
+        def sent():
+            stats = connection.compression_stats()
+            return stats["raw_bytes"], stats["wire_bytes"]
+
+        raw, wire = sent()
+        latencies = list()
+        for text in texts:
+            msg = ClipboardMessage(text)
+            start = time.perf_counter()
+            sender.broadcast(msg)
+            latencies.append(_wait(msg, start))
+            harness.pump()
+
+        after_raw, after_wire = sent()
+        print("{:<12} snippets {:9} bytes raw, {:9} on the wire ({:5.1%}), "
+              "latency p50 {:6.2f}ms p90 {:6.2f}ms".format(
+                name, after_raw - raw, after_wire - wire, (after_wire - wire) / (after_raw - raw),
+                1000 * statistics.median(latencies),
+                1000 * sorted(latencies)[int(len(latencies) * 0.9)]))
+
+        raw, wire = after_raw, after_wire
+        msg = FileContentMessage(os.path.dirname(file_path), os.path.basename(file_path))
+        with open(file_path, encoding="utf-8") as file:
+            expected = FileContentMessage(None, None, False)
+            expected.file_content = file.read()
+
+        start = time.perf_counter()
+        connection.send(msg)
+        latency = _wait(expected, start)
+        harness.pump(0.1)
+
+        after_raw, after_wire = sent()
+        print("{:<12} file     {:9} bytes raw, {:9} on the wire ({:5.1%}), "
+              "latency {:8.2f}ms".format(
+                name, after_raw - raw, after_wire - wire, (after_wire - wire) / (after_raw - raw),
+                1000 * latency))
+
+    finally:
+        harness.shutdown([sender, receiver])
+
+
+def main(base_port=45700):
+    ConnectionManager._queue_event = _queue_event(ConnectionManager._queue_event)
+
+    texts = snippets()
+    source = "".join(snippets(None))
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, "source.py")
+        with open(file_path, "w", encoding="utf-8") as file:
+            for _ in range(4 * 1024 * 1024 // len(source) + 1):
+                file.write(source)
+
+        print("{} snippets of {} bytes on average, and a {} byte file".format(
+            len(texts), sum(map(len, texts)) // len(texts), os.path.getsize(file_path)))
+
+        run("off", base_port, dict(compression=False), texts, file_path)
+        run("zlib", base_port + 2, dict(compression=True, compression_dictionary=False),
+            texts, file_path)
+        run("dictionary", base_port + 4, dict(compression=True, compression_dictionary=True),
+            texts, file_path)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,182 @@
+"""
+Measure how broadcasting from another thread and the network loop get in
+each other's way, with a node servicing a large number of connections.
+
+The connections (200 by default) come from plain loopback sockets that
+introduce themselves to the node and then read and discard everything that
+it sends them; they don't accept compressed messages, so that the network
+loop only has sending to do, since messages are compressed separately for
+each connection. One thread then calls broadcast_encoded() with a clipboard
+update, which takes a snapshot of the connections and queues the update on
+each of them, while the network loop sends it; first as fast as it can, and
+then a hundred times a second. This records how long each broadcast call
+takes and how long each pass of the network loop takes (from select()
+returning until it is called again), and compares the loop with how it does
+with nothing being broadcast.
+
+All of the threads share the interpreter lock, so when broadcasting as fast
+as possible, most of what the loop waits for is its turn to run.
+
+With --locked, the broadcasting thread holds a lock while it broadcasts and
+the network loop takes the same lock on every pass, the way both used to
+take the connection lock, for comparison.
+
+Usage: python tools/bench_contention.py [--locked] [connections] [seconds]
+"""
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+
+import harness
+
+from SubliNet.src.network import ClipboardMessage
+
+
+### ---------------------------------------------------------------------------
+
+
+def _report(name, samples):
+    samples = sorted(samples)
+    print("{:<20} {:8} calls  p50 {:8.1f}us  p99 {:8.1f}us  max {:8.1f}us".format(
+        name, len(samples), 1e6 * samples[len(samples) // 2],
+        1e6 * samples[min(int(len(samples) * 0.99), len(samples) - 1)], 1e6 * samples[-1]))
+
+
+def _introduce(hub, sock, idx):
+    """
+    Introduce the client on the given socket to the hub as a host of its own,
+    which doesn't accept compressed messages.
+    """
+    msg = hub.net_thread.broadcast_msg
+    features = msg.features & ~(msg.FEATURE_ZLIB | msg.FEATURE_DICTIONARY)
+    msg = type(msg)(msg.user, msg.password, "127.0.0.1", 1024 + idx, "client%d" % idx,
+                    features=features, subscriptions=msg.subscriptions,
+                    max_frame=msg.max_frame, instance_id=os.urandom(16))
+    sock.sendall(msg.encode())
+
+
+def main(count=200, seconds=3, port=45900, locked=False):
+    harness.raise_file_limit(count)
+
+    hub = harness.node(port, heartbeat_interval=0, broadcast_time=3600,
+                       sync_paste_history=False, content_offer_threshold=1 << 30)
+    clients = list()
+    stop = threading.Event()
+    drained = [0]
+
+    def drain():
+        selector = selectors.DefaultSelector()
+        for client in clients:
+            client.setblocking(False)
+            selector.register(client, selectors.EVENT_READ)
+
+        while not stop.is_set():
+            for key, _ in selector.select(0.1):
+                try:
+                    drained[0] += len(key.fileobj.recv(1 << 16))
+                except BlockingIOError:
+                    pass
+
+        selector.close()
+
+    drainer = threading.Thread(target=drain)
+    try:
+        for idx in range(count):
+            client = socket.create_connection(("127.0.0.1", port))
+            _introduce(hub, client, idx)
+            clients.append(client)
+
+        drainer.start()
+
+        start = time.monotonic()
+        while len(harness.live(hub)) < count and time.monotonic() - start < 10:
+            harness.pump(0.01)
+
+        print("{} connections{}".format(len(harness.live(hub)),
+                                        ", locked" if locked else ""))
+
+        lock = threading.Lock()
+        thread = hub.net_thread
+        passes = list()
+        resumed = [None]
+        untimed_select = thread.selector.select
+
+        def timed_select(timeout=None):
+            if resumed[0] is not None:
+                passes.append(time.perf_counter() - resumed[0])
+
+            events = untimed_select(timeout)
+            resumed[0] = time.perf_counter()
+            if locked:
+                with lock:
+                    hub.registry.snapshot()
+
+            return events
+
+        thread.selector.select = timed_select
+
+        # The network loop on its own, woken up as often as it is while
+        # there are broadcasts to send.
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            thread.call_soon(lambda: None)
+            time.sleep(0.0001)
+
+        _report("idle loop pass", passes[1:])
+
+        msg = ClipboardMessage("x" * 1024)
+        data = msg.encode()
+
+        def broadcast(name, interval):
+            calls = list()
+
+            def hammer():
+                deadline = time.monotonic() + seconds
+                while time.monotonic() < deadline:
+                    before = time.perf_counter()
+                    if locked:
+                        lock.acquire()
+                    hub.broadcast_encoded(data, policy=msg.delivery_policy,
+                                          msg_id=msg.msg_id(), stream=msg.stream)
+                    if locked:
+                        lock.release()
+                    calls.append(time.perf_counter() - before)
+                    if interval:
+                        time.sleep(max(0, interval - (time.perf_counter() - before)))
+
+            del passes[:]
+            resumed[0] = None
+            sent = drained[0]
+            broadcaster = threading.Thread(target=hammer)
+            broadcaster.start()
+            broadcaster.join()
+            sent = drained[0] - sent
+
+            print("{}: {:,.0f} broadcasts/s; {:.1f}MB/s read by the clients".format(
+                name, len(calls) / seconds, sent / seconds / 1e6))
+            _report("broadcast call", calls)
+            _report("busy loop pass", passes[1:])
+
+        broadcast("As fast as possible", 0)
+        broadcast("Paced", 0.01)
+
+        thread.selector.select = untimed_select
+
+    finally:
+        stop.set()
+        if drainer.is_alive():
+            drainer.join()
+
+        for client in clients:
+            client.close()
+
+        harness.shutdown([hub])
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    locked = "--locked" in args
+    main(*map(int, [arg for arg in args if arg != "--locked"]), locked=locked)
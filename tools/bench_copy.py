@@ -0,0 +1,102 @@
+"""
+Measure how long a copy holds up the main thread, for clipboards of several
+sizes.
+
+A node is connected to a peer over loopback and made the package's network
+manager, and then the event listener is told that a copy happened, the way
+Sublime tells it, with the clipboard holding text of each size in turn. This
+records how long on_post_text_command() takes in the main thread, both in
+wall time (which includes waiting for the network thread to let go of the
+interpreter lock) and in CPU time, and how long it takes for the peer to have
+the text.
+
+For comparison, it also times encoding the same clipboard message in the
+main thread, which is what used to happen there.
+
+Usage: python tools/bench_copy.py [copies per size]
+"""
+import statistics
+import sys
+import time
+
+import harness
+
+from SubliNet.src import core
+from SubliNet.src.eventhandler import SubliNetEventListener
+from SubliNet.src.network import ClipboardMessage
+from SubliNet.src.network.content import ContentExchange
+
+
+### ---------------------------------------------------------------------------
+
+
+# Maps the text of each clipboard update to when the peer decoded it.
+received = dict()
+
+
+def _content_received(content_received):
+    def wrapper(self, connection, msg):
+        received.setdefault(msg.text, time.perf_counter())
+        return content_received(self, connection, msg)
+
+    return wrapper
+
+
+def main(copies=10, base_port=45600):
+    ContentExchange.content_received = _content_received(ContentExchange.content_received)
+
+    overrides = dict(heartbeat_interval=0, sync_paste_history=False, broadcast_time=3600)
+    sender = harness.node(base_port, **overrides)
+    receiver = harness.node(base_port + 1, **overrides)
+    try:
+        sender._defer(sender.net_thread.dial, "127.0.0.1", base_port + 1)
+        harness.pump(0.5)
+
+        core._manager = sender
+        listener = SubliNetEventListener()
+
+        for size in (1024, 1024 * 1024, 10 * 1024 * 1024):
+            handler = list()
+            cpu = list()
+            delivered = list()
+            encoding = list()
+            for idx in range(copies):
+                # Every copy is different, so that the peer can't already
+                # have it.
+                text = "%08d" % idx + "x" * (size - 8)
+                harness.clipboard.append(text)
+
+                start = time.perf_counter()
+                start_cpu = time.thread_time()
+                listener.on_post_text_command(None, "copy", {})
+                cpu.append(time.thread_time() - start_cpu)
+                handler.append(time.perf_counter() - start)
+
+                while text not in received and time.perf_counter() - start < 10:
+                    harness.pump(0.001)
+
+                if text not in received:
+                    print("copy of {} bytes was not delivered".format(size))
+                    return False
+
+                delivered.append(received.pop(text) - start)
+
+                start = time.perf_counter()
+                ClipboardMessage(text).encode()
+                encoding.append(time.perf_counter() - start)
+
+            print("{:>9} bytes: main thread {:7.3f}ms ({:7.3f}ms CPU), delivered {:8.3f}ms, "
+                  "encoding would take {:7.3f}ms (medians)".format(
+                    size, 1000 * statistics.median(handler), 1000 * statistics.median(cpu),
+                    1000 * statistics.median(delivered),
+                    1000 * statistics.median(encoding)))
+
+        return True
+
+    finally:
+        core._manager = None
+        harness.shutdown([sender, receiver])
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(*map(int, sys.argv[1:])) else 1)
@@ -0,0 +1,100 @@
+"""
+Measure how much CPU time each pass of the network loop takes while a node
+holds a large number of idle connections.
+
+The connections come from plain loopback sockets that connect to the node and
+then never send anything. The network thread is woken up every millisecond
+(which is what happens when messages are queued), and the CPU time that its
+thread uses for each pass of the loop, including the select() call itself, is
+recorded.
+
+For comparison, the same is measured for what each pass used to do: build
+lists of the readable and writable connections and select() on all of them.
+
+Usage: python tools/bench_idle.py [connections] [passes]
+"""
+import select
+import socket
+import sys
+import time
+
+import harness
+
+
+### ---------------------------------------------------------------------------
+
+
+def _report(name, samples):
+    samples = sorted(samples)
+    print("{:<24} mean {:7.1f}us  p50 {:7.1f}us  p99 {:7.1f}us".format(
+        name, 1e6 * sum(samples) / len(samples), 1e6 * samples[len(samples) // 2],
+        1e6 * samples[min(int(len(samples) * 0.99), len(samples) - 1)]))
+
+
+def main(count=500, passes=2000, port=45500):
+    harness.raise_file_limit(count)
+
+    node = harness.node(port, heartbeat_interval=0, broadcast_time=3600)
+    clients = list()
+    try:
+        for _ in range(count):
+            clients.append(socket.create_connection(("127.0.0.1", port)))
+
+        start = time.monotonic()
+        while len(node.registry) < count and time.monotonic() - start < 10:
+            time.sleep(0.01)
+
+        print("{} idle connections".format(len(node.registry)))
+
+        thread = node.net_thread
+        samples = list()
+        resumed = [None]
+
+        untimed_select = thread.selector.select
+
+        # Time spent blocked doesn't use any CPU, so the thread time from one
+        # select() returning to the next is what a whole pass costs.
+        def timed_select(timeout=None):
+            events = untimed_select(timeout)
+            now = time.thread_time()
+            if resumed[0] is not None:
+                samples.append(now - resumed[0])
+
+            resumed[0] = now
+            return events
+
+        thread.selector.select = timed_select
+        for _ in range(passes):
+            thread.call_soon(lambda: None)
+            time.sleep(0.001)
+
+        thread.selector.select = untimed_select
+        _report("selector loop pass", samples[1:])
+
+        # The same connections, handled the way the loop used to handle them.
+        connections = node.registry.snapshot()
+        baseline = list()
+        for _ in range(min(passes, 500)):
+            before = time.thread_time()
+            readable = [conn.socket for conn in connections if conn.socket]
+            writable = [conn.socket for conn in connections if conn._is_writeable()]
+            try:
+                select.select(readable, writable, [], 0)
+            except ValueError as e:
+                print("select() over every connection failed: {}".format(e))
+                break
+
+            baseline.append(time.thread_time() - before)
+
+        if baseline:
+            _report("select() over all", baseline)
+
+    finally:
+        for client in clients:
+            client.close()
+
+        harness.shutdown([node])
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
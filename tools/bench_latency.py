@@ -0,0 +1,113 @@
+"""
+Measure how long a copy takes to get onto the wire and over to a peer.
+
+Two nodes are connected over loopback, and one of them broadcasts a series of
+small clipboard updates, one at a time, from the main thread as a copy would.
+For each one this records when the frame has been written to the socket
+("wire") and when the network thread of the other node has decoded it
+("peer"), both measured from the broadcast() call.
+
+With --poll, the sending node's network thread is never woken up for new
+messages, and instead wakes up every 0.25 seconds, which is how the network
+loop worked before it had a wakeup channel.
+
+Usage: python tools/bench_latency.py [--poll] [copies] [size]
+"""
+import random
+import sys
+import time
+
+import harness
+
+from SubliNet.src.network import ClipboardMessage
+from SubliNet.src.network.content import ContentExchange
+
+
+### ---------------------------------------------------------------------------
+
+
+# Maps the text of each clipboard update to when the peer decoded it.
+received = dict()
+
+
+def _content_received(content_received):
+    def wrapper(self, connection, msg):
+        received.setdefault(msg.text, time.perf_counter())
+        return content_received(self, connection, msg)
+
+    return wrapper
+
+
+def _percentiles(name, values):
+    values = sorted(values)
+    print("{:<6} p50 {:8.3f}ms  p90 {:8.3f}ms  p99 {:8.3f}ms  max {:8.3f}ms".format(
+        name, *(1000 * values[min(int(len(values) * fraction), len(values) - 1)]
+                for fraction in (0.5, 0.9, 0.99, 1))))
+
+
+def main(copies=200, size=100, poll=False, base_port=45400):
+    ContentExchange.content_received = _content_received(ContentExchange.content_received)
+
+    overrides = dict(heartbeat_interval=0, sync_paste_history=False, broadcast_time=3600)
+    sender = harness.node(base_port, **overrides)
+    receiver = harness.node(base_port + 1, **overrides)
+    try:
+        sender._defer(sender.net_thread.dial, "127.0.0.1", base_port + 1)
+        harness.pump(0.5)
+
+        connection = harness.live(sender)[0]
+        written = list()
+
+        def write(sock, write=connection.writer.write):
+            count = write(sock)
+            if not connection.writer.pending():
+                written.append(time.perf_counter())
+            return count
+
+        connection.writer.write = write
+
+        if poll:
+            def tick():
+                sender._call_later(0.25, tick)
+
+            sender._defer(tick)
+            harness.pump(0.1)
+            sender.net_thread.wakeup = lambda: None
+
+        wire = list()
+        peer = list()
+        for idx in range(copies):
+            text = "%08d" % idx + "x" * max(size - 8, 0)
+            del written[:]
+
+            start = time.perf_counter()
+            sender.broadcast(ClipboardMessage(text))
+            # The peer can decode the frame before the write it went out in
+            # has returned, so wait for both.
+            while (text not in received or not written) and time.perf_counter() - start < 2:
+                time.sleep(0.0001)
+
+            if text not in received or not written:
+                print("copy {} was not delivered".format(idx))
+                return False
+
+            wire.append(written[0] - start)
+            peer.append(received[text] - start)
+
+            # Copies happen at random, so they shouldn't fall in step with the
+            # polling interval.
+            time.sleep(random.uniform(0, 0.25) if poll else random.uniform(0.001, 0.005))
+
+        print("{} copies of {} bytes{}".format(copies, size, " (polling)" if poll else ""))
+        _percentiles("wire", wire)
+        _percentiles("peer", peer)
+        return True
+
+    finally:
+        harness.shutdown([sender, receiver])
+
+
+if __name__ == "__main__":
+    poll = "--poll" in sys.argv
+    args = [int(arg) for arg in sys.argv[1:] if arg != "--poll"]
+    sys.exit(0 if main(*args, poll=poll) else 1)
@@ -0,0 +1,86 @@
+"""
+Microbenchmark the connection registry with a large number of simulated
+peers, against a linear scan of a list of the same connections, which is how
+connections used to be found.
+
+The peers are plain objects with the attributes that the registry indexes;
+nothing here touches the network.
+
+Usage: python tools/bench_registry.py [peers]
+"""
+import os
+import sys
+import timeit
+
+import harness
+
+from SubliNet.src.network.registry import ConnectionRegistry
+
+
+### ---------------------------------------------------------------------------
+
+
+class Introduction():
+    def __init__(self, instance_id):
+        self.instance_id = instance_id
+
+
+class Peer():
+    def __init__(self, idx):
+        self.ip = "10.%d.%d.%d" % (idx >> 16 & 255, idx >> 8 & 255, idx & 255)
+        self.port = 4377
+        self.hostname = "host%d" % idx
+        self.introduction = Introduction(os.urandom(16))
+
+
+def report(name, seconds, count):
+    print("{:<24} {:8.2f}us".format(name, seconds / count * 1e6))
+
+
+def main(count=1000, rounds=20000):
+    peers = [Peer(idx) for idx in range(count)]
+
+    registry = ConnectionRegistry()
+    for peer in peers:
+        registry.add(peer)
+
+    target = peers[count // 2]
+    print("{} peers, {} rounds each".format(count, rounds))
+
+    report("find by ip", timeit.timeit(lambda: registry.find(ip=target.ip), number=rounds), rounds)
+    report("find by address", timeit.timeit(lambda: registry.find(ip=target.ip, port=target.port),
+                                            number=rounds), rounds)
+    report("find by hostname", timeit.timeit(lambda: registry.find(hostname=target.hostname),
+                                             number=rounds), rounds)
+    report("find by instance id", timeit.timeit(
+        lambda: registry.find(instance_id=target.introduction.instance_id), number=rounds), rounds)
+    report("snapshot", timeit.timeit(registry.snapshot, number=rounds), rounds)
+
+    def churn():
+        registry.remove(target)
+        registry.add(target)
+
+    report("remove and add", timeit.timeit(churn, number=rounds // 10), rounds // 10)
+
+    def churn_snapshot():
+        churn()
+        registry.snapshot()
+
+    report("remove, add, snapshot", timeit.timeit(churn_snapshot, number=rounds // 10),
+           rounds // 10)
+
+    report("reindex", timeit.timeit(lambda: registry.reindex(target), number=rounds // 10),
+           rounds // 10)
+
+    # What finding a connection by ip and removing one used to cost.
+    connections = list(peers)
+    report("linear scan by ip", timeit.timeit(
+        lambda: [conn for conn in connections if conn.ip == target.ip], number=rounds // 10),
+        rounds // 10)
+    report("linear remove", timeit.timeit(
+        lambda: [conn for conn in connections if conn is not target], number=rounds // 10),
+        rounds // 10)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,127 @@
+"""
+Compare sending a large file with file backed frames against sending it from
+memory, for throughput and peak memory use.
+
+A file (100MB by default) is sent over one end of a loopback socket pair
+while a thread drains the other end, in three ways:
+
+- sendfile: FileChunk frames made by file_frames(), as file transfers send
+  them, with the body of each chunk sent by os.sendfile().
+- mmap: the same frames, sent from a memory mapping of the file, which is
+  the fallback for platforms without sendfile().
+- memory: a FileContent message, which reads the whole file and encodes it
+  into a single frame, as files used to be sent.
+
+The time taken includes making the frames, so it covers reading the file for
+the message and hashing it for the chunks. Each way runs in a process of its
+own, so that the peak resident set size it reports is its own.
+
+This needs a Unix, for the resource module.
+
+Usage: python tools/bench_sendfile.py [megabytes]
+"""
+import hashlib
+import os
+import resource
+import select
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import harness
+
+from SubliNet.src.network.filetransfer import file_frames
+from SubliNet.src.network.framing import FileFrame, FrameWriter
+from SubliNet.src.network.messages import FileContentMessage
+from SubliNet.src.network.sendqueue import SendQueue
+
+
+### ---------------------------------------------------------------------------
+
+
+def _peak_rss():
+    """
+    Return the peak resident set size of this process in megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def send(mode, path):
+    """
+    Send the file at the given path in the given way, reporting the results;
+    this is run in a process of its own.
+    """
+    baseline = _peak_rss()
+    start = time.perf_counter()
+    send_queue = SendQueue(1 << 40, 1 << 40, 1 << 40)
+
+    if mode == "memory":
+        frame = FileContentMessage(os.path.dirname(path), os.path.basename(path)).encode()
+        send_queue.put(frame)
+        total = len(frame)
+        del frame
+    else:
+        FileFrame._has_sendfile = mode == "sendfile" and FileFrame._has_sendfile
+        total = 0
+        for _, frame in file_frames(path, 65536, b"\0" * 16, 0, hashlib.sha256()):
+            send_queue.put(frame)
+            total += len(frame)
+
+    writing, reading = socket.socketpair()
+    writing.setblocking(False)
+
+    def drain():
+        buffer = bytearray(1 << 20)
+        remaining = total
+        while remaining:
+            remaining -= reading.recv_into(buffer)
+
+    reader = threading.Thread(target=drain)
+    reader.start()
+
+    writer = FrameWriter()
+    while True:
+        writer.fill(send_queue)
+        if not writer.pending():
+            break
+
+        try:
+            writer.write(writing)
+        except BlockingIOError:
+            select.select([], [writing], [], 1)
+
+    reader.join()
+    elapsed = time.perf_counter() - start
+
+    print("{:<9} {:8.1f} MB/s  peak RSS {:6.1f}MB ({:+.1f}MB over the {:.1f}MB at start)".format(
+        mode, total / elapsed / 1e6, _peak_rss(), _peak_rss() - baseline, baseline))
+
+
+def main(megabytes=100):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "payload.txt")
+        with open(path, "wb") as file:
+            line = b"The quick brown fox jumps over the lazy dog.\n"
+            for _ in range(megabytes * 1024 * 1024 // len(line)):
+                file.write(line)
+
+        # Get the file into the page cache, so every way reads it from there.
+        with open(path, "rb") as file:
+            while file.read(1 << 20):
+                pass
+
+        print("Sending {}MB".format(megabytes))
+        for mode in ("sendfile", "mmap", "memory"):
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--send", mode, path],
+                           check=True)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--send"]:
+        send(*sys.argv[2:4])
+    else:
+        main(*map(int, sys.argv[1:]))
@@ -0,0 +1,124 @@
+"""
+Measure how many messages per second a single connection can send, and how
+many system calls that takes, with the vectored frame writer.
+
+A large number of small messages are queued up in a SendQueue and then
+written to one end of a loopback socket pair, the way a connection sends
+them, while a thread drains the other end. The same messages are also sent
+the way they used to be, one send() call per message with the unsent part of
+a message copied after a partial write, and with the writer's fallback for
+platforms without sendmsg().
+
+Usage: python tools/bench_writer.py [messages] [size]
+"""
+import select
+import socket
+import sys
+import threading
+import time
+
+import harness
+
+from SubliNet.src.network.framing import FrameWriter
+from SubliNet.src.network.sendqueue import SendQueue
+
+
+### ---------------------------------------------------------------------------
+
+
+class CountingSocket():
+    """
+    Wraps a socket, counting the calls made to send data on it.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def send(self, data):
+        self.calls += 1
+        return self.sock.send(data)
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        return self.sock.sendmsg(buffers)
+
+
+def _wait_writable(sock):
+    select.select([], [sock.sock], [], 1)
+
+
+def send_vectored(sock, send_queue, vectored=True):
+    writer = FrameWriter()
+    writer._has_sendmsg = vectored and FrameWriter._has_sendmsg
+    while True:
+        writer.fill(send_queue)
+        if not writer.pending():
+            return
+
+        try:
+            writer.write(sock)
+        except BlockingIOError:
+            _wait_writable(sock)
+            continue
+
+        if writer.blocked:
+            _wait_writable(sock)
+
+
+def send_each(sock, send_queue):
+    while True:
+        try:
+            data = send_queue.get_nowait()
+        except Exception:
+            return
+
+        while data:
+            try:
+                sent = sock.send(data)
+            except BlockingIOError:
+                _wait_writable(sock)
+                continue
+
+            data = data[sent:]
+
+
+def run(name, sender, count, size):
+    send_queue = SendQueue(1 << 40, 1 << 40, 1 << 40)
+    for idx in range(count):
+        send_queue.put(idx.to_bytes(4, "big") * (size // 4))
+
+    total = count * (size // 4) * 4
+    writing, reading = socket.socketpair()
+    writing.setblocking(False)
+
+    def drain():
+        buffer = bytearray(1 << 20)
+        remaining = total
+        while remaining:
+            remaining -= reading.recv_into(buffer)
+
+    reader = threading.Thread(target=drain)
+    reader.start()
+
+    sock = CountingSocket(writing)
+    start = time.perf_counter()
+    sender(sock, send_queue)
+    reader.join()
+    elapsed = time.perf_counter() - start
+
+    writing.close()
+    reading.close()
+
+    print("{:<20} {:10,.0f} messages/s  {:8.1f} MB/s  {:6} calls ({:.1f} messages each)".format(
+        name, count / elapsed, total / elapsed / 1e6, sock.calls, count / sock.calls))
+
+
+def main(count=200000, size=100):
+    print("{} messages of {} bytes".format(count, size))
+    run("sendmsg()", send_vectored, count, size)
+    run("send() fallback", lambda sock, q: send_vectored(sock, q, False), count, size)
+    run("send() per message", send_each, count, size)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
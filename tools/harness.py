@@ -0,0 +1,237 @@
+"""
+Run the SubliNet network code outside of Sublime Text, for the simulations
+and benchmarks in this directory.
+
+Importing this module installs minimal stand-ins for the parts of the
+sublime, sublime_plugin and Default.paste_from_history modules that the
+package uses, makes the package importable as SubliNet from this checkout
+and loads it, so scripts can then import anything from SubliNet.src.
+
+Callbacks that the package schedules with sublime.set_timeout() are run by
+pump() in whatever thread calls it, which stands in for the Sublime main
+thread. Settings come from the package defaults, overridden by whatever is
+put into the settings dictionary; they are read at the point of use, so
+changes affect managers created (or code run) after they are made.
+
+Files the package would store in the Sublime cache go in a temporary
+directory that is unique to each run.
+"""
+import heapq
+import importlib
+import itertools
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+
+
+### ---------------------------------------------------------------------------
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CACHE = tempfile.mkdtemp(prefix="sublinet-")
+
+# Setting overrides; see the module docstring.
+settings = dict()
+
+# Everything put on the clipboard, oldest first.
+clipboard = list()
+
+_timeouts = list()
+_timeout_lock = threading.Lock()
+_timeout_order = itertools.count()
+
+
+def set_timeout(callback, delay=0):
+    """
+    Schedule the callback to be invoked by pump() after the given delay in
+    milliseconds; this can be called from any thread.
+    """
+    with _timeout_lock:
+        heapq.heappush(_timeouts, (time.monotonic() + delay / 1000.0,
+                                   next(_timeout_order), callback))
+
+
+def pump(duration=0):
+    """
+    Invoke any scheduled callbacks that are due, for the given number of
+    seconds; with no duration, only the ones that are due right now are run.
+    """
+    end = time.monotonic() + duration
+    while True:
+        while True:
+            with _timeout_lock:
+                if not _timeouts or _timeouts[0][0] > time.monotonic():
+                    break
+
+                callback = heapq.heappop(_timeouts)[2]
+
+            callback()
+
+        if time.monotonic() >= end:
+            return
+
+        time.sleep(0.0005)
+
+
+### ---------------------------------------------------------------------------
+
+
+class _ClipboardHistory():
+    """
+    Stands in for the paste history of the Default package.
+    """
+    def __init__(self):
+        self.storage = list()
+
+    def push_text(self, text):
+        self.storage.insert(0, (text[:40], text))
+
+    def get(self):
+        return self.storage
+
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def _install():
+    """
+    Install the stand-in modules and load the package from this checkout.
+    """
+    class _Empty():
+        def __init__(self, *args, **kwargs):
+            pass
+
+    _module("sublime",
+            set_timeout=set_timeout,
+            set_timeout_async=set_timeout,
+            platform=lambda: sys.platform[:5],
+            cache_path=lambda: CACHE,
+            packages_path=lambda: os.path.dirname(ROOT),
+            windows=lambda: [],
+            active_window=lambda: None,
+            get_clipboard=lambda: clipboard[-1] if clipboard else "",
+            set_clipboard=clipboard.append,
+            error_message=lambda msg: print("error:", msg),
+            message_dialog=lambda msg: print("message:", msg),
+            load_settings=lambda name: settings,
+            Region=_Empty)
+
+    _module("sublime_plugin",
+            EventListener=_Empty,
+            TextCommand=_Empty,
+            WindowCommand=_Empty,
+            ApplicationCommand=_Empty)
+
+    _module("Default").__path__ = []
+    _module("Default.paste_from_history", g_clipboard_history=_ClipboardHistory())
+
+    _module("SubliNet").__path__ = [ROOT]
+    importlib.import_module("SubliNet.sublinet")
+
+    from SubliNet.src import utils
+    utils.loaded()
+
+
+_install()
+
+
+### ---------------------------------------------------------------------------
+
+
+from SubliNet.src.network import ConnectionManager, NetworkEvent
+
+
+def node(port, hostname=None, **overrides):
+    """
+    Create and start a connection manager that listens on the given loopback
+    port, with the provided settings overrides; the events it raises are
+    recorded as (connection, event, extra) tuples in its events list.
+
+    Each node gets a discovery port of its own (unless the overrides give
+    them a shared one), and its discovery broadcasts don't leave the host, so
+    nodes only connect where a script tells them to and never to real
+    instances on the network.
+
+    The node introduces itself with the given hostname, or that of this
+    machine if there isn't one. Nodes that are to find each other through
+    discovery need hostnames of their own, since hosts ignore broadcasts
+    that carry their own hostname.
+    """
+    settings.update({
+        "stream_ip": "127.0.0.1",
+        "stream_port": port,
+        "discovery_port": port + 10000,
+        "discovery_ttl": 0,
+        "connect_jitter": 0
+    })
+    settings.update(overrides)
+
+    # The hostname is looked up when the manager makes its Introduction.
+    getfqdn = socket.getfqdn
+    if hostname is not None:
+        socket.getfqdn = lambda name="": hostname
+
+    try:
+        manager = ConnectionManager()
+    finally:
+        socket.getfqdn = getfqdn
+
+    manager.events = list()
+    for event in NetworkEvent:
+        manager.add_handler("harness", event,
+                            lambda conn, event, extra, m=manager: m.events.append((conn, event, extra)))
+
+    manager.startup()
+    return manager
+
+
+def live(manager):
+    """
+    Return the connections of the given manager that are connected and whose
+    remote end has introduced itself.
+    """
+    return [conn for conn in manager.registry.snapshot()
+            if conn.socket is not None and conn.introduction is not None]
+
+
+def shutdown(managers):
+    """
+    Shut down all of the provided managers; their network threads are all
+    told to stop first, so that they wind down together.
+    """
+    for manager in managers:
+        manager.thr_event.set()
+        manager._wakeup()
+
+    for manager in managers:
+        manager.shutdown()
+
+
+### ---------------------------------------------------------------------------
+
+
+def raise_file_limit(count):
+    """
+    Raise the limit on open files (where there is one) so that there is room
+    for the given number of loopback connections, with both of their ends in
+    this process.
+    """
+    try:
+        import resource
+    except ImportError:
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = count * 2 + 256
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
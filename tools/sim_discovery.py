@@ -0,0 +1,106 @@
+"""
+Measure how long it takes hosts to form a full mesh through discovery, for
+meshes of several sizes.
+
+Every node listens on a loopback address of its own (127.0.0.1, 127.0.0.2
+and so on) with a hostname of its own, and starts out knowing about nobody.
+A mesh is full once every node has an introduced connection to every other
+one, and no other connections. There are three ways the nodes come up:
+
+- join: the nodes start one at a time, each once the mesh before it is full,
+  and find each other with discovery broadcasts on a shared discovery port.
+- seed: the same, but with no discovery at all; each new node only dials the
+  first one, and learns about the rest from its peer list.
+- together: all of the nodes start at once, with a shared discovery port.
+
+For join and seed, the time is from the last node starting until the mesh
+is full; for together, it is from the first node starting.
+
+Discovery uses multicast, which has to work on the loopback interface.
+
+Usage: python tools/sim_discovery.py [nodes ...]
+"""
+import sys
+import time
+
+import harness
+
+
+### ---------------------------------------------------------------------------
+
+
+def _full(nodes):
+    return all(len(harness.live(node)) == len(node.registry) == len(nodes) - 1
+               for node in nodes)
+
+
+def _settle(nodes, start):
+    """
+    Wait for the provided nodes to form a full mesh, returning how long it
+    took from the given start time, or None if they didn't within 10
+    seconds.
+    """
+    while time.monotonic() - start < 10:
+        if _full(nodes):
+            return time.monotonic() - start
+
+        harness.pump(0.001)
+
+    return None
+
+
+def _start(idx, port, discovery):
+    # The peer directory is shared by every node here, so nothing is loaded
+    # from it; otherwise nodes would dial hosts from earlier runs.
+    overrides = dict(stream_ip="127.0.0.%d" % (idx + 1), heartbeat_interval=0,
+                     peer_expiry=-1)
+    if discovery:
+        overrides["discovery_port"] = discovery
+
+    return harness.node(port, hostname="node%d" % idx, **overrides)
+
+
+def run(mode, count, port):
+    nodes = list()
+    try:
+        discovery = None if mode == "seed" else port + 10000
+        start = time.monotonic()
+        for idx in range(count):
+            if mode != "together":
+                start = time.monotonic()
+
+            nodes.append(_start(idx, port, discovery))
+            if mode == "seed" and idx:
+                seed = nodes[0].net_thread.broadcast_msg
+                nodes[-1]._defer(nodes[-1].net_thread.dial, seed.ip, seed.port)
+
+            if mode != "together" and _settle(nodes, start) is None:
+                break
+
+        settled = _settle(nodes, start)
+        if settled is None:
+            print("{:<9} {:3} nodes: no full mesh after 10s; connections {}".format(
+                mode, count, [len(harness.live(node)) for node in nodes]))
+            return False
+
+        print("{:<9} {:3} nodes: full mesh in {:7.1f}ms".format(mode, count, settled * 1000))
+        return True
+
+    finally:
+        harness.shutdown(nodes)
+
+
+def main(*counts):
+    ok = True
+    port = 46000
+    for mode in ("join", "seed", "together"):
+        for count in counts or (4, 8, 16):
+            harness.raise_file_limit(count * count)
+            ok = run(mode, count, port) and ok
+            port += 1
+
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(*map(int, sys.argv[1:])) else 1)
@@ -0,0 +1,59 @@
+"""
+Simulate a full mesh of hosts starting up at once, and check that every pair
+of them ends up with exactly one link between them.
+
+Every node dials every other node at the same moment, as if they had all
+seen each other's discovery broadcasts in the same round, so that each pair
+starts out with two links; the duplicate of each should be closed once the
+Introduction exchange on it is done.
+
+Usage: python tools/sim_mesh.py [nodes] [base port]
+"""
+import collections
+import sys
+import time
+
+import harness
+
+
+### ---------------------------------------------------------------------------
+
+
+def main(count=8, base_port=45200):
+    nodes = [harness.node(base_port + idx, heartbeat_interval=0) for idx in range(count)]
+    try:
+        for node in nodes:
+            for idx in range(count):
+                if node is not nodes[idx]:
+                    node._defer(node.net_thread.dial, "127.0.0.1", base_port + idx)
+
+        start = time.monotonic()
+        while time.monotonic() - start < 10:
+            harness.pump(0.01)
+            if all(len(harness.live(node)) == len(node.registry) == count - 1 for node in nodes):
+                break
+
+        settled = time.monotonic() - start
+
+        # Give anything that's still going to be closed the chance to be.
+        harness.pump(0.3)
+
+        pairs = collections.Counter()
+        for node in nodes:
+            for conn in harness.live(node):
+                pairs[frozenset((node.instance_id, conn.introduction.instance_id))] += 1
+
+        # Each link is seen from both of its ends.
+        links = collections.Counter(seen // 2 for seen in pairs.values())
+        print("{} nodes settled in {:.1f}ms".format(count, settled * 1000))
+        print("{} of {} pairs linked; links per pair: {}".format(
+            len(pairs), count * (count - 1) // 2, dict(links)))
+
+        return len(pairs) == count * (count - 1) // 2 and set(links) == {1}
+
+    finally:
+        harness.shutdown(nodes)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(*map(int, sys.argv[1:])) else 1)
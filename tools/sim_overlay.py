@@ -0,0 +1,112 @@
+"""
+Simulate a large network of hosts using the relay overlay, and measure how
+many of them each broadcast reaches and how long it takes to get there.
+
+Every node is a real connection manager on a loopback port, all of them in
+this one process. Each node hears about the others in a random order, as it
+would from discovery broadcasts, and dials them until it has as many
+neighbours as it wants. Broadcasts are then sent from several different
+nodes one at a time; a broadcast arrives at a node when its network thread
+first sees the Relay carrying it.
+
+All of the network threads share one interpreter, so the latencies are far
+higher than they would be on a real network; they're mostly useful for
+comparing runs.
+
+Usage: python tools/sim_overlay.py [nodes] [neighbours] [ttl] [broadcasts]
+"""
+import random
+import statistics
+import sys
+import time
+
+import harness
+
+from SubliNet.src.network import ClipboardMessage
+from SubliNet.src.network.overlay import Overlay
+
+
+### ---------------------------------------------------------------------------
+
+
+# Maps (overlay, origin, sequence) to the time that the overlay first saw
+# that broadcast.
+arrivals = dict()
+
+
+def _relay_received(relay_received):
+    def wrapper(self, connection, msg):
+        arrivals.setdefault((self, msg.origin, msg.sequence), time.perf_counter())
+        return relay_received(self, connection, msg)
+
+    return wrapper
+
+
+def _percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main(count=200, neighbours=4, ttl=8, broadcasts=20, base_port=45300):
+    Overlay.relay_received = _relay_received(Overlay.relay_received)
+
+    random.seed(1)
+    nodes = [harness.node(base_port + idx, heartbeat_interval=0, sync_paste_history=False,
+                          broadcast_time=3600, overlay_neighbours=neighbours,
+                          overlay_ttl=ttl)
+             for idx in range(count)]
+    try:
+        def join(node, order):
+            for idx in order:
+                if not node.overlay.wants_neighbours():
+                    return
+
+                node.net_thread.dial("127.0.0.1", base_port + idx)
+
+        for idx, node in enumerate(nodes):
+            others = [other for other in range(count) if other != idx]
+            random.shuffle(others)
+            node._defer(join, node, others[:3 * neighbours])
+            time.sleep(0.002)
+
+        harness.pump(3)
+
+        degrees = sorted(len(harness.live(node)) for node in nodes)
+        print("{} nodes with {} neighbours: degree min {} median {} max {}, "
+              "{} links against {} for a full mesh".format(
+                count, neighbours, degrees[0], statistics.median(degrees), degrees[-1],
+                sum(degrees) // 2, count * (count - 1) // 2))
+
+        coverage = list()
+        latencies = list()
+        for idx in range(broadcasts):
+            origin = nodes[idx * 7 % count]
+            start = time.perf_counter()
+            origin.broadcast(ClipboardMessage("broadcast %d" % idx))
+            harness.pump(0.3)
+
+            times = [when - start for (overlay, origin_id, _), when in arrivals.items()
+                     if origin_id == origin.instance_id and overlay is not origin.overlay]
+            coverage.append(len(times) / (count - 1))
+            latencies.extend(times)
+            arrivals.clear()
+
+        latencies.sort()
+        print("coverage min {:.3f} mean {:.3f} over {} broadcasts".format(
+            min(coverage), statistics.mean(coverage), broadcasts))
+        if latencies:
+            print("latency ms p50 {:.1f} p90 {:.1f} p99 {:.1f} max {:.1f}".format(
+                *(1000 * _percentile(latencies, fraction) for fraction in (0.5, 0.9, 0.99, 1))))
+
+        duplicates = sum(node.overlay.duplicates for node in nodes)
+        print("relays sent {}, duplicates dropped {} ({:.2f} per node per broadcast)".format(
+            sum(node.overlay.relayed for node in nodes), duplicates,
+            duplicates / broadcasts / count))
+
+        return min(coverage) == 1
+
+    finally:
+        harness.shutdown(nodes)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(*map(int, sys.argv[1:])) else 1)